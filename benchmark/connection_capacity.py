@@ -0,0 +1,132 @@
+# How many concurrently waiting consumers each engine holds in one process.
+# The server runs in a child process with N sessions subscribed to one topic. The parent opens N
+# long-poll /api/receive connections, publishes one message and counts how many consumers get it,
+# how long the fan-out took, and the server's RSS and thread count while all of them were waiting.
+# wsgi is the threaded werkzeug server behind app.run, asgi is httpmq.asgi under uvicorn.
+# Usage: python -m benchmark.connection_capacity [--engines wsgi asgi] [--connections 1000 10000]
+# Raise the open file limit (ulimit -n) above the largest connection count first.
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+TOPIC = 'bench/fanout'
+
+def serve(engine: str, port: int, sessions: int):
+    if engine == 'asgi':
+        import uvicorn
+        from httpmq.asgi import app, queue as mq
+    else:
+        from werkzeug.serving import make_server
+        from httpmq.server import app, mq
+    for i in range(sessions):
+        mq.register(f'bench-{i}')
+        mq.subscribe(f'bench-{i}', TOPIC)
+    if engine == 'asgi':
+        uvicorn.run(app, port=port, log_level='error', backlog=4096)
+    else:
+        server = make_server('127.0.0.1', port, app, threaded=True)
+        server.socket.listen(4096)
+        server.serve_forever()
+
+def server_stats(pid: int) -> tuple[int, int]:
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+async def request(port: int, method: str, path: str, body: bytes = b'') -> tuple[int, bytes]:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                     f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return int(response.split(b' ', 2)[1]), response.partition(b'\r\n\r\n')[2]
+
+async def wait_ready(port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await request(port, 'GET', '/api/subscribe?session_id=bench-0')
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+async def consumer(port: int, index: int, connected: list, received: list):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return
+    connected[0] += 1
+    try:
+        writer.write(f'GET /api/receive?session_id=bench-{index}&timeout=60 HTTP/1.1\r\n'
+                     f'Host: localhost\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        response = await reader.read()
+        if TOPIC.encode() in response:
+            received.append(time.perf_counter())
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+async def measure(engine: str, port: int, connections: int, pid: int, settle: float) -> dict:
+    await wait_ready(port)
+    connected, received = [0], []
+    tasks = []
+    for offset in range(0, connections, 500):
+        tasks += [asyncio.create_task(consumer(port, i, connected, received))
+                  for i in range(offset, min(offset + 500, connections))]
+        await asyncio.sleep(0.05)
+    # give the server time to accept and park every request
+    await asyncio.sleep(settle)
+    rss, threads = server_stats(pid)
+    start = time.perf_counter()
+    await request(port, 'POST', f'/api/publish/{TOPIC}', json.dumps({'data': 'wake', 'ttl': 60}).encode())
+    await asyncio.wait(tasks, timeout=60)
+    for task in tasks:
+        task.cancel()
+    return {
+        'engine': engine,
+        'connections': connections,
+        'connected': connected[0],
+        'delivered': len(received),
+        'fanout_ms': round((max(received) - start) * 1e3, 1) if received else None,
+        'rss_mb': round(rss / 2 ** 20, 1),
+        'threads': threads,
+    }
+
+def run(engine: str, port: int, connections: int, settle: float) -> dict:
+    child = subprocess.Popen([sys.executable, '-m', 'benchmark.connection_capacity', '--serve', engine,
+                              '--port', str(port), '--connections', str(connections)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return asyncio.run(measure(engine, port, connections, child.pid, settle))
+    finally:
+        child.kill()
+        child.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', nargs='+', default=['wsgi', 'asgi'])
+    parser.add_argument('--connections', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--port', type=int, default=5902)
+    parser.add_argument('--settle', type=float, default=5, help='seconds to wait after connecting')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.connections[0])
+        sys.exit()
+    for connections in args.connections:
+        for engine in args.engines:
+            print(json.dumps(run(engine, args.port, connections, args.settle)), flush=True)
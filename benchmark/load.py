@@ -0,0 +1,282 @@
+# Sustained load against an in-process MessageQueue and against httpmq.server over loopback.
+# Producer threads publish batches round-robin over the topics, optionally paced to a rate, consumer
+# threads long-poll their sessions and acknowledge every page up to its last message. Every message
+# carries its publish time, so consumers measure end-to-end latency. Reports publish/receive/ack
+# throughput, p50/p99/p999 latency and the RSS of the process holding the queue (the server child
+# process for http). Producers and consumers share the client process and its GIL, keep that in mind
+# when reading the http numbers.
+# --output saves the results together with the commit they were measured on, --compare prints how a
+# run differs from such a file, so regressions show up between commits.
+# Usage: python -m benchmark.load [--targets inproc http] [--producers N] [--consumers N] [--topics N]
+#        [--payload BYTES] [--ttl SECONDS] [--batch N] [--rate MSG/S] [--duration SECONDS]
+#        [--output FILE] [--compare FILE]
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+import requests
+
+class InProcess:
+    def __init__(self):
+        from httpmq.message_queue import MessageQueue
+        self.mq = MessageQueue()
+
+    def register(self, session_id: str):
+        self.mq.register(session_id)
+
+    def subscribe(self, session_id: str, topic: str):
+        self.mq.subscribe(session_id, topic)
+
+    def publish_many(self, batch: list[tuple[str, dict, int]]):
+        self.mq.publish_many(batch)
+
+    def receive(self, session_id: str, max_messages: int) -> list[tuple[str, int, dict]]:
+        messages = self.mq.receive(session_id, timeout=0.5, max_messages=max_messages)
+        return [(message.topic, message.seq, message.data) for message in messages]
+
+    def acknowledge_up_to(self, session_id: str, topic: str, seq: int):
+        self.mq.acknowledge_up_to(session_id, topic, seq)
+
+    def close(self):
+        pass
+
+    def rss(self) -> tuple[int, int]:
+        return memory('self')
+
+class Http:
+    def __init__(self, port: int):
+        self.url = f'http://127.0.0.1:{port}'
+        self.child = subprocess.Popen([sys.executable, '-m', 'benchmark.load', '--serve', '--port', str(port)],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.local = threading.local()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                self.session().post(f'{self.url}/api/register')
+                return
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError('server did not start')
+                time.sleep(0.2)
+
+    def session(self) -> requests.Session:
+        # one keep-alive connection per client thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def register(self, session_id: str):
+        # the server picks the session id, keep ours as an alias
+        self.local.session_id = self.session().post(f'{self.url}/api/register').json()['session_id']
+
+    def subscribe(self, session_id: str, topic: str):
+        self.session().post(f'{self.url}/api/subscribe/{topic}', json={'session_id': self.local.session_id})
+
+    def publish_many(self, batch: list[tuple[str, dict, int]]):
+        response = self.session().post(f'{self.url}/api/publish', json={
+            'messages': [{'topic': topic, 'data': data, 'ttl': ttl} for topic, data, ttl in batch]})
+        if response.status_code in (429, 503):
+            raise Rejected(int(response.headers.get('Retry-After', 1)))
+        response.raise_for_status()
+
+    def receive(self, session_id: str, max_messages: int) -> list[tuple[str, int, dict]]:
+        response = self.session().get(f'{self.url}/api/receive', params={
+            'session_id': self.local.session_id, 'timeout': 0.5, 'max_messages': max_messages})
+        response.raise_for_status()
+        return [(message['topic'], message['seq'], message['data']) for message in response.json()['messages']]
+
+    def acknowledge_up_to(self, session_id: str, topic: str, seq: int):
+        self.session().post(f'{self.url}/api/acknowledge', json={'session_id': self.local.session_id,
+                                                                  'topic': topic, 'up_to': seq})
+
+    def close(self):
+        self.child.kill()
+        self.child.wait()
+
+    def rss(self) -> tuple[int, int]:
+        return memory(self.child.pid)
+
+class Rejected(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+def serve(port: int):
+    from werkzeug.serving import make_server
+    from httpmq.server import app
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+def memory(pid) -> tuple[int, int]:
+    # current and peak resident set size in bytes
+    rss = peak = 0
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('VmHWM:'):
+                peak = int(line.split()[1]) * 1024
+    return rss, peak
+
+def percentile(samples: list[float], fraction: float) -> float:
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+
+def assign(consumer: int, consumers: int, topics: int) -> list[int]:
+    # every topic gets at least one consumer, extra consumers share topics
+    if consumers >= topics:
+        return [consumer % topics]
+    return [topic for topic in range(topics) if topic % consumers == consumer]
+
+def run(target: str, args) -> dict:
+    driver = Http(args.port) if target == 'http' else InProcess()
+    names = [f'bench/load/{topic}' for topic in range(args.topics)]
+    padding = 'x' * args.payload
+    producing = threading.Event()
+    consuming = threading.Event()
+    published = [0] * args.producers
+    rejected = [0] * args.producers
+    received = [0] * args.consumers
+    acknowledged = [0] * args.consumers
+    latencies: list[list[float]] = [[] for _ in range(args.consumers)]
+    finished = [0.0] * args.consumers # when each consumer got its last page
+    subscribed = threading.Barrier(args.consumers + 1)
+
+    def producer(index: int):
+        position = index
+        interval = args.batch / args.rate if args.rate else 0
+        next_batch = time.monotonic()
+        while not producing.is_set():
+            batch = []
+            for _ in range(args.batch):
+                batch.append((names[position % len(names)], {'sent': time.time(), 'padding': padding}, args.ttl))
+                position += 1
+            try:
+                driver.publish_many(batch)
+                published[index] += len(batch)
+            except Rejected as rejection:
+                rejected[index] += len(batch)
+                producing.wait(min(rejection.retry_after, 1))
+            if interval:
+                next_batch += interval
+                producing.wait(max(0, next_batch - time.monotonic()))
+
+    def consumer(index: int):
+        session_id = f'bench-load-{index}'
+        driver.register(session_id)
+        for topic in assign(index, args.consumers, args.topics):
+            driver.subscribe(session_id, names[topic])
+        subscribed.wait()
+        while True:
+            messages = driver.receive(session_id, args.page)
+            if not messages:
+                # drained after the producers stopped
+                if consuming.is_set():
+                    return
+                continue
+            now = time.time()
+            latencies[index].extend(now - data['sent'] for _, _, data in messages)
+            received[index] += len(messages)
+            last: dict[str, int] = {}
+            for topic, seq, _ in messages:
+                last[topic] = max(seq, last.get(topic, -1))
+            for topic, seq in last.items():
+                driver.acknowledge_up_to(session_id, topic, seq)
+            acknowledged[index] += len(messages)
+            finished[index] = time.monotonic()
+
+    consumers = [threading.Thread(target=consumer, args=(i,), daemon=True) for i in range(args.consumers)]
+    producers = [threading.Thread(target=producer, args=(i,), daemon=True) for i in range(args.producers)]
+    try:
+        for thread in consumers:
+            thread.start()
+        subscribed.wait()
+        start = time.monotonic()
+        for thread in producers:
+            thread.start()
+        time.sleep(args.duration)
+        producing.set()
+        for thread in producers:
+            thread.join()
+        publish_elapsed = time.monotonic() - start
+        rss, peak = driver.rss()
+        consuming.set()
+        for thread in consumers:
+            thread.join(args.drain)
+        elapsed = max(finished) - start if any(finished) else publish_elapsed
+    finally:
+        driver.close()
+    samples = sorted(latency for samples in latencies for latency in samples)
+    return {
+        'target': target,
+        'producers': args.producers,
+        'consumers': args.consumers,
+        'topics': args.topics,
+        'payload': args.payload,
+        'batch': args.batch,
+        'rate': args.rate,
+        'published': sum(published),
+        'rejected': sum(rejected),
+        'received': sum(received),
+        'publish_per_s': round(sum(published) / publish_elapsed),
+        'receive_per_s': round(sum(received) / elapsed),
+        'ack_per_s': round(sum(acknowledged) / elapsed),
+        'p50_ms': round(percentile(samples, 0.5) * 1e3, 2) if samples else None,
+        'p99_ms': round(percentile(samples, 0.99) * 1e3, 2) if samples else None,
+        'p999_ms': round(percentile(samples, 0.999) * 1e3, 2) if samples else None,
+        'rss_mb': round(rss / 2 ** 20, 1),
+        'peak_rss_mb': round(peak / 2 ** 20, 1),
+    }
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results: list[dict], path: str):
+    with open(path) as file:
+        baseline = {result['target']: result for result in json.load(file)['results']}
+    for result in results:
+        before = baseline.get(result['target'])
+        if not before:
+            continue
+        for key in ('publish_per_s', 'receive_per_s', 'ack_per_s', 'p50_ms', 'p99_ms', 'p999_ms', 'peak_rss_mb'):
+            if before.get(key) and result.get(key) is not None:
+                print(f'{result["target"]:>7} {key:>14}: {before[key]:>10} -> {result[key]:>10} '
+                      f'({(result[key] / before[key] - 1) * 100:+.1f}%)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', nargs='+', choices=['inproc', 'http'], default=['inproc', 'http'])
+    parser.add_argument('--producers', type=int, default=2)
+    parser.add_argument('--consumers', type=int, default=2)
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--payload', type=int, default=100, help='bytes of padding per message')
+    parser.add_argument('--ttl', type=int, default=60)
+    parser.add_argument('--batch', type=int, default=10, help='messages per publish call')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per producer, 0 is unpaced')
+    parser.add_argument('--page', type=int, default=100, help='max_messages per receive')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=10, help='seconds consumers get to catch up afterwards')
+    parser.add_argument('--port', type=int, default=5903)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file written by --output to compare against')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.port)
+        sys.exit()
+    results = []
+    for target in args.targets:
+        results.append(run(target, args))
+        print(json.dumps(results[-1]), flush=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'commit': commit(), 'python': platform.python_version(), 'time': int(time.time()),
+                       'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'serve')},
+                       'results': results}, file, indent=2)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,51 @@
+# Multi-threaded publish/receive throughput against an in-process MessageQueue.
+# Every topic gets its own publisher and consumer thread, so with per-topic and
+# per-session locks the threads of different topics never wait on each other.
+# Usage: python -m benchmark.lock_scaling [--topics 1 2 4 8] [--duration SECONDS]
+import argparse
+import threading
+import time
+from httpmq.message_queue import MessageQueue
+
+def run(topics: int, duration: float, batch_size: int) -> tuple[int, int]:
+    mq = MessageQueue()
+    stop = threading.Event()
+    published = [0] * topics
+    received = [0] * topics
+
+    def producer(index: int):
+        topic = f'bench/{index}'
+        while not stop.is_set():
+            mq.publish_many([(topic, 'payload', 60)] * batch_size)
+            published[index] += batch_size
+
+    def consumer(index: int):
+        session_id = f'consumer-{index}'
+        mq.register(session_id)
+        mq.subscribe(session_id, f'bench/{index}')
+        while not stop.is_set():
+            messages = mq.receive(session_id, timeout=0.1)
+            if messages:
+                mq.acknowledge_up_to(session_id, f'bench/{index}', max(message.seq for message in messages))
+                received[index] += len(messages)
+
+    threads = [threading.Thread(target=producer, args=(i,)) for i in range(topics)]
+    threads += [threading.Thread(target=consumer, args=(i,)) for i in range(topics)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(published), sum(received)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--topics', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--batch-size', type=int, default=10)
+    args = parser.parse_args()
+    print(f'{"topics":>6} {"publish/s":>12} {"receive/s":>12}')
+    for topics in args.topics:
+        published, received = run(topics, args.duration, args.batch_size)
+        print(f'{topics:>6} {published / args.duration:>12.0f} {received / args.duration:>12.0f}')
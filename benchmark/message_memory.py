@@ -0,0 +1,42 @@
+# Bytes of Python heap retained per queued message and per session.
+# Usage: python -m benchmark.message_memory [--messages N] [--sessions N] [--payload BYTES]
+import argparse
+import tracemalloc
+from httpmq.message_queue import MessageQueue
+
+def measure_messages(count: int, topics: int, payload: str) -> float:
+    mq = MessageQueue()
+    for i in range(topics):
+        mq.publish(f'bench/{i}', payload, 3600)
+    batch = [(f'bench/{i % topics}', payload, 3600) for i in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for offset in range(0, count, 1000):
+        mq.publish_many(batch[offset:offset + 1000])
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+def measure_sessions(count: int) -> float:
+    mq = MessageQueue()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        session_id = f'session-{i:08d}'
+        mq.register(session_id)
+        mq.subscribe(session_id, 'bench/0')
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--payload', type=int, default=16)
+    args = parser.parse_args()
+    # the payload string is shared, so only per-message overhead is counted
+    payload = 'x' * args.payload
+    print(f'{measure_messages(args.messages, args.topics, payload):.0f} bytes per retained message')
+    print(f'{measure_sessions(args.sessions):.0f} bytes per session')
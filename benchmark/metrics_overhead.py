@@ -0,0 +1,75 @@
+# Cost of the metrics recorded on the hot paths. The same publish/receive/acknowledge workload runs
+# against a MessageQueue as it ships and against one whose counters, histograms and timed locks were
+# swapped for no-ops. Every round runs both back to back, alternating which goes first, and the overhead
+# is the median of the per-round ratios, so drift in machine load hits both sides of a ratio alike.
+# --lock-metrics measures a queue that also times its per-topic and per-session locks.
+# Usage: python -m benchmark.metrics_overhead [--rounds N] [--operations N] [--threads N] [--batch N] [--lock-metrics]
+import argparse
+import contextlib
+import gc
+import statistics
+import threading
+import time
+from httpmq.message_queue import MessageQueue
+
+class NoMetric:
+    def inc(self, amount: float = 1):
+        pass
+
+    def observe(self, value: float, labels: tuple = ()):
+        pass
+
+    def time(self, labels: tuple = ()):
+        return contextlib.nullcontext()
+
+def uninstrumented() -> MessageQueue:
+    mq = MessageQueue()
+    mq.lock = threading.Lock()
+    for name in ('published', 'delivered', 'acknowledged', 'rejected_topic_full', 'rejected_memory', 'dropped_expired',
+                 'dropped_overflow', 'dropped_acknowledged', 'dropped_unsubscribed', 'expired_sessions', 'expire_seconds'):
+        setattr(mq, name, NoMetric())
+    return mq
+
+def workload(mq: MessageQueue, threads: int, operations: int, batch: int) -> float:
+    # each thread publishes to its own topic, drains it and acknowledges, returns messages per second
+    def worker(index: int):
+        topic = f'bench/{index}'
+        session_id = f'bench-{index}'
+        mq.register(session_id)
+        mq.subscribe(session_id, topic)
+        for _ in range(operations // batch):
+            if batch == 1:
+                mq.publish(topic, 'payload', 60)
+            else:
+                mq.publish_many([(topic, 'payload', 60)] * batch)
+            messages = mq.receive(session_id)
+            mq.acknowledge_up_to(session_id, topic, messages[-1].seq)
+        mq.expire()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=40)
+    parser.add_argument('--operations', type=int, default=2000, help='messages per thread and round')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=1, help='messages per publish')
+    parser.add_argument('--lock-metrics', action='store_true', help='also time the per-topic and per-session locks')
+    args = parser.parse_args()
+    baseline, instrumented, ratios = [], [], []
+    for round in range(args.rounds):
+        # alternate which goes first, and start both from a collected heap
+        order = [(baseline, uninstrumented), (instrumented, lambda: MessageQueue(lock_metrics=args.lock_metrics))]
+        for results, make in (order if round % 2 else reversed(order)):
+            gc.collect()
+            results.append(workload(make(), args.threads, args.operations, args.batch))
+        ratios.append(instrumented[-1] / baseline[-1])
+    print(f'without metrics: {statistics.median(baseline):10.0f} msg/s')
+    print(f'   with metrics: {statistics.median(instrumented):10.0f} msg/s')
+    print(f'       overhead: {(1 - statistics.median(ratios)) * 100:9.1f} %')
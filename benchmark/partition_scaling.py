@@ -0,0 +1,59 @@
+# Aggregate publish/receive throughput of the partitioned mode as partitions are added.
+# Every round starts N partition workers and as many client processes, each publishing batches to its
+# own topics and draining them through a session, the way separate server processes would.
+# On a machine with fewer cores than partitions the numbers flatten out, that is the point of the test.
+# Usage: python -m benchmark.partition_scaling [--partitions 1 2 4] [--clients N] [--duration SECONDS]
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from httpmq.partition import PartitionedMessageQueue, start_partitions
+
+def client(directory: str, partitions: int, index: int, topics: int, batch_size: int, duration: float, results):
+    mq = PartitionedMessageQueue(directory, partitions)
+    session_id = f'bench-{index}'
+    names = [f'bench/{index}/{topic}' for topic in range(topics)]
+    mq.register(session_id)
+    for name in names:
+        mq.subscribe(session_id, name)
+    published = received = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        mq.publish_many([(names[i % topics], 'payload', 60) for i in range(batch_size)])
+        published += batch_size
+        last: dict[str, int] = {}
+        for message in mq.receive(session_id):
+            last[message.topic] = max(last.get(message.topic, -1), message.seq)
+            received += 1
+        for name, seq in last.items():
+            mq.acknowledge_up_to(session_id, name, seq)
+    results.put((published, received))
+
+def run(partitions: int, clients: int, topics: int, batch_size: int, duration: float) -> tuple[float, float]:
+    with tempfile.TemporaryDirectory() as directory:
+        workers = start_partitions(partitions, directory)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(directory, partitions, index, topics, batch_size,
+                                                                  duration, results)) for index in range(clients)]
+        for process in processes:
+            process.start()
+        totals = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        for worker in workers:
+            worker.terminate()
+    return sum(published for published, _ in totals) / duration, sum(received for _, received in totals) / duration
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--partitions', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=os.cpu_count())
+    parser.add_argument('--topics', type=int, default=16, help='topics per client')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} cores, {args.clients} client processes')
+    for partitions in args.partitions:
+        published, received = run(partitions, args.clients, args.topics, args.batch_size, args.duration)
+        print(f'{partitions:3} partitions: {published:10.0f} published/s {received:10.0f} received/s')
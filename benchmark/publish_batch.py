@@ -0,0 +1,33 @@
+# Compare per-message publish cost of /api/publish/<topic> against the batched /api/publish.
+# Runs the Flask app in-process so only server-side overhead is measured.
+# Usage: python -m benchmark.publish_batch [--messages N] [--batch-size N]
+import argparse
+import time
+from httpmq.server import app
+
+def publish_single(client, count: int, topics: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        client.post(f'/api/publish/bench/{i % topics}', json={'data': f'event {i}', 'ttl': 60})
+    return time.perf_counter() - start
+
+def publish_batched(client, count: int, topics: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        batch = [{'topic': f'bench/{i % topics}', 'data': f'event {i}', 'ttl': 60}
+                 for i in range(offset, min(offset + batch_size, count))]
+        client.post('/api/publish', json={'messages': batch})
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    client = app.test_client()
+    single = publish_single(client, args.messages, args.topics)
+    batched = publish_batched(client, args.messages, args.topics, args.batch_size)
+    print(f'single:  {single / args.messages * 1e6:8.1f} us/message')
+    print(f'batched: {batched / args.messages * 1e6:8.1f} us/message (batch size {args.batch_size})')
+    print(f'speedup: {single / batched:.1f}x')
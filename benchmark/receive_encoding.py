@@ -0,0 +1,50 @@
+# Time to build a /api/receive body for a page of messages: a dict per message through json.dumps,
+# the way jsonify did it, against splicing in the cached per-message encodings, with and without orjson.
+# Usage: python -m benchmark.receive_encoding [--messages N] [--payload BYTES] [--rounds N]
+import argparse
+import json
+import time
+from httpmq import encoder
+from httpmq.message_queue import MessageQueue
+
+def to_dict_body(messages: list) -> bytes:
+    return json.dumps({'messages': [message.to_dict() for message in messages], 'next': ''}).encode()
+
+def cold_body(messages: list) -> bytes:
+    # every message encoded for the first time, the way receive(encode=True) keeps it
+    for message in messages:
+        message.encoded = None
+    mq._encode(messages)
+    return encoder.messages_response(messages, next='')
+
+def warm_body(messages: list) -> bytes:
+    return encoder.messages_response(messages, next='')
+
+def measure(build, messages: list, rounds: int) -> float:
+    build(messages)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        build(messages)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--payload', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+    mq = MessageQueue()
+    mq.register('bench')
+    mq.subscribe('bench', 'bench/0')
+    mq.publish_many([('bench/0', 'x' * args.payload, 3600)] * args.messages)
+    messages = mq.receive('bench', max_messages=args.messages, encode=True)
+    orjson = encoder.orjson
+    print(f'{len(messages)} messages of {args.payload} bytes, us per response body')
+    print(f'{"to_dict + json.dumps":>24}: {measure(to_dict_body, messages, args.rounds):10.0f}')
+    for name in ('json', 'orjson'):
+        if name == 'orjson' and not orjson:
+            print('orjson is not installed')
+            break
+        encoder.orjson = orjson if name == 'orjson' else None
+        print(f'{"cold cache, " + name:>24}: {measure(cold_body, messages, args.rounds):10.0f}')
+        print(f'{"warm cache, " + name:>24}: {measure(warm_body, messages, args.rounds):10.0f}')
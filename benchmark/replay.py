@@ -0,0 +1,49 @@
+# Time to rebuild a MessageQueue from its write-ahead log, optionally starting from a snapshot.
+# Usage: python -m benchmark.replay [--messages 10000000] [--ttl SECONDS] [--snapshot] [--dir PATH]
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from httpmq.message_queue import MessageQueue
+from httpmq.storage import SegmentLog
+
+def populate(directory: str, count: int, topics: int, sessions: int, ttl: int, payload: str, snapshot: bool):
+    mq = MessageQueue(SegmentLog(directory))
+    for i in range(sessions):
+        mq.register(f'session-{i}')
+        mq.subscribe(f'session-{i}', f'bench/{i % topics}')
+    for offset in range(0, count, 10000):
+        mq.publish_many([(f'bench/{i % topics}', payload, ttl) for i in range(offset, min(offset + 10000, count))])
+    if snapshot:
+        # expired messages are left out of the snapshot, so the snapshot holds only the live state
+        mq.expire()
+        mq.snapshot()
+    mq.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--topics', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--ttl', type=int, default=3600)
+    parser.add_argument('--payload', type=int, default=64)
+    parser.add_argument('--snapshot', action='store_true', help='snapshot once the log is written')
+    parser.add_argument('--dir', help='reuse an existing log directory instead of writing a new one')
+    args = parser.parse_args()
+    directory = args.dir or tempfile.mkdtemp(prefix='httpmq-replay-')
+    try:
+        if not args.dir:
+            start = time.perf_counter()
+            populate(directory, args.messages, args.topics, args.sessions, args.ttl, 'x' * args.payload, args.snapshot)
+            print(f'write:  {time.perf_counter() - start:.1f}s')
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        start = time.perf_counter()
+        mq = MessageQueue(SegmentLog(directory))
+        elapsed = time.perf_counter() - start
+        retained = sum(len(topic) for topic in mq.topics.values())
+        print(f'startup: {elapsed:.2f}s from {size / 1e6:.0f} MB on disk, {retained} messages retained')
+        mq.close()
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
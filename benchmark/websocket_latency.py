@@ -0,0 +1,68 @@
+# Publish-to-delivery latency over REST long-polling against the WebSocket transport.
+# Starts the server on a loopback port. Each round trip publishes one message, waits until
+# a subscribed consumer has it and acknowledges it, so the numbers include both hops.
+# Requires flask-sock on the server side and websocket-client for the client.
+# Usage: python -m benchmark.websocket_latency [--messages N] [--port PORT]
+import argparse
+import os
+import sys
+import threading
+import time
+import requests
+from werkzeug.serving import make_server
+from httpmq.server import app
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'client', 'py'))
+from httpmqwebsocket import HTTPMQWebSocketClient
+
+def percentile(samples: list[float], fraction: float) -> float:
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+def rest_round_trips(url: str, count: int) -> list[float]:
+    publisher = requests.Session()
+    consumer = requests.Session()
+    session_id = consumer.post(f'{url}/api/register').json()['session_id']
+    consumer.post(f'{url}/api/subscribe/bench/rest', json={'session_id': session_id})
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        publisher.post(f'{url}/api/publish/bench/rest', json={'data': f'event {i}', 'ttl': 60})
+        messages = []
+        while not messages:
+            messages = consumer.get(f'{url}/api/receive', params={'session_id': session_id, 'timeout': 5}).json()['messages']
+        consumer.post(f'{url}/api/acknowledge', json={'session_id': session_id, 'topic': 'bench/rest',
+                                                       'up_to': max(message['seq'] for message in messages)})
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def websocket_round_trips(url: str, count: int) -> list[float]:
+    publisher = HTTPMQWebSocketClient(url)
+    consumer = HTTPMQWebSocketClient(url)
+    consumer.subscribe('bench/ws')
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        publisher.publish('bench/ws', 60, f'event {i}')
+        message = consumer.receive(timeout=5)
+        consumer.acknowledge_up_to('bench/ws', message['seq'])
+        samples.append(time.perf_counter() - start)
+    publisher.close()
+    consumer.close()
+    return samples
+
+def report(name: str, samples: list[float]):
+    samples.sort()
+    print(f'{name:10} p50 {percentile(samples, 0.5) * 1e3:7.2f} ms  p99 {percentile(samples, 0.99) * 1e3:7.2f} ms  '
+          f'{len(samples) / sum(samples):8.0f} round trips/s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5901)
+    args = parser.parse_args()
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{args.port}'
+    report('rest', rest_round_trips(url, args.messages))
+    report('websocket', websocket_round_trips(url, args.messages))
+    server.shutdown()
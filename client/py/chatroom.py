@@ -38,6 +38,7 @@ def impart(package_name) -> bool:
 
 USE_WCWIDTH = impart('wcwidth')
 TAB_WIDTH = 8
+RECEIVE_TIMEOUT = 1
 
 def display_length(text):
     total_width = 0
@@ -88,8 +89,8 @@ def receive_func(pad, client, max_y, max_x, stdscr, screen_control_queue):
                 else:
                     row += control
                 refresh = True
-            messages = client.receive()
-            messages.sort(key=lambda x: x['timestamp'])
+            # long-poll, the timeout only bounds how late resizes and screen controls are handled
+            messages = client.receive(timeout=RECEIVE_TIMEOUT)
             for chat_message in messages:
                 topic = chat_message['topic']
                 chatroom_id = ''
@@ -111,14 +112,12 @@ def receive_func(pad, client, max_y, max_x, stdscr, screen_control_queue):
                 curses.setsyx(y, x)
             curses.doupdate()
         except:
-            pass
+            time.sleep(0.3)
         finally:
             if next_delay < 0:
                 pass
             if next_delay > 0:
                 time.sleep(next_delay)
-            else:
-                time.sleep(0.3)
             next_delay = 0
 
 def chat(stdscr, client):
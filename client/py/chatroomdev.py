@@ -48,7 +48,6 @@ class ChatWindow:
                 pad.refresh(0,0, 0,0, max_y-2, max_x-1)
 
             messages = client.receive()
-            messages.sort(key=lambda x: x['timestamp'])
             for chat_message in messages:
                 message_text = ChatroomMessage.message_to_text(chat_message['data'])
                 if len(message_text) > 0:
@@ -34,10 +34,10 @@ class HTTPMQChatroom:
             pass
         self.nickname = platform.node()
     
-    def receive(self, client: 'HTTPMQClient' = None) -> list[dict]:
+    def receive(self, client: 'HTTPMQClient' = None, timeout: float = 0) -> list[dict]:
         if not client:
             client = self.client
-        resp = client.receive()
+        resp = client.receive(timeout)
         if resp:
             messages = resp['messages']
             if messages:
@@ -160,16 +160,13 @@ class HTTPMQChatroom:
         self.broadcast_info()
         self.send_join()
         while True:
-            messages = self.receive()
-            # sort messages by timestamp
-            messages.sort(key=lambda x: x['timestamp'])
+            messages = self.receive(timeout=interval)
             for message in messages:
                 # print message time
                 message_text = ChatroomMessage.message_to_text(message['data'])
                 if len(message_text) > 0:
                     print(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message["timestamp"]))}]', end=' ')
                     print(message_text)
-            time.sleep(interval)
     
     def _publish(self, message: 'ChatroomMessage'):
         message.meta['nickname'] = self.nickname
@@ -4,6 +4,7 @@ import sys
 import platform
 import requests
 import json
+from urllib.parse import quote
 
 class HTTPMQClient:
     def __init__(self, server_url, session_id = None, stat = True):
@@ -11,6 +12,7 @@ class HTTPMQClient:
         self.server_url = server_url
         self.session_id = session_id
         self.subscribed_topics = []
+        self.groups = {} # topic -> (group, visibility_timeout) for topics joined as a consumer group
         self.auto_resession = True
         self.requests = requests.Session()
         if not session_id:
@@ -51,7 +53,7 @@ class HTTPMQClient:
     def publish(self, topic: str, ttl: int, data) -> dict:
         if isinstance(data, dict):
             data = json.dumps(data)
-        url = f"{self.server_url}/api/publish/{topic}"
+        url = f"{self.server_url}/api/publish/{quote(topic)}"
         try:
             response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
                                      data=json.dumps({"ttl": ttl, "data": data}))
@@ -60,13 +62,28 @@ class HTTPMQClient:
         except requests.exceptions.RequestException as exception:
             raise exception
 
-    def subscribe(self, topic: str) -> dict:
-        url = f"{self.server_url}/api/subscribe/{topic}"
+    def publish_many(self, messages: list[dict]) -> dict:
+        batch = []
+        for message in messages:
+            data = message.get('data')
+            if isinstance(data, dict):
+                data = json.dumps(data)
+            batch.append({"topic": message['topic'], "ttl": message.get('ttl'), "data": data})
+        url = f"{self.server_url}/api/publish"
+        response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
+                                 data=json.dumps({"messages": batch}))
+        response.raise_for_status()
+        return response.json()
+
+    def subscribe(self, topic: str, group: str = None, visibility_timeout: int = None) -> dict:
+        url = f"{self.server_url}/api/subscribe/{quote(topic)}"
         if topic not in self.subscribed_topics:
             self.subscribed_topics.append(topic)
+            if group:
+                self.groups[topic] = (group, visibility_timeout)
             try:
                 response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
-                                        data=json.dumps({"session_id": self.session_id}))
+                                        data=json.dumps(self._subscription(topic)))
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as exception:
@@ -80,9 +97,10 @@ class HTTPMQClient:
         
 
     def unsubscribe(self, topic: str) -> dict:
-        url = f"{self.server_url}/api/subscribe/{topic}"
+        url = f"{self.server_url}/api/subscribe/{quote(topic)}"
         if topic in self.subscribed_topics:
             self.subscribed_topics.remove(topic)
+            self.groups.pop(topic, None)
             try:
                 response = self.requests.delete(url, headers={"Content-Type": "application/json; charset=utf-8"},
                                         data=json.dumps({"session_id": self.session_id}))
@@ -97,10 +115,21 @@ class HTTPMQClient:
         else:
             return None
 
-    def receive(self) -> dict:
+    def receive(self, timeout: float = 0, max_messages: int = None, max_bytes: int = None, cursor: str = None) -> dict:
+        # oldest first, pass the returned 'next' as cursor to page through messages before acknowledging them
         url = f"{self.server_url}/api/receive"
+        params = {"session_id": self.session_id}
+        if timeout > 0:
+            params["timeout"] = timeout
+        if max_messages:
+            params["max_messages"] = max_messages
+        if max_bytes:
+            params["max_bytes"] = max_bytes
+        if cursor:
+            params["cursor"] = cursor
         try:
-            response = self.requests.get(url, params={"session_id": self.session_id})
+            # leave the server room to answer before the HTTP request itself times out
+            response = self.requests.get(url, params=params, timeout=timeout + 30 if timeout > 0 else None)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as exception:
@@ -110,6 +139,25 @@ class HTTPMQClient:
                 raise exception
             return None
 
+    def stream(self, auto_ack: bool = False, read_timeout: float = 60):
+        url = f"{self.server_url}/api/stream"
+        params = {"session_id": self.session_id}
+        if auto_ack:
+            params["auto_ack"] = 1
+        # the server sends a keep-alive comment well within read_timeout
+        with self.requests.get(url, params=params, stream=True, timeout=(10, read_timeout)) as response:
+            response.raise_for_status()
+            data_lines = []
+            for line in response.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line == '':
+                    if data_lines:
+                        yield json.loads('\n'.join(data_lines))
+                    data_lines = []
+                elif line.startswith('data:'):
+                    data_lines.append(line[5:].lstrip())
+
     def acknowledge(self, topic: str, message_id: str) -> dict:
         url = f"{self.server_url}/api/acknowledge"
         try:
@@ -120,8 +168,28 @@ class HTTPMQClient:
         except requests.exceptions.RequestException:
             return response.json()
     
+    def acknowledge_up_to(self, topic: str, seq: int) -> dict:
+        url = f"{self.server_url}/api/acknowledge"
+        response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
+                                 data=json.dumps({"topic": topic, "up_to": seq, "session_id": self.session_id}))
+        response.raise_for_status()
+        return response.json()
+
     def ack_all(self, messages: list[dict], output: bool = True) -> list[dict]:
         resp = []
+        if len(messages) == 0:
+            return resp
+        url = f"{self.server_url}/api/acknowledge"
+        acknowledgements = [{'topic': message['topic'], 'message_id': message['message_id']} for message in messages]
+        results = None
+        error = None
+        try:
+            response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
+                                     data=json.dumps({"messages": acknowledgements, "session_id": self.session_id}))
+            response.raise_for_status()
+            results = response.json()['results']
+        except requests.exceptions.RequestException as exception:
+            error = exception
         messages_len = len(messages)
         for i in range(messages_len):
             message = messages[i]
@@ -133,15 +201,13 @@ class HTTPMQClient:
             ack_resp = {
                 'success': False,
                 'response': None,
-                'error': None
+                'error': error
             }
-            try:
-                ack_resp['response'] = self.acknowledge(topic, message_id)
+            if results is not None:
+                ack_resp['response'] = results[i]
                 ack_resp['success'] = True
                 if output:
                     print(f'\033[K[{i+1}/{len(messages)}] Acked message {message_id} on topic {topic}: {data}', end='\r')
-            except requests.exceptions.RequestException as exception:
-                ack_resp['error'] = exception
             resp.append(ack_resp)
         if output:
             print(f'\033[K', end='\r')
@@ -152,9 +218,15 @@ class HTTPMQClient:
             return
         self.register()
         for topic in self.subscribed_topics:
-            url = f"{self.server_url}/api/subscribe/{topic}"
+            url = f"{self.server_url}/api/subscribe/{quote(topic)}"
             response = self.requests.post(url, headers={"Content-Type": "application/json; charset=utf-8"},
-                                    data=json.dumps({"session_id": self.session_id}))
+                                    data=json.dumps(self._subscription(topic)))
+
+    def _subscription(self, topic: str) -> dict:
+        body = {"session_id": self.session_id}
+        if topic in self.groups:
+            body["group"], body["visibility_timeout"] = self.groups[topic]
+        return body
 
     @staticmethod
     def auto_register(server_url: str, key: str = 'auto-register/test7246', ttl: int = 7200, stat: bool = True) -> 'HTTPMQClient':
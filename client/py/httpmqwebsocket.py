@@ -0,0 +1,158 @@
+import json
+import queue
+import socket
+import struct
+import threading
+import websocket
+
+# Mirror of httpmq/frames.py, the client does not import the server package.
+HEADER = struct.Struct('<IBI')
+LENGTH = struct.Struct('<H')
+PUBLISH = struct.Struct('<qB')
+SEQ = struct.Struct('<Q')
+MESSAGE = struct.Struct('<QqqB')
+PUBLISHED = struct.Struct('<Qq')
+COUNT = struct.Struct('<I')
+
+OP_PUBLISH = 1
+OP_SUBSCRIBE = 2
+OP_UNSUBSCRIBE = 3
+OP_ACK = 4
+OP_ACK_UP_TO = 5
+OP_OK = 16
+OP_ERROR = 17
+OP_MESSAGE = 18
+OP_SESSION = 19
+
+DATA_STR = 0
+DATA_JSON = 1
+
+def encode_frame(opcode: int, request_id: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(len(payload), opcode, request_id) + payload
+
+def pack_str(value: str) -> bytes:
+    encoded = value.encode()
+    return LENGTH.pack(len(encoded)) + encoded
+
+def unpack_str(payload: bytes, offset: int) -> tuple:
+    (length,) = LENGTH.unpack_from(payload, offset)
+    offset += LENGTH.size
+    return payload[offset:offset + length].decode(), offset + length
+
+class HTTPMQWebSocketError(Exception):
+    pass
+
+class HTTPMQWebSocketClient:
+    def __init__(self, server_url, session_id = None, timeout = 30):
+        url = server_url.replace('http://', 'ws://').replace('https://', 'wss://') + '/api/ws'
+        if session_id:
+            url += f'?session_id={session_id}'
+        self.timeout = timeout
+        # small frames, Nagle would hold them back for the peer's delayed ack
+        self.ws = websocket.create_connection(url, timeout=timeout,
+                                              sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),))
+        self.ws.settimeout(None)
+        self.messages = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {} # request id -> [event, opcode, payload]
+        self.next_request_id = 1
+        self.closed = False
+        self.session_id = self._read_session()
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+
+    def close(self):
+        self.closed = True
+        self.ws.close()
+
+    def publish(self, topic: str, ttl: int, data) -> dict:
+        if isinstance(data, str):
+            kind, encoded = DATA_STR, data.encode()
+        else:
+            kind, encoded = DATA_JSON, json.dumps(data, separators=(',', ':')).encode()
+        payload = self._request(OP_PUBLISH, PUBLISH.pack(ttl, kind) + pack_str(topic) + encoded)
+        seq, timestamp = PUBLISHED.unpack(payload)
+        return {'topic': topic, 'seq': seq, 'timestamp': timestamp}
+
+    def subscribe(self, topic: str, group: str = None, visibility_timeout: int = 0):
+        payload = pack_str(topic)
+        if group:
+            payload += pack_str(group) + COUNT.pack(visibility_timeout)
+        self._request(OP_SUBSCRIBE, payload)
+
+    def unsubscribe(self, topic: str):
+        self._request(OP_UNSUBSCRIBE, pack_str(topic))
+
+    def acknowledge(self, topic: str, seq: int):
+        self._request(OP_ACK, SEQ.pack(seq) + pack_str(topic))
+
+    def acknowledge_up_to(self, topic: str, seq: int) -> int:
+        (count,) = COUNT.unpack(self._request(OP_ACK_UP_TO, SEQ.pack(seq) + pack_str(topic)))
+        return count
+
+    def receive(self, timeout = None) -> dict:
+        # the next pushed message, oldest first, or None on timeout
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _request(self, opcode: int, payload: bytes) -> bytes:
+        entry = [threading.Event(), None, None]
+        with self.lock:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.pending[request_id] = entry
+            self.ws.send_binary(encode_frame(opcode, request_id, payload))
+        if not entry[0].wait(self.timeout):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise HTTPMQWebSocketError('request timed out')
+        if entry[1] == OP_ERROR:
+            raise HTTPMQWebSocketError(entry[2].decode())
+        return entry[2]
+
+    def _read_session(self) -> str:
+        for opcode, _, payload in self._frames(self.ws.recv()):
+            if opcode == OP_SESSION:
+                return payload.decode()
+        raise HTTPMQWebSocketError('server did not send a session')
+
+    def _read_loop(self):
+        while not self.closed:
+            try:
+                data = self.ws.recv()
+            except (websocket.WebSocketException, OSError):
+                break
+            for opcode, request_id, payload in self._frames(data):
+                if opcode == OP_MESSAGE:
+                    self.messages.put(self._message(payload))
+                    continue
+                with self.lock:
+                    entry = self.pending.pop(request_id, None)
+                if entry:
+                    entry[1], entry[2] = opcode, payload
+                    entry[0].set()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for entry in pending.values():
+            entry[1], entry[2] = OP_ERROR, b'connection closed'
+            entry[0].set()
+
+    def _frames(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        offset = 0
+        while offset < len(data):
+            length, opcode, request_id = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            yield opcode, request_id, data[offset:offset + length]
+            offset += length
+
+    def _message(self, payload: bytes) -> dict:
+        seq, timestamp, ttl, kind = MESSAGE.unpack_from(payload)
+        topic, offset = unpack_str(payload, MESSAGE.size)
+        data = payload[offset:].decode()
+        if kind == DATA_JSON:
+            data = json.loads(data)
+        return {'topic': topic, 'seq': seq, 'timestamp': timestamp, 'ttl': ttl, 'data': data}
@@ -1,4 +1,3 @@
-import time
 import platform
 from httpmqclient import HTTPMQClient
 
@@ -12,10 +11,9 @@ if __name__ == '__main__':
         client.publish(topic, 60, 'Hello!')
     try:
         while True:
-            response = client.receive()
+            response = client.receive(timeout=10)
             message_len = len(response['messages'])
             if message_len == 0:
-                time.sleep(0.5)
                 continue
             print(f'Received {len(response["messages"])} messages')
             for message in response['messages']:
@@ -0,0 +1,335 @@
+# ASGI engine: the /api routes of server.py on top of AsyncMessageQueue. A waiting consumer costs a
+# coroutine instead of a thread, so one process can hold tens of thousands of long-polls and streams.
+# Serve it with any ASGI server, e.g. uvicorn httpmq.asgi:app, or python -m httpmq.asgi
+from urllib.parse import parse_qs
+from uuid import uuid4
+import asyncio
+import json
+import os
+import re
+import time
+from . import encoder, frames, handlers, pagination
+from .async_message_queue import AsyncMessageQueue
+from .config import SERVER_SETTINGS, topic_retention
+from .message_queue import MessageQueue, QueueFull, TopicFull
+from .metrics import Registry
+from .tracing import Tracer
+from .storage import SegmentLog
+
+storage = None
+if SERVER_SETTINGS['DATA_DIR']:
+    storage = SegmentLog(SERVER_SETTINGS['DATA_DIR'], SERVER_SETTINGS['SEGMENT_BYTES'])
+queue = MessageQueue(storage, topic_retention(), SERVER_SETTINGS['MEMORY_BUDGET'], SERVER_SETTINGS['LOCK_METRICS'])
+queue.start_reaper()
+mq = AsyncMessageQueue(queue)
+tracer = Tracer(SERVER_SETTINGS['SLOW_OP_SECONDS'], SERVER_SETTINGS['TRACE_PROFILE_RATE'])
+if SERVER_SETTINGS['TRACING']:
+    tracer.attach(queue, queue.TRACED_METHODS, queue.TRACED_LOCKS, queue.TRACED_LOCK_OWNERS, queue.TRACED_LOCK_FACTORY)
+
+http_metrics = Registry()
+request_seconds = http_metrics.histogram('httpmq_http_request_duration_seconds', 'Time to produce a response',
+                                         ('endpoint', 'method'))
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+class Request:
+    __slots__ = ('method', 'path', 'args', 'headers', 'body', '_json')
+
+    def __init__(self, scope: dict, body: bytes = b''):
+        self.method = scope.get('method', 'GET')
+        self.path = scope['path']
+        self.args = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.headers = {key.decode().lower(): value.decode() for key, value in scope.get('headers', [])}
+        self.body = body
+        self._json = None
+
+    @property
+    def json(self) -> dict:
+        # like Flask, a missing or malformed body is a bad request
+        if self._json is None:
+            self._json = json.loads(self.body)
+            if not isinstance(self._json, dict):
+                raise ValueError('expected a JSON object')
+        return self._json
+
+    def session_id(self) -> str:
+        return self.headers.get('session-id') or self.args.get('session_id')
+
+class Response:
+    __slots__ = ('status', 'body', 'content_type', 'headers', 'stream')
+
+    def __init__(self, status: int = 200, body: bytes = b'', content_type: str = 'application/json',
+                 headers: dict = None, stream = None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.stream = stream # async iterator of str chunks, sent as they are produced
+
+def jsonify(payload: dict, status: int = 200) -> Response:
+    return Response(status, encoder.dumps(payload))
+
+def send_file(path: str) -> Response:
+    with open(path, 'rb') as file:
+        return Response(200, file.read(), 'text/html; charset=utf-8')
+
+routes: list[tuple[str, re.Pattern, any]] = []
+
+def route(path: str, methods: list[str] = ('GET',)):
+    # <path:name> captures the rest of the path, like the Flask converter
+    pattern = re.compile('^' + re.sub(r'<path:(\w+)>', r'(?P<\1>.+)', path) + '$')
+    def decorator(handler):
+        for method in methods:
+            routes.append((method, pattern, handler))
+        return handler
+    return decorator
+
+def validate_admin(request: Request) -> bool:
+    key = SERVER_SETTINGS['AUTH_KEY']
+    return key in (request.args.get('key'), request.headers.get('authorization'), request.headers.get('auth-key'))
+
+async def reply(handler, *args) -> Response:
+    # the shared handlers may wait for a lock or the log, AsyncMessageQueue.call keeps that off the loop
+    status, payload = await mq.call(handler, *args)
+    return jsonify(payload, status)
+
+@route('/api/register', methods=['POST'])
+async def register(request: Request) -> Response:
+    return await reply(handlers.register, queue)
+
+@route('/api/publish/<path:topic>', methods=['POST'])
+async def publish(request: Request, topic: str) -> Response:
+    return await reply(handlers.publish, queue, topic, request.json)
+
+@route('/api/publish', methods=['POST'])
+async def publish_many(request: Request) -> Response:
+    return await reply(handlers.publish_many, queue, request.json)
+
+@route('/api/subscribe')
+async def get_subscribe(request: Request) -> Response:
+    return await reply(handlers.get_subscriptions, queue, request.session_id())
+
+@route('/api/subscribe/<path:topic>', methods=['POST'])
+async def subscribe(request: Request, topic: str) -> Response:
+    try:
+        data = request.json
+    except ValueError:
+        data = {}
+    session_id = request.headers.get('session-id') or data.get('session_id')
+    return await reply(handlers.subscribe, queue, topic, session_id, data)
+
+@route('/api/subscribe/<path:topic>', methods=['DELETE'])
+async def unsubscribe(request: Request, topic: str) -> Response:
+    return await reply(handlers.unsubscribe, queue, topic, request.json)
+
+@route('/api/receive')
+async def receive(request: Request) -> Response:
+    session_id = request.session_id()
+    try:
+        timeout, after, max_messages, max_bytes = handlers.receive_query(request.args)
+    except ValueError as error:
+        return jsonify({'error': str(error)}, 400)
+    if session_id in queue.sessions:
+        messages = await mq.receive(session_id, timeout, after, max_messages, max_bytes, encode=True)
+        return Response(200, handlers.receive_body(after, messages))
+    return jsonify({'error': 'session not found'}, 404)
+
+@route('/api/stream')
+async def stream(request: Request) -> Response:
+    session_id = request.session_id()
+    if session_id not in queue.sessions:
+        return jsonify({'error': 'session not found'}, 404)
+    headers = {'cache-control': 'no-cache', 'x-accel-buffering': 'no'}
+    return Response(200, content_type='text/event-stream', headers=headers,
+                    stream=stream_messages(session_id, handlers.auto_ack(request.args)))
+
+async def stream_messages(session_id: str, auto_ack: bool):
+    # same events as server.stream_messages
+    delivered: dict[str, int] = {}
+    yield ': connected\n\n'
+    while session_id in queue.sessions:
+        messages = await mq.receive(session_id, SERVER_SETTINGS['STREAM_KEEPALIVE'], delivered,
+                                    SERVER_SETTINGS['MAX_RECEIVE_MESSAGES'], SERVER_SETTINGS['MAX_RECEIVE_BYTES'],
+                                    encode=True)
+        if not messages:
+            yield ': keep-alive\n\n'
+            continue
+        batch = handlers.last_seqs(messages)
+        delivered.update(batch)
+        yield handlers.stream_events(messages)
+        if auto_ack:
+            for topic, seq in batch.items():
+                await mq.acknowledge_up_to(session_id, topic, seq)
+
+@route('/api/acknowledge', methods=['POST'])
+async def acknowledge(request: Request) -> Response:
+    return await reply(handlers.acknowledge, queue, request.json)
+
+@route('/api/admin/topics')
+async def admin_topics(request: Request) -> Response:
+    if not validate_admin(request):
+        return jsonify({'error': 'Unauthorized'}, 401)
+    return await reply(handlers.admin_topics, queue)
+
+@route('/api/admin/lag')
+async def admin_lag(request: Request) -> Response:
+    if not validate_admin(request):
+        return jsonify({'error': 'Unauthorized'}, 401)
+    return await reply(handlers.admin_lag, queue, request.args)
+
+@route('/api/admin/trace', methods=['GET', 'POST'])
+async def admin_trace(request: Request) -> Response:
+    if not validate_admin(request):
+        return jsonify({'error': 'Unauthorized'}, 401)
+    return await reply(handlers.admin_trace, queue, tracer, request.json if request.method == 'POST' else None)
+
+@route('/metrics')
+async def metrics(request: Request) -> Response:
+    if not validate_admin(request):
+        return jsonify({'error': 'Unauthorized'}, 401)
+    return Response(200, (queue.metrics.render() + http_metrics.render()).encode(), 'text/plain; version=0.0.4')
+
+@route('/api/admin/messages/<path:topic>')
+async def admin_messages(request: Request, topic: str) -> Response:
+    if not validate_admin(request):
+        return jsonify({'error': 'Unauthorized'}, 401)
+    try:
+        query = pagination.admin_query(request.args, topic)
+    except ValueError as error:
+        return jsonify({'error': str(error)}, 400)
+    return Response(200, content_type='application/x-ndjson', stream=admin_lines(topic, query))
+
+async def admin_lines(topic: str, query: dict):
+    # every page is taken in a worker thread, so waiting for the topic lock does not stall the loop
+    lines = pagination.admin_lines(queue.get_messages, topic, **query)
+    while (chunk := await asyncio.to_thread(next, lines, None)) is not None:
+        yield chunk
+
+@route('/')
+async def index(request: Request) -> Response:
+    return send_file(os.path.join(TEMPLATE_DIR, 'index.html'))
+
+@route('/admin')
+async def admin(request: Request) -> Response:
+    return send_file(os.path.join(STATIC_DIR, 'admin.html'))
+
+@route('/tool')
+async def tool(request: Request) -> Response:
+    return send_file(os.path.join(STATIC_DIR, 'tool.html'))
+
+async def app(scope: dict, receive, send):
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'websocket':
+        await handle_websocket(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                queue.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+async def handle_http(scope: dict, receive, send):
+    chunks = []
+    while True:
+        event = await receive()
+        if event['type'] == 'http.disconnect':
+            return
+        chunks.append(event.get('body', b''))
+        if not event.get('more_body'):
+            break
+    request = Request(scope, b''.join(chunks))
+    start = time.perf_counter()
+    response = None
+    endpoint = 'unmatched'
+    allowed = False
+    for method, pattern, handler in routes:
+        # the ASGI server already percent-decoded the path
+        match = pattern.match(request.path)
+        if match:
+            allowed = True
+            if method == request.method:
+                endpoint = handler.__name__
+                # long-polls and streams mostly wait, the queue calls they make are traced on their own
+                trace = tracer.enabled and not request.args.get('timeout') and endpoint != 'stream'
+                try:
+                    if trace:
+                        with tracer.span(f'http {endpoint}', profile=False) as span:
+                            response = await handler(request, **match.groupdict())
+                            span.bytes += len(response.body) if response.stream is None else 0
+                    else:
+                        response = await handler(request, **match.groupdict())
+                except ValueError:
+                    response = jsonify({'error': 'bad request'}, 400)
+                except QueueFull as error:
+                    response = jsonify({'error': error.reason}, 429 if isinstance(error, TopicFull) else 503)
+                    response.headers['retry-after'] = str(error.retry_after)
+                break
+    if response is None:
+        response = jsonify({'error': 'method not allowed'}, 405) if allowed else jsonify({'error': 'not found'}, 404)
+    # streams are timed until their response starts, long-polls include the wait
+    request_seconds.observe(time.perf_counter() - start, (endpoint, request.method))
+    headers = [(b'content-type', response.content_type.encode())]
+    headers += [(key.encode(), value.encode()) for key, value in response.headers.items()]
+    if response.stream is None:
+        headers.append((b'content-length', str(len(response.body)).encode()))
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.body})
+        return
+    await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+    # stop producing as soon as the client goes away instead of at the next keep-alive
+    producer = asyncio.create_task(send_stream(response.stream, send))
+    disconnect = asyncio.create_task(wait_disconnect(receive))
+    await asyncio.wait((producer, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    producer.cancel()
+    disconnect.cancel()
+
+async def send_stream(stream, send):
+    async for chunk in stream:
+        await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def handle_websocket(scope: dict, receive, send):
+    # the binary frame protocol of server.py's /api/ws
+    request = Request(scope)
+    if request.path != '/api/ws' or (await receive())['type'] != 'websocket.connect':
+        await send({'type': 'websocket.close'})
+        return
+    session_id = request.session_id()
+    if session_id not in queue.sessions:
+        session_id = await mq.register(str(uuid4()))
+    await send({'type': 'websocket.accept'})
+    await send({'type': 'websocket.send', 'bytes': frames.encode_frame(frames.OP_SESSION, 0, session_id.encode())})
+    pusher = asyncio.create_task(push_frames(session_id, send))
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                return
+            data = event.get('bytes') or event.get('text', '').encode()
+            replies = await mq.call(handlers.handle_frames, queue, session_id, data)
+            await send({'type': 'websocket.send', 'bytes': replies})
+    finally:
+        pusher.cancel()
+
+async def push_frames(session_id: str, send):
+    delivered: dict[str, int] = {}
+    while session_id in queue.sessions:
+        messages = await mq.receive(session_id, SERVER_SETTINGS['MAX_RECEIVE_TIMEOUT'], delivered,
+                                    SERVER_SETTINGS['MAX_RECEIVE_MESSAGES'], SERVER_SETTINGS['MAX_RECEIVE_BYTES'])
+        if not messages:
+            continue
+        delivered.update(handlers.last_seqs(messages))
+        await send({'type': 'websocket.send', 'bytes': handlers.message_frames(messages)})
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=5000)
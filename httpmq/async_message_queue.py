@@ -0,0 +1,114 @@
+from .message_queue import MessageQueue
+from .models import Message, Session
+import asyncio
+
+class AsyncWakeup:
+    # stands in for the session's threading.Event, a publish from any thread wakes the loop
+    __slots__ = ('loop', 'event')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+class AsyncMessageQueue:
+    # asyncio front end for a MessageQueue. Waiting consumers park on the event loop instead of a thread,
+    # calls that may wait for the log to be flushed run in the default executor.
+
+    def __init__(self, mq: MessageQueue):
+        self.mq = mq
+
+    async def register(self, session_id: str) -> str:
+        return await self.call(self.mq.register, session_id)
+
+    async def publish(self, topic: str, data: any, ttl: int = 3600) -> Message:
+        return (await self.publish_many([(topic, data, ttl)]))[0]
+
+    async def publish_many(self, messages: list[tuple[str, any, int]]) -> list[Message]:
+        return await self.call(self.mq.publish_many, messages)
+
+    async def subscribe(self, session_id: str, topic: str, group: str = None, visibility_timeout: int = None) -> bool:
+        return await self.call(self.mq.subscribe, session_id, topic, group, visibility_timeout)
+
+    async def unsubscribe(self, session_id: str, topic: str) -> bool:
+        return await self.call(self.mq.unsubscribe, session_id, topic)
+
+    def get_subscriptions(self, session_id: str) -> list[str]:
+        return self.mq.get_subscriptions(session_id)
+
+    async def acknowledge(self, session_id: str, topic_name: str, message_id: str) -> bool:
+        return (await self.acknowledge_many(session_id, [(topic_name, message_id)]))[0]
+
+    async def acknowledge_many(self, session_id: str, acknowledgements: list[tuple[str, str]]) -> list[bool]:
+        return await self.call(self.mq.acknowledge_many, session_id, acknowledgements)
+
+    async def acknowledge_up_to(self, session_id: str, topic_name: str, seq: int) -> int:
+        return await self.call(self.mq.acknowledge_up_to, session_id, topic_name, seq)
+
+    async def receive(self, session_id: str, timeout: float = 0, after: dict[str, int] = None, max_messages: int = None,
+                      max_bytes: int = None, encode: bool = False) -> list[Message]:
+        mq = self.mq
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            session = mq._session(session_id)
+            if not session:
+                return []
+            # the session and topic locks may be held by a slow call, so the loop never waits for them itself
+            wakeup, topics, messages = await asyncio.to_thread(self._poll, session, loop, timeout > 0, after,
+                                                               max_messages, max_bytes, encode)
+            remaining = deadline - loop.time()
+            if messages or remaining <= 0:
+                if topics:
+                    await asyncio.to_thread(mq._discard_waiter, session, topics)
+                return messages
+            try:
+                await wakeup.wait(remaining)
+            finally:
+                await asyncio.to_thread(mq._discard_waiter, session, topics)
+
+    def get_messages(self, topic: str, after: int = None, max_messages: int = None, start: float = None,
+                     end: float = None, acknowledged: bool = None) -> tuple[list[dict], int]:
+        return self.mq.get_messages(topic, after, max_messages, start, end, acknowledged)
+
+    def get_topics(self) -> list[str]:
+        return self.mq.get_topics()
+
+    def get_lag(self, topic: str = None) -> list[dict]:
+        return self.mq.get_lag(topic)
+
+    async def call(self, function, *args):
+        # runs a blocking call on the queue, asgi runs the shared request handlers through it too.
+        # Without a log nothing blocks for longer than a lock hold.
+        if self.mq.storage:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    def _poll(self, session: Session, loop: asyncio.AbstractEventLoop, wait: bool, after: dict[str, int],
+              max_messages: int, max_bytes: int, encode: bool) -> tuple[AsyncWakeup, list, list[Message]]:
+        # runs in a worker thread
+        wakeup = None
+        if wait:
+            with session.lock:
+                if not isinstance(session.wakeup, AsyncWakeup) or session.wakeup.loop is not loop:
+                    session.wakeup = AsyncWakeup(loop)
+                wakeup = session.wakeup
+        return wakeup, *self.mq._poll(session, wait, after, max_messages, max_bytes, encode)
@@ -1,6 +1,41 @@
 # Configuration for Message Queue Server
+from .models import Retention
+
 SERVER_SETTINGS = {
     'AUTH_KEY': 'YourSecretAuthKey',
     'DEFAULT_TTL': 120,
     'NEVER_EXPIRE_TTL': 86400 * 365 * 100,
+    'MAX_RECEIVE_TIMEOUT': 60,
+    'MAX_RECEIVE_MESSAGES': 1000, # per /api/receive page and per pushed batch
+    'MAX_RECEIVE_BYTES': 4 * 1024 * 1024, # approximate data size of a page
+    'STREAM_KEEPALIVE': 15,
+    'ADMIN_PAGE_SIZE': 500, # messages per page the admin listing takes from the queue while streaming
+    'TRACING': False, # spans around queue calls and requests, can also be switched at /api/admin/trace
+    'SLOW_OP_SECONDS': 0.1, # traced calls slower than this go to the httpmq.slow log
+    'TRACE_PROFILE_RATE': 0, # fraction of traced requests run under cProfile, their profile is logged when slow
+    'LOCK_METRICS': False, # also time the per-topic and per-session locks, costs around 15% on single-message traffic
+    'MEMORY_BUDGET': 1024 * 1024 * 1024, # bytes the retained messages may take, data and bookkeeping, beyond it publish gets a 503
+    # topic prefix -> Retention arguments (max_messages, max_bytes, max_age, overflow, drop_unsubscribed,
+    # reclaim_acked), the longest prefix wins,
+    # e.g. {'': {'max_age': 86400}, 'logs/': {'max_messages': 10000, 'overflow': 'drop_oldest'}, 'jobs/': {'reclaim_acked': True}}
+    'TOPIC_RETENTION': {},
+    'DATA_DIR': None, # directory for the write-ahead log, None keeps everything in memory
+    'SEGMENT_BYTES': 64 * 1024 * 1024,
+    'PARTITIONS': 0, # worker processes started by python -m httpmq.partition, 0 keeps the queue in the server process
+    'PARTITION_DIR': '/tmp/httpmq', # unix sockets of the partition workers
 }
+
+def topic_retention() -> dict[str, Retention]:
+    return {prefix: Retention(**limits) for prefix, limits in SERVER_SETTINGS['TOPIC_RETENTION'].items()}
+
+def parse_ttl(payload: dict) -> int:
+    ttl = SERVER_SETTINGS['DEFAULT_TTL']
+    if 'ttl' in payload:
+        ttl_req = payload.get('ttl')
+        if isinstance(ttl_req, int):
+            ttl = ttl_req
+        if isinstance(ttl_req, str) and ttl_req.lstrip('-').isdigit():
+            ttl = int(ttl_req)
+        if ttl < 0:
+            ttl = SERVER_SETTINGS['NEVER_EXPIRE_TTL']
+    return ttl
@@ -0,0 +1,27 @@
+# JSON for the response bodies. orjson is used when it is installed, the standard library otherwise.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json.dumps builds a new encoder for every call with non-default separators
+COMPACT = json.JSONEncoder(separators=(',', ':'))
+
+def dumps(value: any) -> bytes:
+    if orjson:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # integers beyond 64 bits and the like, which the standard library still handles
+            pass
+    return COMPACT.encode(value).encode()
+
+def messages_response(messages: list, **fields) -> bytes:
+    # {"messages": [...], **fields} with every message spliced in from its cached encoding
+    body = [b'{"messages":[', b','.join(message.to_json() for message in messages), b']']
+    for name, value in fields.items():
+        body += [b',', dumps(name), b':', dumps(value)]
+    body.append(b'}')
+    return b''.join(body)
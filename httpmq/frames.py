@@ -0,0 +1,76 @@
+from .storage import encode_data, decode_data
+import struct
+
+# WebSocket frame protocol. A binary WebSocket message carries one or more frames:
+#   header: payload length, opcode, request id (echoed in the reply, 0 for pushed messages)
+#   payload: fixed-size fields first, then length-prefixed strings, then raw data
+# Data is tagged with the same kind byte as the storage log: 0 for a utf-8 string, 1 for JSON.
+HEADER = struct.Struct('<IBI')
+LENGTH = struct.Struct('<H')
+PUBLISH = struct.Struct('<qB') # ttl, data kind
+SEQ = struct.Struct('<Q')
+MESSAGE = struct.Struct('<QqqB') # seq, timestamp, ttl, data kind
+PUBLISHED = struct.Struct('<Qq') # seq, timestamp
+COUNT = struct.Struct('<I')
+
+# client -> server
+OP_PUBLISH = 1
+OP_SUBSCRIBE = 2
+OP_UNSUBSCRIBE = 3
+OP_ACK = 4
+OP_ACK_UP_TO = 5
+# server -> client
+OP_OK = 16
+OP_ERROR = 17
+OP_MESSAGE = 18
+OP_SESSION = 19
+
+def encode_frame(opcode: int, request_id: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(len(payload), opcode, request_id) + payload
+
+def decode_frames(buffer: bytes) -> list[tuple[int, int, bytes]]:
+    frames = []
+    offset = 0
+    while offset < len(buffer):
+        length, opcode, request_id = HEADER.unpack_from(buffer, offset)
+        offset += HEADER.size
+        if offset + length > len(buffer):
+            raise ValueError('truncated frame')
+        frames.append((opcode, request_id, buffer[offset:offset + length]))
+        offset += length
+    return frames
+
+def pack_str(value: str) -> bytes:
+    encoded = value.encode()
+    return LENGTH.pack(len(encoded)) + encoded
+
+def unpack_str(payload: bytes, offset: int) -> tuple[str, int]:
+    (length,) = LENGTH.unpack_from(payload, offset)
+    offset += LENGTH.size
+    return payload[offset:offset + length].decode(), offset + length
+
+def decode_publish(payload: bytes) -> tuple[str, int, any]:
+    ttl, kind = PUBLISH.unpack_from(payload)
+    topic, offset = unpack_str(payload, PUBLISH.size)
+    return topic, ttl, decode_data(kind, payload[offset:])
+
+def decode_ack(payload: bytes) -> tuple[str, int]:
+    (seq,) = SEQ.unpack_from(payload)
+    topic, _ = unpack_str(payload, SEQ.size)
+    return topic, seq
+
+def decode_topic(payload: bytes) -> str:
+    return unpack_str(payload, 0)[0]
+
+def decode_subscribe(payload: bytes) -> tuple[str, str, int]:
+    # topic, then optionally a consumer group and its visibility timeout
+    topic, offset = unpack_str(payload, 0)
+    if offset == len(payload):
+        return topic, None, None
+    group, offset = unpack_str(payload, offset)
+    (visibility_timeout,) = COUNT.unpack_from(payload, offset)
+    return topic, group, visibility_timeout or None
+
+def encode_message(topic: str, seq: int, timestamp: int, ttl: int, data: any) -> bytes:
+    kind, encoded = encode_data(data)
+    return encode_frame(OP_MESSAGE, 0, MESSAGE.pack(seq, timestamp, ttl, kind) + pack_str(topic) + encoded)
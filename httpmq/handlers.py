@@ -0,0 +1,212 @@
+# Request handling shared by server.py (Flask, threads) and asgi.py (asyncio). A handler takes the queue and
+# the parsed path, query args or JSON body and returns (status, payload), the front ends only parse requests,
+# wait for messages and write responses. Handlers may block on a lock or a log flush, asgi runs them
+# through AsyncMessageQueue.call.
+from uuid import uuid4
+import struct
+from . import encoder, frames, pagination
+from .config import SERVER_SETTINGS, parse_ttl
+from .message_queue import QueueFull
+from .models import Message
+from .topics import is_filter
+
+BAD_REQUEST = 400, {'error': 'bad request'}
+
+def valid_topic(topic: str, wildcards: bool = False) -> bool:
+    # + and # levels are only allowed in subscriptions
+    if not isinstance(topic, str) or not topic:
+        return False
+    try:
+        wildcard = is_filter(topic)
+    except ValueError:
+        # a # before the last level
+        return False
+    return wildcards or not wildcard
+
+def valid_ack(topic: str, message_id) -> bool:
+    # message ids are strings, acknowledging by sequence number takes an int
+    return isinstance(topic, str) and isinstance(message_id, (str, int)) and not isinstance(message_id, bool)
+
+def register(mq) -> tuple[int, dict]:
+    return 200, {'session_id': mq.register(str(uuid4()))}
+
+def publish(mq, topic: str, body: dict) -> tuple[int, dict]:
+    if not valid_topic(topic):
+        return BAD_REQUEST
+    message = mq.publish(topic, body.get('data'), parse_ttl(body))
+    return 200, {'status': 'success', 'message_id': message.message_id, 'timestamp': message.timestamp}
+
+def publish_many(mq, body: dict) -> tuple[int, dict]:
+    items = body.get('messages')
+    if not isinstance(items, list):
+        return BAD_REQUEST
+    batch = []
+    for item in items:
+        if not isinstance(item, dict) or not valid_topic(item.get('topic')):
+            return BAD_REQUEST
+        batch.append((item.get('topic'), item.get('data'), parse_ttl(item)))
+    messages = mq.publish_many(batch)
+    return 200, {'status': 'success', 'messages': [{
+        'message_id': message.message_id,
+        'topic': message.topic,
+        'seq': message.seq,
+        'timestamp': message.timestamp,
+    } for message in messages]}
+
+def get_subscriptions(mq, session_id: str) -> tuple[int, dict]:
+    topics = mq.get_subscriptions(session_id)
+    if topics is None:
+        return 400, {'error': 'session_id not found'}
+    return 200, {'topics': topics}
+
+def subscribe(mq, topic: str, session_id: str, body: dict) -> tuple[int, dict]:
+    # joining a consumer group shares the topic with the other members instead of receiving every message
+    group = body.get('group')
+    visibility_timeout = body.get('visibility_timeout')
+    if (group is not None and not isinstance(group, str)) or \
+            (visibility_timeout is not None and (not isinstance(visibility_timeout, int) or visibility_timeout <= 0)):
+        return BAD_REQUEST
+    # a topic filter subscribes every matching topic, now and later, but cannot be shared by a group
+    if not valid_topic(topic, wildcards=not group):
+        return BAD_REQUEST
+    if session_id not in mq.sessions:
+        return 400, {'error': 'session_id not found'}
+    if mq.subscribe(session_id, topic, group, visibility_timeout):
+        return 200, {'status': 'subscribed'}
+    return 404, {'error': 'topic not found'}
+
+def unsubscribe(mq, topic: str, body: dict) -> tuple[int, dict]:
+    if not valid_topic(topic, wildcards=True):
+        return BAD_REQUEST
+    if mq.unsubscribe(body.get('session_id'), topic):
+        return 200, {'status': 'success'}
+    return 404, {'error': 'topic or subscription not found'}
+
+def receive_query(args: dict) -> tuple[float, dict[str, int], int, int]:
+    # timeout, after, max_messages and max_bytes of a receive, raises ValueError with the reason
+    try:
+        timeout = float(args.get('timeout', 0))
+    except ValueError:
+        timeout = 0
+    timeout = max(0, min(timeout, SERVER_SETTINGS['MAX_RECEIVE_TIMEOUT']))
+    max_messages, max_bytes = pagination.receive_limits(args)
+    after = pagination.decode_token(args['cursor']) if 'cursor' in args else None
+    return timeout, after, max_messages, max_bytes
+
+def receive_body(after: dict[str, int], messages: list[Message]) -> bytes:
+    return encoder.messages_response(messages, next=pagination.encode_token(pagination.advance(after, messages)))
+
+def auto_ack(args: dict) -> bool:
+    return args.get('auto_ack', '').lower() in ('1', 'true', 'yes')
+
+def last_seqs(messages: list[Message]) -> dict[str, int]:
+    # topic -> last seq among messages, what a stream or a websocket has delivered
+    seqs: dict[str, int] = {}
+    for message in messages:
+        seqs[message.topic] = max(seqs.get(message.topic, -1), message.seq)
+    return seqs
+
+def stream_events(messages: list[Message]) -> str:
+    # Server-Sent Events, oldest message first
+    return ''.join(f'event: message\ndata: {message.to_json().decode()}\n\n' for message in messages)
+
+def message_frames(messages: list[Message]) -> bytes:
+    return b''.join(frames.encode_message(message.topic, message.seq, message.timestamp, message.ttl, message.data)
+                    for message in messages)
+
+def acknowledge(mq, body: dict) -> tuple[int, dict]:
+    session_id = body.get('session_id')
+    topic_name = body.get('topic')
+    message_id = body.get('message_id')
+    if not session_id:
+        return BAD_REQUEST
+    if 'messages' in body:
+        acknowledgements = body.get('messages')
+        if not isinstance(acknowledgements, list):
+            return BAD_REQUEST
+        pairs = []
+        for item in acknowledgements:
+            if not isinstance(item, dict):
+                pairs.append((None, None))
+            elif not valid_ack(item.get('topic'), item.get('message_id')):
+                return BAD_REQUEST
+            else:
+                pairs.append((item.get('topic'), item.get('message_id')))
+        results = mq.acknowledge_many(session_id, pairs)
+        return 200, {'results': [{
+            'topic': topic,
+            'message_id': message_id,
+            'status': 'success' if acknowledged else 'error',
+        } for (topic, message_id), acknowledged in zip(pairs, results)]}
+    if 'up_to' in body:
+        up_to = body.get('up_to')
+        if not topic_name or not valid_ack(topic_name, up_to) or not isinstance(up_to, int):
+            return BAD_REQUEST
+        return 200, {'status': 'success', 'acknowledged': mq.acknowledge_up_to(session_id, topic_name, up_to)}
+    if not message_id or not topic_name or not valid_ack(topic_name, message_id):
+        return BAD_REQUEST
+    if mq.acknowledge(session_id, topic_name, message_id):
+        return 200, {'status': 'success'}
+    return 404, {'error': 'message invalid or not found'}
+
+def admin_topics(mq) -> tuple[int, dict]:
+    return 200, {'topics': mq.get_topics()}
+
+def admin_lag(mq, args: dict) -> tuple[int, dict]:
+    # unread messages and the age of the oldest one per subscriber and group, ?topic= narrows it to one topic
+    return 200, {'topics': mq.get_lag(args.get('topic'))}
+
+def admin_trace(mq, tracer, body: dict = None) -> tuple[int, dict]:
+    # switches tracing on and off without a restart, and lists the recent slow calls
+    if body is not None:
+        try:
+            tracer.configure(body.get('slow_seconds'), body.get('profile_rate'))
+        except ValueError:
+            return BAD_REQUEST
+        if body.get('enabled') is True:
+            tracer.attach(mq, mq.TRACED_METHODS, mq.TRACED_LOCKS, mq.TRACED_LOCK_OWNERS, mq.TRACED_LOCK_FACTORY)
+        elif body.get('enabled') is False:
+            tracer.detach()
+    return 200, tracer.state()
+
+def handle_frame(mq, session_id: str, opcode: int, request_id: int, payload: bytes) -> bytes:
+    # one request of the binary websocket protocol, returns the reply frame
+    try:
+        if opcode == frames.OP_PUBLISH:
+            topic, ttl, data = frames.decode_publish(payload)
+            if not valid_topic(topic):
+                return frames.encode_frame(frames.OP_ERROR, request_id, b'bad request')
+            message = mq.publish(topic, data, parse_ttl({'ttl': ttl}))
+            return frames.encode_frame(frames.OP_OK, request_id, frames.PUBLISHED.pack(message.seq, message.timestamp))
+        if opcode == frames.OP_SUBSCRIBE:
+            topic, group, visibility_timeout = frames.decode_subscribe(payload)
+            if not valid_topic(topic, wildcards=not group):
+                return frames.encode_frame(frames.OP_ERROR, request_id, b'bad request')
+            if mq.subscribe(session_id, topic, group, visibility_timeout):
+                return frames.encode_frame(frames.OP_OK, request_id)
+            return frames.encode_frame(frames.OP_ERROR, request_id, b'already subscribed')
+        if opcode == frames.OP_UNSUBSCRIBE:
+            if mq.unsubscribe(session_id, frames.decode_topic(payload)):
+                return frames.encode_frame(frames.OP_OK, request_id)
+            return frames.encode_frame(frames.OP_ERROR, request_id, b'subscription not found')
+        if opcode == frames.OP_ACK:
+            topic, seq = frames.decode_ack(payload)
+            if mq.acknowledge_many(session_id, [(topic, seq)])[0]:
+                return frames.encode_frame(frames.OP_OK, request_id)
+            return frames.encode_frame(frames.OP_ERROR, request_id, b'message invalid or not found')
+        if opcode == frames.OP_ACK_UP_TO:
+            topic, seq = frames.decode_ack(payload)
+            count = mq.acknowledge_up_to(session_id, topic, seq)
+            return frames.encode_frame(frames.OP_OK, request_id, frames.COUNT.pack(count))
+        return frames.encode_frame(frames.OP_ERROR, request_id, b'unknown opcode')
+    except QueueFull as error:
+        return frames.encode_frame(frames.OP_ERROR, request_id, error.reason.encode())
+    except (ValueError, struct.error, UnicodeDecodeError):
+        return frames.encode_frame(frames.OP_ERROR, request_id, b'bad request')
+
+def handle_frames(mq, session_id: str, data: bytes) -> bytes:
+    # the replies to every frame of one websocket message
+    try:
+        return b''.join(handle_frame(mq, session_id, *frame) for frame in frames.decode_frames(data))
+    except (ValueError, struct.error):
+        return frames.encode_frame(frames.OP_ERROR, 0, b'bad frame')
@@ -1,103 +1,1144 @@
-from .models import Message, Session
-from collections import defaultdict
+from .metrics import Registry, TimedLock
+from .models import ConsumerGroup, Cursor, Message, Retention, Session, Topic, TopicFilter
+from .pagination import take
+from .snapshot import SnapshotReader, SnapshotWriter, list_snapshots, snapshot_path
+from .storage import SegmentLog, encode_data, encode_json, encode_publish, decode_data, decode_publish, fsync_directory
+from .storage import RECORD_PUBLISH, RECORD_TOPIC, RECORD_REGISTER, RECORD_SUBSCRIBE, RECORD_UNSUBSCRIBE
+from .storage import RECORD_ACK, RECORD_ACK_UP_TO, RECORD_SESSION, RECORD_SESSION_EXPIRED, RECORD_GROUP_ACK, RECORD_TRIM
+from .storage import RECORD_FILTER, RECORD_MATCH
+from .topics import TopicTrie, is_filter
+from .tracing import count_scanned
+from uuid import uuid4
+import json
+import heapq
+import logging
+import os
 import time
 import threading
 
+# Lock order: session.lock -> topic.lock -> expiry_lock.
+# self.lock only guards the sessions and topics dicts, it is never held while taking another lock
+# except the storage lock, the TopicFilter locks and the metric locks, which are leaves and may be taken
+# under any of them.
+# Session.wake() is called without holding any lock.
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    # publishing would go over the memory budget, retry_after is a hint in seconds
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason, retry_after)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TopicFull(QueueFull):
+    # a topic that rejects new messages is at its retention caps
+    pass
+
 class MessageQueue:
     SESSION_TTL = 3600
+    REAPER_INTERVAL = 1
+    REAPER_BATCH_SIZE = 1000
+    SNAPSHOT_INTERVAL = 300
+    VISIBILITY_TIMEOUT = 30 # seconds a consumer group member has to acknowledge a message
+    LEASE_BATCH_SIZE = 10 # messages leased per group topic and receive, leaves the rest to other members
+    MAX_RETRY_AFTER = 60
+    LOCK_SAMPLE_EVERY = 16 # acquisitions of each instrumented lock per timed one
+    ADMIN_SCAN_LIMIT = 10000 # log entries an admin page looks at under the topic lock
+    # memory a retained message takes besides its data and cached encoding: the Message, its log slot,
+    # its expiry entry and the header of the data object, measured with benchmark/message_memory
+    MESSAGE_OVERHEAD = 320
+    # what a Tracer wraps, _poll is the part of receive that works rather than waits. Besides the queue-wide
+    # locks, the locks of the topics and sessions, including those _new_lock makes while tracing is on
+    TRACED_METHODS = ('register', 'publish_many', 'subscribe', 'unsubscribe', 'acknowledge_many', 'acknowledge_up_to',
+                      'get_subscriptions', '_poll', 'get_messages', 'get_topics', 'get_lag', 'expire', 'snapshot')
+    TRACED_LOCKS = ('lock', 'expiry_lock')
+    TRACED_LOCK_OWNERS = ('topics', 'sessions')
+    TRACED_LOCK_FACTORY = '_new_lock'
 
-    def __init__(self):
-        self.lock = threading.Lock()
+    def __init__(self, storage: SegmentLog = None, retention: dict[str, Retention] = None, memory_budget: int = None,
+                 lock_metrics: bool = False):
+        self.metrics = Registry()
+        self.published = self.metrics.counter('httpmq_published_messages_total', 'Messages published')
+        self.delivered = self.metrics.counter('httpmq_delivered_messages_total', 'Messages handed out by receive')
+        self.acknowledged = self.metrics.counter('httpmq_acknowledged_messages_total', 'Messages acknowledged')
+        rejected = self.metrics.counter('httpmq_rejected_messages_total', 'Messages refused at publish', ('reason',))
+        self.rejected_topic_full = rejected.labels('topic_full')
+        self.rejected_memory = rejected.labels('memory_budget')
+        dropped = self.metrics.counter('httpmq_dropped_messages_total', 'Messages removed before their TTL or on it',
+                                       ('reason',))
+        self.dropped_expired = dropped.labels('expired')
+        self.dropped_overflow = dropped.labels('overflow')
+        self.dropped_acknowledged = dropped.labels('acknowledged')
+        self.dropped_unsubscribed = dropped.labels('unsubscribed')
+        self.expired_sessions = self.metrics.counter('httpmq_expired_sessions_total', 'Sessions expired')
+        self.expire_seconds = self.metrics.histogram('httpmq_expire_duration_seconds', 'Duration of an expire() pass')
+        self.reaper_errors = self.metrics.counter('httpmq_reaper_errors_total', 'Reaper passes that failed')
+        # the queue lock, and with lock_metrics the per-topic and per-session locks, labelled by kind rather than
+        # by name. Those sit on every publish, receive and ack, where the timing wrapper costs more than the lock.
+        self.lock_metrics = lock_metrics
+        self.lock_wait = self.metrics.histogram('httpmq_lock_wait_seconds', 'Time spent waiting for a lock, sampled',
+                                                ('lock',))
+        self.lock_hold = self.metrics.histogram('httpmq_lock_hold_seconds', 'Time a lock was held, sampled', ('lock',))
+        self.metrics.collector(self._collect_metrics)
+        self.lock = TimedLock(self.lock_wait, self.lock_hold, 'queue', self.LOCK_SAMPLE_EVERY)
         self.sessions: dict[str, Session] = {} # session_id -> Session
-        self.topic_messages: dict[str, dict[str, Message]] = defaultdict(defaultdict) # topic -> message_id -> Message
+        self.topics: dict[str, Topic] = {} # topic -> Topic
+        self.topic_keys: dict[int, Topic] = {} # topic key -> Topic
+        self.grouped_topics: set[str] = set() # topics with consumer groups, their leases need expiring
+        self.topic_index = TopicTrie() # topic -> Topic, by level
+        self.filters = TopicTrie() # wildcard filter -> TopicFilter
+        self.instance = uuid4().int >> 96 # keeps message ids distinct across restarts
+        self.expiry_lock = threading.Lock()
+        self.message_expiry: list[tuple[int, str, int]] = [] # heap of (expire_ts, topic, seq)
+        self.expiry_stale = 0 # entries in message_expiry for messages trimmed since, guarded by expiry_lock
+        self.trimmed: dict[str, int] = {} # topic -> first seq left by its last trim, guarded by expiry_lock
+        self.session_expiry: list[tuple[int, str]] = [] # heap of (last_active + SESSION_TTL, session_id)
+        self.retention = retention or {} # topic prefix -> Retention
+        self.memory_budget = memory_budget
+        # memory held by the messages: their data, cached encodings and MESSAGE_OVERHEAD each, guarded by expiry_lock
+        self.retained_bytes = 0
+        self.reaper: threading.Thread = None
+        self.reaper_stop = threading.Event()
+        self.storage = storage
+        self.last_snapshot = time.monotonic()
+        if storage:
+            self._replay()
+            storage.start()
+            self.retained_bytes = sum(topic.bytes + topic.count * self.MESSAGE_OVERHEAD for topic in self.topics.values())
+            self._index_subscribers()
+
+    def close(self):
+        self.stop_reaper()
+        if self.storage:
+            self.storage.close()
 
     def register(self, session_id: str) -> str:
+        session = Session(session_id, self._new_lock('session'))
         with self.lock:
-            session = Session(session_id)
             self.sessions[session_id] = session
+            lsn = self._log(encode_json(RECORD_REGISTER, [session_id]), session_id=session_id)
+        with self.expiry_lock:
+            heapq.heappush(self.session_expiry, (session.last_active + self.SESSION_TTL, session_id))
+        self._sync(lsn)
         return session.session_id
 
     def publish(self, topic: str, data: any, ttl: int = 3600) -> Message:
-        with self.lock:
-            message = Message(topic, data, ttl)
-            self.topic_messages[topic][message.message_id] = message
-            return message
+        return self.publish_many([(topic, data, ttl)])[0]
 
-    def subscribe(self, session_id: str, topic: str) -> bool:
-        with self.lock:
-            session = self.sessions.get(session_id)
-            if session:
+    def publish_many(self, messages: list[tuple[str, any, int]]) -> list[Message]:
+        topics: dict[str, Topic] = {}
+        by_topic: dict[str, list[Message]] = {}
+        sizes: dict[str, int] = {}
+        published: list[Message] = []
+        for topic_name, data, ttl in messages:
+            if topic_name not in topics:
+                if is_filter(topic_name):
+                    raise ValueError(f'cannot publish to the filter {topic_name}')
+                topics[topic_name] = self._topic(topic_name)
+                sizes[topic_name] = 0
+            retention = topics[topic_name].retention
+            if retention and retention.max_age is not None:
+                ttl = min(ttl, retention.max_age)
+            message = Message(topics[topic_name], data, ttl)
+            by_topic.setdefault(topic_name, []).append(message)
+            sizes[topic_name] += message.size
+            published.append(message)
+        # refuse the whole batch up front when it can tell, a batch racing another publisher
+        # for the last room in a topic may still be published in part
+        for topic_name, topic in topics.items():
+            if topic.retention and topic.retention.reject:
+                with topic.lock:
+                    if topic.retention.exceeded(topic, len(by_topic[topic_name]), sizes[topic_name]):
+                        self.rejected_topic_full.inc(len(messages))
+                        raise TopicFull(f'topic {topic_name} is full', self._retry_after(topic.oldest()))
+        self._reserve(sum(sizes.values()) + len(published) * self.MESSAGE_OVERHEAD)
+        waiters: set[Session] = set()
+        expiry: list[tuple[int, str, int]] = []
+        freed = 0
+        full: TopicFull = None
+        lsn = 0
+        count = 0
+        for topic_name, topic_messages in by_topic.items():
+            topic = topics[topic_name]
+            retention = topic.retention
+            # encode payloads before taking the lock, only the sequence number is assigned under it
+            encoded = [encode_data(message.data) for message in topic_messages] if self.storage else None
+            with topic.lock:
+                if retention and retention.reject and retention.exceeded(topic, len(topic_messages), sizes[topic_name]):
+                    full = TopicFull(f'topic {topic_name} is full', self._retry_after(topic.oldest()))
+                    freed += sizes[topic_name] + len(topic_messages) * self.MESSAGE_OVERHEAD
+                    self.rejected_topic_full.inc(len(topic_messages))
+                    continue
+                if retention and retention.drop_unsubscribed and not topic.has_audience():
+                    # nobody would ever read them, they only use up their sequence numbers
+                    # without a slot in the log, a long run of them costs one gap entry
+                    for seq, message in enumerate(topic_messages, topic.next_seq):
+                        message.seq = seq
+                    topic.skip(len(topic_messages))
+                    freed += sizes[topic_name] + len(topic_messages) * self.MESSAGE_OVERHEAD
+                    self.dropped_unsubscribed.inc(len(topic_messages))
+                    # the ids handed out must not be reused after a restart, and no publish record carries them
+                    if self.storage:
+                        lsn = self._log(encode_json(RECORD_TOPIC, self._topic_state(topic)), topic_key=topic.key)
+                    continue
+                count += len(topic_messages)
+                for index, message in enumerate(topic_messages):
+                    topic.append(message)
+                    expiry.append((message.expire_ts, topic_name, message.seq))
+                    if encoded:
+                        record = encode_publish(topic.key, message.seq, message.created_ms, message.ttl, encoded[index])
+                        lsn = self._log(record, expire_ts=message.expire_ts, topic_key=topic.key)
+                if retention and not retention.reject and retention.exceeded(topic):
+                    dropped, trim_lsn = self._drop_oldest(topic)
+                    freed += dropped
+                    lsn = trim_lsn or lsn
+                waiters.update(topic.waiters)
+        with self.expiry_lock:
+            for entry in expiry:
+                heapq.heappush(self.message_expiry, entry)
+            self.retained_bytes -= freed
+        self.published.inc(count)
+        count_scanned(len(published), published)
+        self._sync(lsn)
+        for session in waiters:
+            session.wake()
+        if full:
+            raise full
+        return published
+
+    def subscribe(self, session_id: str, topic: str, group: str = None, visibility_timeout: int = None) -> bool:
+        # sessions in the same group share the topic, each message goes to one of them
+        session = self._session(session_id)
+        if session:
+            if is_filter(topic):
+                if group:
+                    raise ValueError('a consumer group needs a topic, not a filter')
+                return self._subscribe_filter(session, topic)
+            lsn = 0
+            with session.lock:
                 session.refresh()
-                return session.subscribe(topic)
-            return False
-        
+                subscribed = session.subscribe(topic, group)
+                if subscribed:
+                    record = [session_id, topic]
+                    topic_obj = self._topic(topic)
+                    with topic_obj.lock:
+                        if group:
+                            consumer_group = self._group(topic_obj, group, visibility_timeout)
+                            record += [group, consumer_group.visibility_timeout]
+                        else:
+                            topic_obj.add_subscriber(session_id, session.cursors[topic])
+                    lsn = self._log(encode_json(RECORD_SUBSCRIBE, record), session_id=session_id)
+            self._sync(lsn)
+            # let a waiting receive pick up the new topic
+            session.wake()
+            return subscribed
+        return False
+
     def unsubscribe(self, session_id: str, topic: str) -> bool:
-        with self.lock:
-            session = self.sessions.get(session_id)
-            if session:
+        session = self._session(session_id)
+        if session:
+            if is_filter(topic):
+                return self._unsubscribe_filter(session, topic)
+            lsn = 0
+            with session.lock:
                 session.refresh()
-                return session.unsubscribe(topic)
-            return False
+                group = session.group(topic)
+                unsubscribed = session.unsubscribe(topic)
+                if unsubscribed:
+                    lsn = self._log(encode_json(RECORD_UNSUBSCRIBE, [session_id, topic]), session_id=session_id)
+                    if not group:
+                        lsn = self._remove_subscriber(session_id, topic) or lsn
+            if group:
+                self._release(session_id, topic, group)
+            self._sync(lsn)
+            return unsubscribed
+        return False
+
+    def get_subscriptions(self, session_id: str) -> list[str]:
+        session = self._session(session_id)
+        if session:
+            with session.lock:
+                return list(session.subscribed_topics) + list(session.filters or ())
+        return None
 
     def acknowledge(self, session_id: str, topic_name: str, message_id: str) -> bool:
-        with self.lock:
-            session = self.sessions.get(session_id)
-            if session:
-                session.refresh()
+        return self.acknowledge_many(session_id, [(topic_name, message_id)])[0]
+
+    def acknowledge_many(self, session_id: str, acknowledgements: list[tuple[str, str]]) -> list[bool]:
+        session = self._session(session_id)
+        if not session:
+            return [False] * len(acknowledgements)
+        lsn = 0
+        with session.lock:
+            session.refresh()
+            results: list[bool] = []
+            for topic_name, message_id in acknowledgements:
+                acknowledged = False
                 if topic_name in session.subscribed_topics:
-                    message = self.topic_messages[topic_name].get(message_id)
-                    if message:
-                        message.clients_acknowledged.add(session_id)
-                        return session.acknowledge(topic_name, message_id)
-            return False
+                    group = session.group(topic_name)
+                    topic = self._topic(topic_name)
+                    with topic.lock:
+                        # the binary protocols acknowledge by sequence number instead of message id
+                        if isinstance(message_id, int):
+                            message = topic.get(message_id)
+                        else:
+                            message = topic.get_by_id(message_id)
+                        if message and group:
+                            consumer_group = self._group(topic, group)
+                            held = consumer_group.cursor.position <= topic.first_seq
+                            acknowledged = consumer_group.acknowledge(session_id, message.seq, time.monotonic())
+                            if acknowledged:
+                                consumer_group.cursor.advance(topic)
+                                record = encode_json(RECORD_GROUP_ACK, [topic_name, group, [message.seq]])
+                                lsn = self._log(record, topic_key=topic.key)
+                                if held:
+                                    lsn = self._reclaim(topic) or lsn
+                        elif message:
+                            cursor = session.cursors[topic_name]
+                            held = cursor.position <= topic.first_seq
+                            acknowledged = session.acknowledge(topic_name, message.seq)
+                            cursor.advance(topic)
+                            record = encode_json(RECORD_ACK, [session_id, topic_name, message.seq])
+                            lsn = self._log(record, session_id=session_id)
+                            if held:
+                                lsn = self._reclaim(topic) or lsn
+                results.append(acknowledged)
+        self.acknowledged.inc(results.count(True))
+        count_scanned(len(acknowledgements))
+        self._sync(lsn)
+        return results
 
-    def receive(self, session_id: str) -> list[Message]:
-        with self.lock:
-            session = self.sessions.get(session_id)
-            if session:
-                session.refresh()
-                messages: list[Message] = []
-                for topic in session.subscribed_topics:
-                    for message in self.topic_messages[topic].values():
-                        if message.message_id not in session.acknowledged_messages:
-                            messages.append(message)
-                messages.sort(reverse=True)
+    def acknowledge_up_to(self, session_id: str, topic_name: str, seq: int) -> int:
+        session = self._session(session_id)
+        if not session:
+            return 0
+        with session.lock:
+            session.refresh()
+            if topic_name not in session.subscribed_topics:
+                return 0
+            topic = self._topic(topic_name)
+            group = session.group(topic_name)
+            if group:
+                count, lsn = self._acknowledge_leases(session_id, topic, group, seq)
+            else:
+                cursor = session.cursors[topic_name]
+                with topic.lock:
+                    # past the head would acknowledge messages that are not published yet
+                    seq = min(seq, topic.next_seq - 1)
+                    count = 0
+                    for message in cursor.pending(topic):
+                        if message.seq > seq:
+                            break
+                        count += 1
+                    held = cursor.position <= topic.first_seq
+                    session.acknowledge_up_to(topic_name, seq)
+                    cursor.advance(topic)
+                    lsn = self._log(encode_json(RECORD_ACK_UP_TO, [session_id, topic_name, seq]), session_id=session_id)
+                    if held:
+                        lsn = self._reclaim(topic) or lsn
+        self.acknowledged.inc(count)
+        self._sync(lsn)
+        return count
+
+    def receive(self, session_id: str, timeout: float = 0, after: dict[str, int] = None, max_messages: int = None,
+                max_bytes: int = None, cancel: threading.Event = None, encode: bool = False) -> list[Message]:
+        # oldest first, after maps topics to the last sequence number the caller has already seen,
+        # setting cancel and waking the session ends the wait early. encode keeps the JSON of the messages
+        # for Message.to_json, for callers that are going to send it.
+        deadline = time.monotonic() + timeout
+        while True:
+            session = self._session(session_id)
+            if not session:
+                return []
+            topics, messages = self._poll(session, timeout > 0, after, max_messages, max_bytes, encode)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0 or (cancel and cancel.is_set()):
+                self._discard_waiter(session, topics)
                 return messages
-            return []
+            try:
+                session.wakeup.wait(remaining)
+            finally:
+                self._discard_waiter(session, topics)
 
-    def get_messages(self, topic: str) -> list[dict]:
-        with self.lock:
-            messages: list[Message] = []
-            for message in self.topic_messages[topic].values():
-                messages.append(message)
-            messages.sort(reverse=True)
-            mapped_messages: list[dict] = map(lambda message: message.to_dict_admin(), messages)
-            return mapped_messages
+    def get_messages(self, topic: str, after: int = None, max_messages: int = None, start: float = None,
+                     end: float = None, acknowledged: bool = None) -> tuple[list[dict], int]:
+        # one page of the admin listing, oldest first. Messages published from start until before end
+        # (seconds) and, if acknowledged is given, acknowledged or not by every subscriber and group.
+        # Only the page is looked at under the lock, and at most ADMIN_SCAN_LIMIT entries of the log.
+        # Returns the page and the last sequence number looked at, None once the end of the topic was reached.
+        topic_obj = self.topics.get(topic)
+        if topic_obj is None:
+            return [], None
+        page: list[tuple[Message, list[str]]] = []
+        with topic_obj.lock:
+            # who acknowledged what is derived from the cursors of the subscribers and groups
+            cursors = list(topic_obj.subscribers.items())
+            cursors += [(f'group:{group.name}', group.cursor) for group in topic_obj.groups.values()]
+            seq = topic_obj.first_seq if after is None else max(after + 1, topic_obj.first_seq)
+            scanned = 0
+            while seq < topic_obj.next_seq and scanned < self.ADMIN_SCAN_LIMIT and \
+                    (max_messages is None or len(page) < max_messages):
+                message = topic_obj.get(seq)
+                # a run of sequence numbers without a slot counts as one
+                seq = topic_obj.following(seq)
+                scanned += 1
+                if message is None or (start is not None and message.created_ms < start * 1000) or \
+                        (end is not None and message.created_ms >= end * 1000):
+                    continue
+                names = [name for name, cursor in cursors if cursor.is_acknowledged(message.seq)]
+                if acknowledged is not None and acknowledged != (bool(cursors) and len(names) == len(cursors)):
+                    continue
+                page.append((message, names))
+            last = seq - 1 if seq < topic_obj.next_seq else None
+        count_scanned(scanned, (message for message, _ in page))
+        # payloads are decoded for display after the lock is released
+        return [message.to_dict_admin(names) for message, names in page], last
 
     def get_topics(self) -> list[str]:
         with self.lock:
-            return list(self.topic_messages.keys())
-    
-    def expire(self):
+            return list(self.topics.keys())
+
+    def get_lag(self, topic: str = None) -> list[dict]:
+        # how far every subscriber and group is behind, per topic. Costs a few operations per
+        # cursor instead of a walk over the messages, so it is fine to poll.
+        if topic is None:
+            with self.lock:
+                topics = list(self.topics.values())
+        else:
+            topics = [self.topics[topic]] if topic in self.topics else []
+        now = time.time()
+        lag = []
+        for topic_obj in topics:
+            with topic_obj.lock:
+                cursors = [('session_id', session_id, cursor) for session_id, cursor in topic_obj.subscribers.items()]
+                cursors += [('group', group.name, group.cursor) for group in topic_obj.groups.values()]
+                consumers = []
+                count_scanned(len(cursors))
+                for kind, name, cursor in cursors:
+                    oldest = cursor.oldest_unread(topic_obj)
+                    consumers.append({
+                        kind: name,
+                        'unread': cursor.unread(topic_obj) if oldest else 0,
+                        'oldest_unread_age': round(now - oldest.receive_time, 3) if oldest else None,
+                    })
+                lag.append({
+                    'topic': topic_obj.name,
+                    'head_seq': topic_obj.next_seq - 1 if topic_obj.next_seq else None,
+                    'messages': topic_obj.count,
+                    'bytes': topic_obj.bytes,
+                    'consumers': consumers,
+                })
+        return lag
+
+    def expire(self, batch_size: int = None) -> int:
+        # pop only what is due, releasing the locks between batches
+        if batch_size is None:
+            batch_size = self.REAPER_BATCH_SIZE
         timestamp = int(time.time())
+        reaped = 0
+        with self.expire_seconds.time():
+            while True:
+                count = self._expire_sessions(timestamp, batch_size)
+                reaped += count
+                if count < batch_size:
+                    break
+            self._expire_leases()
+            while True:
+                count = self._expire_messages(timestamp, batch_size)
+                reaped += count
+                if count < batch_size:
+                    return reaped
+
+    def start_reaper(self, interval: float = None):
+        if self.reaper and self.reaper.is_alive():
+            return
+        if interval is None:
+            interval = self.REAPER_INTERVAL
+        self.reaper_stop.clear()
+        self.reaper = threading.Thread(target=self._reap, args=(interval,), daemon=True)
+        self.reaper.start()
+
+    def stop_reaper(self):
+        self.reaper_stop.set()
+        if self.reaper:
+            self.reaper.join()
+            self.reaper = None
+
+    def _reap(self, interval: float):
+        while not self.reaper_stop.wait(interval):
+            # a failed pass, e.g. a full disk during a snapshot, must not end expiry for good
+            try:
+                self.expire()
+                if self.storage:
+                    self._compact_storage(int(time.time()))
+                    if time.monotonic() - self.last_snapshot >= self.SNAPSHOT_INTERVAL:
+                        self.snapshot()
+            except Exception:
+                self.reaper_errors.inc()
+                logger.exception('reaper pass failed')
+
+    def snapshot(self) -> int:
+        # a fuzzy snapshot: whatever changes while it is written is also in the log after lsn,
+        # and replaying those records on top of the snapshot is idempotent
+        lsn = self.storage.appended_lsn()
+        writer = SnapshotWriter(snapshot_path(self.storage.directory, lsn), lsn)
         with self.lock:
-            # expire sessions
-            expired_sessions: list[str] = []
-            for session_id, session in self.sessions.items():
-                if timestamp - session.last_active > self.SESSION_TTL:
-                    expired_sessions.append(session_id)
-            for session_id in expired_sessions:
+            topics = list(self.topics.values())
+            sessions = list(self.sessions.values())
+        for topic in topics:
+            with topic.lock:
+                next_seq = topic.next_seq
+                messages = list(topic.since(topic.first_seq))
+                groups = {name: (group.visibility_timeout, group.cursor.position, group.cursor.acknowledged)
+                          for name, group in topic.groups.items()}
+            encoded = [(message.seq, message.created_ms, message.ttl, encode_data(message.data)) for message in messages]
+            writer.write_topic(topic.name, topic.key, next_seq, encoded, groups)
+        for session in sessions:
+            with session.lock:
+                subscribed_topics = sorted(session.subscribed_topics)
+                cursors = {topic: (cursor.position, cursor.acknowledged) for topic, cursor in session.cursors.items()}
+                groups = dict(session.groups or {})
+                filters = session.filter_state()
+                matched = dict(session.matched or {})
+            writer.write_session(session.session_id, subscribed_topics, cursors, groups, filters, matched)
+        writer.close()
+        # the log up to lsn and older snapshots are no longer needed for recovery
+        removed = False
+        for old_lsn, path in list_snapshots(self.storage.directory):
+            if old_lsn < lsn:
+                os.remove(path)
+                removed = True
+        if removed:
+            fsync_directory(self.storage.directory)
+        self.storage.truncate_before(lsn)
+        self.last_snapshot = time.monotonic()
+        return lsn
+
+    def _load_snapshot(self, path: str, timestamp: int) -> int:
+        reader = SnapshotReader(path)
+        try:
+            for name, topic_key, next_seq, messages, groups in reader.topics():
+                topic = self._add_topic(name, topic_key)
+                for seq, created_ms, ttl, kind, data in messages:
+                    self._restore(topic, seq, created_ms, ttl, decode_data(kind, data), timestamp)
+                topic.skip_to(next_seq)
+                for group, (visibility_timeout, position, acknowledged) in groups.items():
+                    topic.add_group(ConsumerGroup(group, visibility_timeout, Cursor(position, acknowledged)))
+                    self.grouped_topics.add(name)
+            for session_id, subscribed_topics, cursors, groups, filters, matched in reader.sessions():
+                session = Session(session_id, self._new_lock('session'))
+                session.subscribed_topics = set(subscribed_topics)
+                for topic, (position, acknowledged) in cursors.items():
+                    session.cursors[topic] = Cursor(position, acknowledged)
+                session.groups = groups or None
+                session.restore_filters(filters)
+                session.matched = matched or None
+                self.sessions[session_id] = session
+            return reader.lsn
+        finally:
+            reader.close()
+
+    def _compact_storage(self, timestamp: int):
+        # a sealed segment whose messages have all expired is deleted whole, after the state of
+        # the live sessions and topics it mentions has been carried forward into the active segment
+        for segment in self.storage.sealed_segments():
+            if segment.max_expire_ts >= timestamp:
+                continue
+            lsn = 0
+            older = [other for other in self.storage.sealed_segments() if other.start_lsn < segment.start_lsn]
+            for session_id in segment.sessions:
+                session = self._session(session_id)
+                if session:
+                    with session.lock:
+                        # expiry removes sessions under their lock, so a session still listed here is live
+                        if self.sessions.get(session_id) is session:
+                            lsn = self._log(encode_json(RECORD_SESSION, self._session_state(session)), session_id=session_id)
+                            continue
+                # the expiry of a session may be in this segment while an older one that stays still
+                # registers it, so the tombstone is carried forward until those are gone too.
+                # Under self.lock, so a registration of the same id cannot slip in before it.
+                with self.lock:
+                    if session_id not in self.sessions and any(session_id in other.sessions for other in older):
+                        lsn = self._log(encode_json(RECORD_SESSION_EXPIRED, [session_id]), session_id=session_id)
+            for topic_key in segment.topics:
+                topic = self.topic_keys[topic_key]
+                with topic.lock:
+                    lsn = self._log(encode_json(RECORD_TOPIC, self._topic_state(topic)), topic_key=topic_key)
+            self._sync(lsn)
+            self.storage.delete(segment)
+
+    def _session_state(self, session: Session) -> list:
+        # callers must hold session.lock
+        cursors = {topic: cursor.to_list() for topic, cursor in session.cursors.items()}
+        return [session.session_id, sorted(session.subscribed_topics), cursors, session.groups or {},
+                session.filter_state(), session.matched or {}]
+
+    def _topic_state(self, topic: Topic) -> list:
+        # callers must hold topic.lock
+        groups = {name: group.to_list() for name, group in topic.groups.items()}
+        return [topic.name, topic.key, topic.next_seq, groups]
+
+    def _replay(self):
+        timestamp = int(time.time())
+        # publishes whose topic record was carried forward past them after compaction
+        orphans: dict[int, list[tuple[int, int, int, any]]] = {}
+        trimmed: dict[int, int] = {} # and the first seq they kept, for trims logged before the topic record
+        # start from the latest snapshot and replay only the log written after it was started
+        from_lsn = 0
+        snapshots = list_snapshots(self.storage.directory)
+        if snapshots:
+            from_lsn = self._load_snapshot(snapshots[-1][1], timestamp)
+        for segment, record_type, payload in self.storage.replay(from_lsn):
+            if record_type == RECORD_PUBLISH:
+                topic_key, seq, created_ms, ttl, data = decode_publish(payload)
+                segment.note((created_ms // 1000) + ttl, topic_key=topic_key)
+                if topic_key in self.topic_keys:
+                    self._restore(self.topic_keys[topic_key], seq, created_ms, ttl, data, timestamp)
+                else:
+                    orphans.setdefault(topic_key, []).append((seq, created_ms, ttl, data))
+                continue
+            record = json.loads(payload)
+            if record_type == RECORD_TOPIC:
+                name, topic_key, next_seq, groups = record
+                segment.note(topic_key=topic_key)
+                topic = self.topics.get(name)
+                if not topic:
+                    topic = self._add_topic(name, topic_key)
+                for seq, created_ms, ttl, data in orphans.pop(topic_key, []):
+                    self._restore(topic, seq, created_ms, ttl, data, timestamp)
+                self._trim(topic, trimmed.pop(topic_key, 0))
+                topic.skip_to(next_seq)
+                # carried forward topics bring the state of their consumer groups along
+                for group, state in groups.items():
+                    topic.add_group(ConsumerGroup.from_list(group, state))
+                    self.grouped_topics.add(name)
+                continue
+            if record_type == RECORD_TRIM:
+                name, topic_key, first_seq = record
+                segment.note(topic_key=topic_key)
+                if topic_key in self.topic_keys:
+                    self._trim(self.topic_keys[topic_key], first_seq)
+                else:
+                    trimmed[topic_key] = max(trimmed.get(topic_key, 0), first_seq)
+                continue
+            if record_type == RECORD_GROUP_ACK:
+                name, group, seqs = record
+                topic = self.topics.get(name)
+                if topic:
+                    segment.note(topic_key=topic.key)
+                    cursor = self._group(topic, group).cursor
+                    for seq in seqs:
+                        cursor.acknowledge(seq)
+                continue
+            session_id = record[0]
+            segment.note(session_id=session_id)
+            session = self.sessions.get(session_id)
+            if record_type == RECORD_REGISTER:
+                self.sessions[session_id] = Session(session_id, self._new_lock('session'))
+            elif record_type == RECORD_SESSION:
+                session = Session(session_id, self._new_lock('session'))
+                session.subscribed_topics = set(record[1])
+                session.cursors = {topic: Cursor.from_list(state) for topic, state in record[2].items()}
+                session.groups = record[3] or None
+                session.restore_filters(record[4])
+                session.matched = record[5] or None
+                self.sessions[session_id] = session
+            elif not session:
+                continue
+            elif record_type == RECORD_SUBSCRIBE:
+                if len(record) > 2:
+                    # [session_id, topic, group, visibility_timeout], the topic record was logged first
+                    # unless it was carried forward, and then it brings the group along
+                    if record[1] in self.topics:
+                        self._group(self.topics[record[1]], record[2], record[3])
+                    session.subscribe(record[1], record[2])
+                else:
+                    session.subscribe(record[1])
+            elif record_type == RECORD_UNSUBSCRIBE:
+                session.unsubscribe(record[1])
+            elif record_type == RECORD_ACK:
+                session.acknowledge(record[1], record[2])
+            elif record_type == RECORD_ACK_UP_TO:
+                session.acknowledge_up_to(record[1], record[2])
+            elif record_type == RECORD_FILTER:
+                if record[2]:
+                    session.subscribe_filter(record[1])
+                else:
+                    session.unsubscribe_filter(record[1])
+            elif record_type == RECORD_MATCH:
+                session.match(record[1], record[2])
+            elif record_type == RECORD_SESSION_EXPIRED:
                 del self.sessions[session_id]
-            # expire messages
-            expired_messages: set[str] = set()
-            for messages in self.topic_messages.values():
-                expired_messages_for_topic: list[Message] = []
-                for message in messages.values():
-                    if timestamp > message.expire_ts:
-                        expired_messages.add(message.topic)
-                        expired_messages_for_topic.append(message)
-                for message in expired_messages_for_topic:
-                    del messages[message.message_id]
-            # expire acknowledged messages
-            for session in self.sessions.values():
-                session.acknowledged_messages.difference_update(expired_messages)
+        for session in self.sessions.values():
+            for pattern in session.filters or ():
+                self._filter(pattern).sessions += 1
+        # messages trimmed after they were restored left their entries behind
+        self.message_expiry = [entry for entry in self.message_expiry if self.topics[entry[1]].get(entry[2])]
+        heapq.heapify(self.message_expiry)
+        self.session_expiry = [(session.last_active + self.SESSION_TTL, session_id) for session_id, session in self.sessions.items()]
+        heapq.heapify(self.session_expiry)
+        self.storage.truncate_before(from_lsn)
+
+    def _restore(self, topic: Topic, seq: int, created_ms: int, ttl: int, data: any, timestamp: int):
+        if seq < topic.next_seq:
+            # already part of the snapshot
+            return
+        message = Message(topic, data, ttl, created_ms, seq)
+        if message.expire_ts < timestamp:
+            topic.skip_to(seq + 1)
+        else:
+            topic.restore(message)
+            self.message_expiry.append((message.expire_ts, topic.name, seq))
+
+    def _log(self, record: bytes, expire_ts: int = 0, session_id: str = None, topic_key: int = None) -> int:
+        if not self.storage:
+            return 0
+        return self.storage.append(record, expire_ts, session_id, topic_key)
+
+    def _sync(self, lsn: int):
+        # wait outside of the queue locks until the record is fsynced
+        if lsn:
+            self.storage.wait(lsn)
+
+    def _expire_sessions(self, timestamp: int, batch_size: int) -> int:
+        due: list[str] = []
+        with self.expiry_lock:
+            while len(due) < batch_size and self.session_expiry and self.session_expiry[0][0] < timestamp:
+                due.append(heapq.heappop(self.session_expiry)[1])
+        count_scanned(len(due))
+        # re-queue the sessions refreshed since they were queued
+        for session_id in due:
+            session = self._session(session_id)
+            if not session:
+                continue
+            expired = False
+            with session.lock:
+                deadline = session.last_active + self.SESSION_TTL
+                if deadline < timestamp:
+                    with self.lock:
+                        if self.sessions.get(session_id) is session:
+                            del self.sessions[session_id]
+                            self._log(encode_json(RECORD_SESSION_EXPIRED, [session_id]), session_id=session_id)
+                            expired = True
+                else:
+                    with self.expiry_lock:
+                        heapq.heappush(self.session_expiry, (deadline, session_id))
+            if expired:
+                self.expired_sessions.inc()
+            if expired and session.groups:
+                for topic, group in session.groups.items():
+                    self._release(session_id, topic, group)
+            if expired and session.filters:
+                for pattern in session.filters:
+                    self._drop_filter(pattern)
+            if expired:
+                for topic in session.subscribed_topics:
+                    if not session.group(topic):
+                        self._remove_subscriber(session_id, topic)
+        return len(due)
+
+    def _expire_messages(self, timestamp: int, batch_size: int) -> int:
+        due: dict[str, list[int]] = {}
+        count = 0
+        with self.expiry_lock:
+            while count < batch_size and self.message_expiry and self.message_expiry[0][0] < timestamp:
+                _, topic_name, seq = heapq.heappop(self.message_expiry)
+                due.setdefault(topic_name, []).append(seq)
+                count += 1
+        count_scanned(count)
+        # cursors skip the gaps on their next receive
+        freed = 0
+        removed = 0
+        for topic_name, seqs in due.items():
+            topic = self._topic(topic_name)
+            with topic.lock:
+                for seq in seqs:
+                    message = topic.get(seq)
+                    if message:
+                        topic.remove(message)
+                        freed += self._footprint(message)
+                        removed += 1
+        if freed:
+            with self.expiry_lock:
+                self.retained_bytes -= freed
+        if removed:
+            self.dropped_expired.inc(removed)
+        return count
+
+    def _reserve(self, size: int):
+        with self.expiry_lock:
+            if self.memory_budget is not None and self.retained_bytes + size > self.memory_budget:
+                self.rejected_memory.inc()
+                # nothing is freed before the next message expires
+                raise QueueFull('memory budget exhausted',
+                                self._retry_after(expire_ts=self.message_expiry[0][0] if self.message_expiry else None))
+            self.retained_bytes += size
+
+    def _retry_after(self, message: Message = None, expire_ts: int = None) -> int:
+        if message:
+            expire_ts = message.expire_ts
+        if expire_ts is None:
+            return self.MAX_RETRY_AFTER
+        return max(1, min(expire_ts - int(time.time()), self.MAX_RETRY_AFTER))
+
+    def _drop_oldest(self, topic: Topic) -> tuple[int, int]:
+        # callers must hold topic.lock, returns the bytes freed and the lsn of the trim record
+        freed = 0
+        expire_ts = 0
+        count = topic.count
+        while topic.count and topic.retention.exceeded(topic):
+            message = topic.oldest()
+            topic.remove(message)
+            freed += self._footprint(message)
+            expire_ts = max(expire_ts, message.expire_ts)
+        self.dropped_overflow.inc(count - topic.count)
+        self._trimmed(topic, count - topic.count)
+        # the record has to outlive the segments holding the dropped messages, or they would come back on replay
+        lsn = self._log(encode_json(RECORD_TRIM, [topic.name, topic.key, topic.first_seq]), expire_ts=expire_ts,
+                        topic_key=topic.key)
+        return freed, lsn
+
+    def _trim(self, topic: Topic, first_seq: int) -> tuple[int, int]:
+        # returns the bytes freed and the latest expiry among the removed messages
+        freed = 0
+        expire_ts = 0
+        while topic.count and topic.oldest().seq < first_seq:
+            message = topic.oldest()
+            topic.remove(message)
+            freed += self._footprint(message)
+            expire_ts = max(expire_ts, message.expire_ts)
+        return freed, expire_ts
+
+    def _footprint(self, message: Message) -> int:
+        # what removing a message gives back to the memory budget
+        return message.size + len(message.encoded or b'') + self.MESSAGE_OVERHEAD
+
+    def _trimmed(self, topic: Topic, count: int):
+        # callers must hold topic.lock. The expiry entries of the count messages just trimmed stay in the heap
+        # until they come up, unless stale entries make up half of it, then it is rebuilt without them.
+        with self.expiry_lock:
+            self.trimmed[topic.name] = topic.first_seq
+            self.expiry_stale += count
+            if self.expiry_stale * 2 > len(self.message_expiry):
+                trimmed = self.trimmed
+                self.message_expiry = [entry for entry in self.message_expiry if entry[2] >= trimmed.get(entry[1], 0)]
+                heapq.heapify(self.message_expiry)
+                self.expiry_stale = 0
+
+    def _reclaim(self, topic: Topic) -> int:
+        # callers must hold topic.lock, drops what every subscriber and group has acknowledged on topics
+        # that ask for it and returns the lsn of the trim record. Only a cursor that was at the oldest
+        # message can free it, so acknowledgements check that first and rarely get here.
+        if not (topic.retention and topic.retention.reclaim_acked) or not topic.count:
+            return 0
+        first_seq = topic.acknowledged_below()
+        if first_seq <= topic.first_seq:
+            return 0
+        count = topic.count
+        freed, expire_ts = self._trim(topic, first_seq)
+        self.dropped_acknowledged.inc(count - topic.count)
+        self._trimmed(topic, count - topic.count)
+        with self.expiry_lock:
+            self.retained_bytes -= freed
+        return self._log(encode_json(RECORD_TRIM, [topic.name, topic.key, topic.first_seq]), expire_ts=expire_ts,
+                         topic_key=topic.key)
+
+    def _remove_subscriber(self, session_id: str, topic_name: str) -> int:
+        # the subscriber leaving may have been the last one holding back the oldest messages
+        topic = self._topic(topic_name)
+        with topic.lock:
+            if topic.subscribers.pop(session_id, None) is None:
+                return 0
+            return self._reclaim(topic)
+
+    def _index_subscribers(self):
+        # topics know their subscribers, rebuilt from the sessions after a restart
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            with session.lock:
+                for topic_name in session.subscribed_topics:
+                    if not session.group(topic_name):
+                        topic = self._topic(topic_name)
+                        with topic.lock:
+                            topic.add_subscriber(session.session_id, session.cursors[topic_name])
+
+    def _acknowledge_leases(self, session_id: str, topic: Topic, group: str, seq: int) -> tuple[int, int]:
+        # within a group, acknowledging up to seq covers the messages leased to this member
+        now = time.monotonic()
+        with topic.lock:
+            consumer_group = self._group(topic, group)
+            seqs = sorted(leased for leased in consumer_group.held_by(session_id) if leased <= seq)
+            held = consumer_group.cursor.position <= topic.first_seq
+            for leased in seqs:
+                consumer_group.acknowledge(session_id, leased, now)
+            consumer_group.cursor.advance(topic)
+            lsn = 0
+            if seqs:
+                lsn = self._log(encode_json(RECORD_GROUP_ACK, [topic.name, group, seqs]), topic_key=topic.key)
+                if held:
+                    lsn = self._reclaim(topic) or lsn
+        return len(seqs), lsn
+
+    def _group(self, topic: Topic, name: str, visibility_timeout: int = None) -> ConsumerGroup:
+        # callers must hold topic.lock
+        group = topic.groups.get(name)
+        if group is None:
+            group = ConsumerGroup(name, visibility_timeout or self.VISIBILITY_TIMEOUT)
+            topic.add_group(group)
+            with self.lock:
+                self.grouped_topics.add(topic.name)
+        return group
+
+    def _release(self, session_id: str, topic_name: str, group: str):
+        # a member that leaves hands its leases back right away
+        topic = self._topic(topic_name)
+        with topic.lock:
+            self._group(topic, group).release(session_id)
+            waiters = set(topic.waiters)
+        for session in waiters:
+            if session.session_id != session_id:
+                session.wake()
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        with self.lock:
+            topics = [self.topics[name] for name in self.grouped_topics]
+        for topic in topics:
+            with topic.lock:
+                expired = [group.expire_leases(now) for group in topic.groups.values()]
+                waiters = set(topic.waiters) if any(expired) else ()
+            # messages whose lease ran out are up for grabs again
+            for session in waiters:
+                session.wake()
+
+    def _subscribe_filter(self, session: Session, pattern: str) -> bool:
+        lsn = 0
+        with session.lock:
+            session.refresh()
+            subscribed = session.subscribe_filter(pattern)
+            if subscribed:
+                with self.lock:
+                    self._filter(pattern).sessions += 1
+                lsn = self._log(encode_json(RECORD_FILTER, [session.session_id, pattern, True]), session_id=session.session_id)
+                lsn = self._expand(session) or lsn
+        self._sync(lsn)
+        session.wake()
+        return subscribed
+
+    def _unsubscribe_filter(self, session: Session, pattern: str) -> bool:
+        lsn = 0
+        with session.lock:
+            session.refresh()
+            matched = [topic for topic, matched_by in (session.matched or {}).items() if matched_by == pattern]
+            unsubscribed = session.unsubscribe_filter(pattern)
+            if unsubscribed:
+                lsn = self._log(encode_json(RECORD_FILTER, [session.session_id, pattern, False]), session_id=session.session_id)
+                # the other filters take back what they still match
+                lsn = self._expand(session) or lsn
+                for topic in matched:
+                    if topic not in session.subscribed_topics:
+                        lsn = self._remove_subscriber(session.session_id, topic) or lsn
+        if unsubscribed:
+            self._drop_filter(pattern)
+        self._sync(lsn)
+        return unsubscribed
+
+    def _filter(self, pattern: str) -> TopicFilter:
+        # callers must hold self.lock, a new filter starts out with the topics that already match it
+        topic_filter = self.filters.get(pattern)
+        if topic_filter is None:
+            topics = self.topic_index.names_matching(pattern)
+            topic_filter = TopicFilter(pattern, [topic.name for topic in topics])
+            self.filters.insert(pattern, topic_filter)
+            for topic in topics:
+                topic.filters = [*(topic.filters or ()), topic_filter]
+        return topic_filter
+
+    def _drop_filter(self, pattern: str):
+        with self.lock:
+            topic_filter = self.filters.get(pattern)
+            if topic_filter:
+                topic_filter.sessions -= 1
+                if topic_filter.sessions <= 0:
+                    self.filters.remove(pattern)
+                    for topic in self.topic_index.names_matching(pattern):
+                        topic.filters = [other for other in topic.filters or () if other is not topic_filter] or None
+
+    def _expand(self, session: Session) -> int:
+        # callers must hold session.lock
+        # subscribes the topics that appeared under the session's filters since it last looked
+        lsn = 0
+        for pattern, seen in (session.filters or {}).items():
+            with self.lock:
+                topic_filter = self.filters.get(pattern)
+            if topic_filter is None:
+                continue
+            with topic_filter.lock:
+                topics = topic_filter.topics[seen:]
+            for topic in topics:
+                if session.match(topic, pattern):
+                    lsn = self._log(encode_json(RECORD_MATCH, [session.session_id, topic, pattern]),
+                                    session_id=session.session_id)
+                    topic_obj = self._topic(topic)
+                    with topic_obj.lock:
+                        topic_obj.add_subscriber(session.session_id, session.cursors[topic])
+            session.filters[pattern] = seen + len(topics)
+        return lsn
+
+    def _poll(self, session: Session, wait: bool, after: dict[str, int] = None, max_messages: int = None,
+              max_bytes: int = None, encode: bool = False) -> tuple[list[Topic | TopicFilter], list[Message]]:
+        # shared by the threaded and the asyncio receive, returns the topics and filters the session now waits on
+        with session.lock:
+            session.refresh()
+            self._expand(session)
+            # register as a waiter before looking, so a publish in between still wakes us
+            topics: list[Topic | TopicFilter] = []
+            if wait:
+                topics = [self._topic(topic) for topic in session.subscribed_topics]
+                if session.filters:
+                    # a topic that does not exist yet can only announce itself through the filter
+                    with self.lock:
+                        topics += [topic_filter for topic_filter in map(self.filters.get, session.filters) if topic_filter]
+                session.wakeup.clear()
+            for topic in topics:
+                with topic.lock:
+                    topic.waiters.add(session)
+            messages = self._pending(session, after, max_messages, max_bytes)
+        if messages:
+            self.delivered.inc(len(messages))
+            count_scanned(0, messages)
+            if encode:
+                self._encode(messages)
+        return topics, messages
+
+    def _encode(self, messages: list[Message]):
+        # the encodings are built outside the topic locks, then kept on the messages that are still retained
+        # and charged to the memory budget, which their removal gives back
+        fresh: dict[Topic, list[tuple[Message, bytes]]] = {}
+        for message in messages:
+            if message.encoded is None:
+                fresh.setdefault(message.topic_ref, []).append((message, message.encode()))
+        charged = 0
+        for topic, encoded in fresh.items():
+            with topic.lock:
+                for message, value in encoded:
+                    if message.encoded is None and topic.get(message.seq) is message:
+                        message.encoded = value
+                        charged += len(value)
+        if charged:
+            with self.expiry_lock:
+                self.retained_bytes += charged
+
+    def _pending(self, session: Session, after: dict[str, int] = None, max_messages: int = None,
+                 max_bytes: int = None) -> list[Message]:
+        # callers must hold session.lock
+        # each topic log is already ordered, so merging is enough, and no topic has to give more than a page,
+        # so its walk stops at max_messages or max_bytes however large its backlog is
+        pending: list[list[Message]] = []
+        groups: dict[str, tuple[Topic, ConsumerGroup]] = {}
+        now = time.monotonic()
+        for topic_name in session.subscribed_topics:
+            topic = self._topic(topic_name)
+            group = session.group(topic_name)
+            with topic.lock:
+                if group:
+                    # leases keep messages from being handed out twice, so after does not apply
+                    consumer_group = self._group(topic, group)
+                    limit = min(max_messages or self.LEASE_BATCH_SIZE, self.LEASE_BATCH_SIZE)
+                    messages = take(consumer_group.available(topic, now), limit, max_bytes)
+                    groups[topic_name] = (topic, consumer_group)
+                else:
+                    cursor = session.cursors[topic_name]
+                    start = after.get(topic_name) if after else None
+                    messages = take(cursor.pending(topic, start), max_messages, max_bytes)
+            pending.append(messages)
+        page = take(heapq.merge(*pending), max_messages, max_bytes)
+        if groups:
+            page = self._lease(session.session_id, page, groups, now)
+        return page
+
+    def _lease(self, session_id: str, page: list[Message], groups: dict[str, tuple[Topic, ConsumerGroup]],
+               now: float) -> list[Message]:
+        # only what made it into the page is leased, another member may have taken some in the meantime
+        taken: set[Message] = set()
+        for topic_name, (topic, consumer_group) in groups.items():
+            with topic.lock:
+                for message in page:
+                    if message.topic_ref is topic and not consumer_group.lease(message.seq, session_id, now):
+                        taken.add(message)
+        return [message for message in page if message not in taken] if taken else page
+
+    def _discard_waiter(self, session: Session, topics: list[Topic | TopicFilter]):
+        for topic in topics:
+            with topic.lock:
+                topic.waiters.discard(session)
+
+    def _collect_metrics(self) -> list:
+        # read when /metrics is scraped, so the hot paths keep nothing extra for it
+        with self.lock:
+            topics = list(self.topics.values())
+            sessions = len(self.sessions)
+        sizes = []
+        for topic in topics:
+            with topic.lock:
+                sizes.append((topic.name, topic.count, topic.bytes, len(topic.subscribers)))
+        with self.expiry_lock:
+            retained_bytes = self.retained_bytes
+        metrics = [
+            ('httpmq_sessions', 'gauge', 'Registered sessions', [({}, sessions)]),
+            ('httpmq_retained_bytes', 'gauge', 'Memory held by the messages, counted against the budget',
+             [({}, retained_bytes)]),
+            ('httpmq_topic_messages', 'gauge', 'Messages retained per topic', [({'topic': name}, count) for name, count, _, _ in sizes]),
+            ('httpmq_topic_bytes', 'gauge', 'Data size retained per topic', [({'topic': name}, size) for name, _, size, _ in sizes]),
+            ('httpmq_topic_subscribers', 'gauge', 'Sessions subscribed per topic outside consumer groups',
+             [({'topic': name}, subscribers) for name, _, _, subscribers in sizes]),
+        ]
+        if self.memory_budget is not None:
+            metrics.append(('httpmq_memory_budget_bytes', 'gauge', 'Memory budget for message data', [({}, self.memory_budget)]))
+        return metrics
+
+    def _new_lock(self, name: str) -> threading.Lock:
+        if self.lock_metrics:
+            return TimedLock(self.lock_wait, self.lock_hold, name, self.LOCK_SAMPLE_EVERY)
+        return threading.Lock()
+
+    def _session(self, session_id: str) -> Session:
+        # a single dict lookup is atomic, the lock only orders it against inserts and removals,
+        # which it cannot observe halfway anyway
+        return self.sessions.get(session_id)
+
+    def _topic(self, topic: str) -> Topic:
+        # topics are never removed, so an existing one can be looked up without the lock
+        topic_obj = self.topics.get(topic)
+        if topic_obj is not None:
+            return topic_obj
+        with self.lock:
+            topic_obj = self.topics.get(topic)
+            if topic_obj is not None:
+                return topic_obj
+            topic_obj = self._add_topic(topic, (self.instance << 32) | len(self.topics))
+            self._log(encode_json(RECORD_TOPIC, [topic, topic_obj.key, 0, {}]), topic_key=topic_obj.key)
+            # sessions with a matching filter subscribe it on their next receive
+            waiters: set[Session] = set()
+            topic_obj.filters = self.filters.filters_matching(topic) or None
+            for topic_filter in topic_obj.filters or ():
+                with topic_filter.lock:
+                    topic_filter.topics.append(topic)
+                    waiters.update(topic_filter.waiters)
+        for session in waiters:
+            session.wake()
+        return topic_obj
+
+    def _add_topic(self, name: str, key: int) -> Topic:
+        # callers must hold self.lock unless replaying
+        topic = Topic(name, key, self._new_lock('topic'))
+        # the longest matching prefix decides the retention caps
+        prefixes = [prefix for prefix in self.retention if name.startswith(prefix)]
+        if prefixes:
+            topic.retention = self.retention[max(prefixes, key=len)]
+        self.topics[name] = topic
+        self.topic_keys[key] = topic
+        self.topic_index.insert(name, topic)
+        return topic
@@ -0,0 +1,170 @@
+# Metrics in the Prometheus text format, without the client library. Counters and histograms are updated
+# on the hot paths and cost a lock and an addition. Everything that can be read off the
+# queue (topic sizes, session counts) is collected only when /metrics is scraped.
+from bisect import bisect_left
+from time import perf_counter
+import threading
+
+# seconds, from a fast lock acquisition to a slow long-poll
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter:
+    # inc() on a counter with labels goes through the child bound by labels(), which callers keep around
+    __slots__ = ('name', 'help', 'labelnames', 'lock', 'value', 'children')
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.value = 0
+        self.children: dict[tuple, Counter] = {}
+
+    def inc(self, amount: float = 1):
+        # += is a read and a store, without the lock a thread switch in between loses an increment
+        with self.lock:
+            self.value += amount
+
+    def labels(self, *values) -> 'Counter':
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = Counter(self.name, self.help)
+            return child
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        if not self.labelnames:
+            return lines + [f'{self.name} {self.value}']
+        with self.lock:
+            children = list(self.children.items())
+        lines += [f'{self.name}{format_labels(self.labelnames, labels)} {child.value}' for labels, child in children]
+        return lines
+
+class Histogram:
+    __slots__ = ('name', 'help', 'labelnames', 'buckets', 'lock', 'values')
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values: dict[tuple, list] = {} # labels -> [count per bucket and +Inf, sum]
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, labels: tuple = ()) -> 'Timer':
+        return Timer(self, labels)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, counts in values:
+            # buckets are stored apart and exported cumulative
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames + ("le",), labels + (bound,))} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {total}')
+        return lines
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start, self.labels)
+
+class TimedLock:
+    # a drop-in for threading.Lock that records how long callers waited for it and held it. Only every
+    # sample_every-th acquisition is timed, the others pay for a countdown and a bound method call.
+    __slots__ = ('lock', 'acquire', 'release', 'wait', 'hold', 'labels', 'sample_every', 'countdown', 'acquired')
+
+    def __init__(self, wait: Histogram, hold: Histogram, name: str, sample_every: int = 1):
+        self.lock = threading.Lock()
+        self.acquire = self.lock.acquire
+        self.release = self.lock.release
+        self.wait = wait
+        self.hold = hold
+        self.labels = (name,)
+        self.sample_every = sample_every
+        self.countdown = sample_every # acquisitions until the next timed one
+        self.acquired = 0.0 # when the timed holder got the lock, 0 when the holder is not timed
+
+    def __enter__(self):
+        # unlocked, a racing decrement past zero only times the next acquisition instead
+        self.countdown -= 1
+        if self.countdown > 0:
+            self.acquire()
+            return self
+        self.countdown = self.sample_every
+        start = perf_counter()
+        self.acquire()
+        self.acquired = perf_counter()
+        self.wait.observe(self.acquired - start, self.labels)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if not self.acquired:
+            self.release()
+            return
+        held = perf_counter() - self.acquired
+        self.acquired = 0.0
+        self.release()
+        self.hold.observe(held, self.labels)
+
+class Registry:
+    # collectors are called at scrape time and return (name, type, help, [(labels dict, value)])
+    def __init__(self):
+        self.metrics: list[Counter | Histogram] = []
+        self.collectors: list = []
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        counter = Counter(name, help, labelnames)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collect in self.collectors:
+            for name, kind, help, samples in collect():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1,99 +1,652 @@
-from uuid import uuid4
+from uuid import UUID, uuid4
+from bisect import bisect_right
+from operator import itemgetter
+import heapq
 import time
 import json
+import threading
+from json.encoder import encode_basestring_ascii as escape
+from .encoder import dumps
+from .topics import matches
+from .tracing import count_scanned
+
+SEQ_BITS = 64
 
 class Message:
-    def __init__(self, topic: str, data: str, ttl: int = 3600):
-        self.message_id = str(uuid4())
-        self.timestamp = int(time.time())
-        self.topic = topic
+    __slots__ = ('topic_ref', 'seq', 'data', 'ttl', 'created_ms', 'size', 'encoded')
+
+    def __init__(self, topic: 'Topic', data: str, ttl: int = 3600, created_ms: int = None, seq: int = None):
+        self.topic_ref = topic
+        self.seq = seq
         self.data = data
         self.ttl = ttl
-        self.receive_time = time.time()
-        self.expire_ts = self.timestamp + ttl
-        self.clients_acknowledged: set[str] = set()
+        if created_ms is None:
+            created_ms = time.time_ns() // 1000000
+        self.created_ms = created_ms
+        # roughly the serialized size of the data, enough to bound a response and to account for memory
+        self.size = len(data) if isinstance(data, str) else len(dumps(data))
+        self.encoded: bytes = None # to_dict() as JSON, kept by MessageQueue.receive(encode=True)
+
+    @property
+    def message_id(self) -> str:
+        # rendered on demand from the topic key and sequence number, see Topic.parse_message_id,
+        # formatted by hand as str(UUID(...)) takes twice as long
+        value = '%032x' % ((self.topic_ref.key << SEQ_BITS) | self.seq)
+        return f'{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}'
+
+    @property
+    def topic(self) -> str:
+        return self.topic_ref.name
+
+    @property
+    def timestamp(self) -> int:
+        return self.created_ms // 1000
+
+    @property
+    def receive_time(self) -> float:
+        return self.created_ms / 1000
+
+    @property
+    def expire_ts(self) -> int:
+        return self.timestamp + self.ttl
     
     def __eq__(self, __value: object) -> bool:
         if isinstance(__value, Message):
-            return self.message_id == __value.message_id
+            return self.topic_ref is __value.topic_ref and self.seq == __value.seq
         else:
             return False
     
     def __cmp__(self, __value: object) -> int:
         if isinstance(__value, Message):
-            return self.receive_time - __value.receive_time
+            return self.created_ms - __value.created_ms
         else:
             return 0
     
     def __lt__(self, __value: object) -> bool:
         if isinstance(__value, Message):
-            return self.receive_time < __value.receive_time
+            return self.created_ms < __value.created_ms
         else:
             return False
     
     def __gt__(self, __value: object) -> bool:
         if isinstance(__value, Message):
-            return self.receive_time > __value.receive_time
+            return self.created_ms > __value.created_ms
         else:
             return False
     
     def __hash__(self) -> int:
-        return hash(self.message_id)
+        return hash((self.topic_ref.key, self.seq))
     
     def to_dict(self) -> dict:
         return {
             'message_id': self.message_id,
             'topic': self.topic,
+            'seq': self.seq,
             'data': self.data,
             'timestamp': self.timestamp,
             'ttl': self.ttl,
         }
     
-    def to_dict_admin(self) -> dict:
+    def to_json(self) -> bytes:
+        # a message never changes once published, so the encoding kept by a receive serves every later one
+        return self.encoded or self.encode()
+
+    def encode(self) -> bytes:
+        # to_dict() as JSON, put together directly so only the topic and the data need escaping
+        head = f'{{"message_id":"{self.message_id}","topic":{escape(self.topic)},"seq":{self.seq},"data":'
+        tail = f',"timestamp":{self.created_ms // 1000},"ttl":{self.ttl}}}'
+        if isinstance(self.data, str):
+            return (head + escape(self.data) + tail).encode()
+        return b''.join((head.encode(), dumps(self.data), tail.encode()))
+
+    def to_dict_admin(self, clients_acknowledged: list[str] = ()) -> dict:
         data = self.data
-        try:
-            data = json.loads(self.data)
-        except:
-            pass
+        # only structured payloads are worth decoding for display
+        if isinstance(data, str) and data.startswith(('{', '[')):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                pass
         if isinstance(data, str) and len(data) > 80:
             data = self.data[:80] + '...'
         return {
             'message_id': self.message_id,
             'topic': self.topic,
+            'seq': self.seq,
             'data': data,
             'timestamp': self.timestamp,
             'ttl': self.ttl,
             'receive_time': self.receive_time,
             'expire_ts': self.expire_ts,
-            'clients_acknowledged': list(self.clients_acknowledged),
+            'clients_acknowledged': list(clients_acknowledged),
         }
 
+class Retention:
+    # per-topic caps, None means unbounded. A full topic drops its oldest messages or rejects new ones.
+    __slots__ = ('max_messages', 'max_bytes', 'max_age', 'reject', 'drop_unsubscribed', 'reclaim_acked')
+
+    def __init__(self, max_messages: int = None, max_bytes: int = None, max_age: int = None, overflow: str = 'drop_oldest',
+                 drop_unsubscribed: bool = False, reclaim_acked: bool = False):
+        if overflow not in ('drop_oldest', 'reject'):
+            raise ValueError(f'unknown overflow policy {overflow}')
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age # caps the ttl of every message published to the topic
+        self.reject = overflow == 'reject'
+        self.drop_unsubscribed = drop_unsubscribed # messages published while nobody subscribes are not kept
+        # messages are dropped as soon as every subscriber and group has acknowledged them,
+        # so a session subscribing later does not get to see them
+        self.reclaim_acked = reclaim_acked
+
+    def exceeded(self, topic: 'Topic', count: int = 0, size: int = 0) -> bool:
+        # whether the topic would be over its caps with count more messages of size bytes
+        return (self.max_messages is not None and topic.count + count > self.max_messages) or \
+            (self.max_bytes is not None and topic.bytes + size > self.max_bytes)
+
+class Topic:
+    __slots__ = ('name', 'key', 'lock', 'base_seq', 'next_seq', 'log', 'offset', 'gaps', 'count', 'bytes', 'retention',
+                 'waiters', 'groups', 'subscribers', 'filters', 'holders')
+    COMPACT_THRESHOLD = 64
+    GAP_THRESHOLD = 64 # shorter runs of missing sequence numbers are cheaper as empty slots
+
+    def __init__(self, name: str, key: int = 0, lock: threading.Lock = None):
+        self.name = name
+        self.key = key # high bits of every message id in this topic
+        self.lock = lock or threading.Lock()
+        self.base_seq = 0 # sequence number of log[0]
+        self.next_seq = 0
+        self.log: list[Message] = [] # seq - base_seq -> Message, None once removed
+        self.offset = 0 # number of removed entries at the head of the log
+        # (index, seq, length, skipped): length sequence numbers from seq on have no slot and come before
+        # log[index], skipped is the total length of the gaps up to this one
+        self.gaps: list[tuple[int, int, int, int]] = []
+        self.count = 0
+        self.bytes = 0 # approximate size of the retained data
+        self.retention: Retention = None
+        self.waiters: set[Session] = set() # sessions blocked in receive on this topic
+        self.groups: dict[str, ConsumerGroup] = {} # consumer groups reading this topic
+        self.subscribers: dict[str, Cursor] = {} # session_id -> cursor of the sessions reading this topic on their own
+        self.filters: list[TopicFilter] = None # wildcard filters matching this topic, replaced rather than changed
+        # heap of (position, is a group, session_id or group name) behind acknowledged_below, built on first use
+        self.holders: list[tuple[int, bool, str]] = None
+
+    @property
+    def first_seq(self) -> int:
+        if not self.gaps:
+            return self.base_seq + self.offset
+        return self.base_seq + self.offset + self._skipped_before(self.offset)
+
+    def _skipped_before(self, index: int) -> int:
+        # sequence numbers without a slot up to log[index]
+        position = bisect_right(self.gaps, index, key=itemgetter(0))
+        return self.gaps[position - 1][3] if position else 0
+
+    def _slot(self, seq: int) -> int:
+        # log index of seq, or of the first slot after it when seq has none
+        index = seq - self.base_seq
+        if self.gaps:
+            position = bisect_right(self.gaps, seq, key=itemgetter(1))
+            if position:
+                gap_index, gap_seq, length, skipped = self.gaps[position - 1]
+                if seq < gap_seq + length:
+                    return gap_index
+                index -= skipped
+        return index
+
+    def append(self, message: Message) -> Message:
+        message.seq = self.next_seq
+        self.next_seq += 1
+        self.log.append(message)
+        self.count += 1
+        self.bytes += message.size
+        return message
+
+    def skip(self, count: int):
+        # uses up count sequence numbers without giving them a slot in the log
+        if self.count == 0:
+            self.log = []
+            self.base_seq = self.next_seq + count
+            self.offset = 0
+            self.gaps = []
+        elif self.gaps and self.gaps[-1][0] == len(self.log):
+            index, seq, length, skipped = self.gaps[-1]
+            self.gaps[-1] = (index, seq, length + count, skipped + count)
+        else:
+            self.gaps.append((len(self.log), self.next_seq, count, (self.gaps[-1][3] if self.gaps else 0) + count))
+        self.next_seq += count
+
+    def skip_to(self, seq: int):
+        # used when rebuilding from storage, leaves a gap for messages that are gone
+        if seq <= self.next_seq:
+            return
+        if self.count and seq - self.next_seq < self.GAP_THRESHOLD:
+            self.log.extend([None] * (seq - self.next_seq))
+            self.next_seq = seq
+        else:
+            self.skip(seq - self.next_seq)
+
+    def skipped(self, seq: int) -> int:
+        # sequence numbers from seq on that have no slot
+        if not self.gaps:
+            return 0
+        position = bisect_right(self.gaps, seq, key=itemgetter(1))
+        total = self.gaps[-1][3]
+        if not position:
+            return total
+        index, gap_seq, length, skipped = self.gaps[position - 1]
+        return total - skipped + max(gap_seq + length - seq, 0)
+
+    def following(self, seq: int) -> int:
+        # the next sequence number after seq that may have a message, past the gap seq is in
+        if self.gaps:
+            position = bisect_right(self.gaps, seq, key=itemgetter(1))
+            if position:
+                index, gap_seq, length, skipped = self.gaps[position - 1]
+                if seq < gap_seq + length:
+                    return gap_seq + length
+        return seq + 1
+
+    def restore(self, message: Message) -> Message:
+        self.skip_to(message.seq)
+        return self.append(message)
+
+    def get(self, seq: int) -> Message:
+        index = self._slot(seq)
+        if 0 <= index < len(self.log):
+            message = self.log[index]
+            if message and message.seq == seq:
+                return message
+        return None
+
+    def parse_message_id(self, message_id: str) -> int:
+        try:
+            value = UUID(message_id).int
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if value >> SEQ_BITS != self.key:
+            return None
+        return value & ((1 << SEQ_BITS) - 1)
+
+    def get_by_id(self, message_id: str) -> Message:
+        seq = self.parse_message_id(message_id)
+        if seq is None:
+            return None
+        return self.get(seq)
+
+    def oldest(self) -> Message:
+        # remove() keeps offset on the first live entry
+        if self.count:
+            return self.log[self.offset]
+        return None
+
+    def has_audience(self) -> bool:
+        # callers must hold self.lock, sessions with a matching filter count before they get to subscribe the topic
+        return bool(self.subscribers or self.groups) or any(topic_filter.sessions for topic_filter in self.filters or ())
+
+    def add_subscriber(self, session_id: str, cursor: 'Cursor'):
+        # callers must hold self.lock
+        self.subscribers[session_id] = cursor
+        self._hold(False, session_id, cursor)
+
+    def add_group(self, group: 'ConsumerGroup'):
+        # callers must hold self.lock
+        self.groups[group.name] = group
+        self._hold(True, group.name, group.cursor)
+
+    def _hold(self, is_group: bool, name: str, cursor: 'Cursor'):
+        if self.holders is None:
+            return
+        # a session that subscribes again leaves a duplicate behind, rebuilt once those pile up
+        if len(self.holders) > 2 * (len(self.subscribers) + len(self.groups)) + 16:
+            self.holders = None
+        else:
+            heapq.heappush(self.holders, (cursor.position, is_group, name))
+
+    def _holder(self, is_group: bool, name: str) -> 'Cursor':
+        if is_group:
+            group = self.groups.get(name)
+            return group.cursor if group else None
+        return self.subscribers.get(name)
+
+    def acknowledged_below(self) -> int:
+        # callers must hold self.lock, every subscriber and group has acknowledged the messages below
+        # this sequence number. Cursors only ever move forward, so a heap entry can only be behind its cursor:
+        # the top is refreshed until it is current, and dropped once its subscriber has left.
+        if self.holders is None:
+            self.holders = [(cursor.position, False, session_id) for session_id, cursor in self.subscribers.items()]
+            self.holders += [(group.cursor.position, True, name) for name, group in self.groups.items()]
+            heapq.heapify(self.holders)
+        holders = self.holders
+        while holders:
+            position, is_group, name = holders[0]
+            cursor = self._holder(is_group, name)
+            if cursor is None:
+                heapq.heappop(holders)
+            elif cursor.position != position:
+                heapq.heapreplace(holders, (cursor.position, is_group, name))
+            else:
+                return position
+        return self.first_seq
+
+    def since(self, seq: int):
+        # by index rather than a slice, which would copy the whole tail for a caller that wants a page.
+        # Callers hold self.lock, so the log cannot be compacted while this runs. Every entry walked over
+        # counts as scanned, the removed ones and those the caller skips as well.
+        log = self.log
+        start = max(self._slot(seq), self.offset)
+        index = start - 1
+        try:
+            for index in range(start, len(log)):
+                message = log[index]
+                if message:
+                    yield message
+        finally:
+            count_scanned(index - start + 1)
+
+    def remove(self, message: Message) -> bool:
+        index = self._slot(message.seq)
+        if not 0 <= index < len(self.log) or self.log[index] is not message:
+            return False
+        self.log[index] = None
+        self.count -= 1
+        self.bytes -= message.size
+        while self.offset < len(self.log) and self.log[self.offset] is None:
+            self.offset += 1
+        # drop the dead head in bulk so repeated removals stay amortized O(1)
+        if self.offset >= self.COMPACT_THRESHOLD and self.offset * 2 >= len(self.log):
+            skipped = 0
+            if self.gaps:
+                # gaps before the new head are folded into base_seq
+                skipped = self._skipped_before(self.offset)
+                self.gaps = [(index - self.offset, seq, length, total - skipped)
+                             for index, seq, length, total in self.gaps if index > self.offset]
+            del self.log[:self.offset]
+            self.base_seq += self.offset + skipped
+            self.offset = 0
+        return True
+
+    def __len__(self) -> int:
+        return self.count
+
+class Cursor:
+    __slots__ = ('position', 'acknowledged', 'ahead')
+
+    def __init__(self, position: int = 0, acknowledged: int = 0):
+        self.position = position # every message below this sequence number is acknowledged or gone
+        self.acknowledged = acknowledged # bitmap of out-of-order acks, bit n is sequence number position + n
+        self.ahead = acknowledged.bit_count() # bits set in acknowledged, kept up to date for unread()
+
+    def is_acknowledged(self, seq: int) -> bool:
+        return seq < self.position or bool(self.acknowledged >> (seq - self.position) & 1)
+
+    def acknowledge(self, seq: int):
+        if seq >= self.position and not self.acknowledged >> (seq - self.position) & 1:
+            self.acknowledged |= 1 << (seq - self.position)
+            self.ahead += 1
+
+    def acknowledge_up_to(self, seq: int):
+        if seq >= self.position:
+            self._shift(seq + 1 - self.position)
+
+    def to_list(self) -> list:
+        return [self.position, format(self.acknowledged, 'x')]
+
+    @staticmethod
+    def from_list(state: list) -> 'Cursor':
+        return Cursor(state[0], int(state[1], 16))
+
+    def unread(self, topic: Topic) -> int:
+        # callers must hold topic.lock. Messages published past the cursor and not acknowledged, without
+        # walking them. Messages that expired out of order still count until the cursor moves past them.
+        first_seq = topic.first_seq
+        if self.position >= first_seq:
+            return topic.next_seq - self.position - topic.skipped(self.position) - self.ahead
+        # acks below the head of the topic are for messages that are gone
+        return topic.next_seq - first_seq - topic.skipped(first_seq) - self.ahead + self._below(first_seq - self.position)
+
+    def oldest_unread(self, topic: Topic) -> Message:
+        # callers must hold topic.lock, after advance() the first message looked at is the one
+        for message in topic.since(self.position):
+            if not self.is_acknowledged(message.seq):
+                return message
+        return None
+
+    def advance(self, topic: Topic):
+        # move past expired and acknowledged messages so the bitmap only spans retained ones
+        if self.position < topic.first_seq:
+            self._shift(topic.first_seq - self.position)
+        while self.position < topic.next_seq:
+            if self.acknowledged & 1:
+                # skip the whole run of acknowledged messages at once
+                self._shift((~self.acknowledged & (self.acknowledged + 1)).bit_length() - 1)
+            elif topic.get(self.position) is None:
+                self._shift(topic.following(self.position) - self.position)
+            else:
+                break
+
+    def pending(self, topic: Topic, after: int = None):
+        self.advance(topic)
+        acknowledged = self.acknowledged
+        position = self.position
+        start = self.position
+        if after is not None and after >= start:
+            start = after + 1
+        for message in topic.since(start):
+            if acknowledged:
+                acknowledged >>= message.seq - position
+                position = message.seq
+                if acknowledged & 1:
+                    continue
+            yield message
+
+    def _below(self, count: int) -> int:
+        # acks among the next count sequence numbers, without building a mask as wide as a long gap
+        if count >= self.acknowledged.bit_length():
+            return self.ahead
+        return (self.acknowledged & ((1 << count) - 1)).bit_count()
+
+    def _shift(self, count: int):
+        if self.ahead:
+            self.ahead -= self._below(count)
+        self.acknowledged >>= count
+        self.position += count
+
+class ConsumerGroup:
+    # members share one cursor, a message is leased to one member at a time and becomes
+    # visible to the others again when the lease runs out before it is acknowledged
+    __slots__ = ('name', 'cursor', 'visibility_timeout', 'leases', 'lease_expiry')
+
+    def __init__(self, name: str, visibility_timeout: int, cursor: Cursor = None):
+        self.name = name
+        self.cursor = cursor or Cursor()
+        self.visibility_timeout = visibility_timeout
+        self.leases: dict[int, tuple[str, float]] = {} # seq -> (session_id, monotonic deadline)
+        self.lease_expiry: list[tuple[float, int]] = [] # heap of (deadline, seq), stale entries are skipped
+
+    def available(self, topic: Topic, now: float):
+        # unacknowledged messages nobody holds a lease on, callers must hold topic.lock
+        for message in self.cursor.pending(topic):
+            lease = self.leases.get(message.seq)
+            if not lease or lease[1] <= now:
+                yield message
+
+    def lease(self, seq: int, session_id: str, now: float) -> bool:
+        # callers must hold topic.lock
+        lease = self.leases.get(seq)
+        if lease and lease[1] > now:
+            return False
+        deadline = now + self.visibility_timeout
+        self.leases[seq] = (session_id, deadline)
+        heapq.heappush(self.lease_expiry, (deadline, seq))
+        return True
+
+    def acknowledge(self, session_id: str, seq: int, now: float) -> bool:
+        # a message leased to another member cannot be acknowledged until the lease runs out
+        lease = self.leases.get(seq)
+        if lease and lease[0] != session_id and lease[1] > now:
+            return False
+        self.leases.pop(seq, None)
+        self.cursor.acknowledge(seq)
+        return True
+
+    def held_by(self, session_id: str) -> list[int]:
+        return [seq for seq, (holder, _) in self.leases.items() if holder == session_id]
+
+    def release(self, session_id: str):
+        for seq in self.held_by(session_id):
+            del self.leases[seq]
+
+    def expire_leases(self, now: float) -> bool:
+        expired = False
+        while self.lease_expiry and self.lease_expiry[0][0] <= now:
+            deadline, seq = heapq.heappop(self.lease_expiry)
+            lease = self.leases.get(seq)
+            if lease and lease[1] == deadline:
+                del self.leases[seq]
+                expired = True
+        return expired
+
+    def to_list(self) -> list:
+        return [self.visibility_timeout] + self.cursor.to_list()
+
+    @staticmethod
+    def from_list(name: str, state: list) -> 'ConsumerGroup':
+        return ConsumerGroup(name, state[0], Cursor.from_list(state[1:]))
+
+class TopicFilter:
+    # a wildcard subscription shared by every session using it, topics lists the matching topics
+    # in the order they appeared, so a session only has to look at the ones added since its last visit
+    __slots__ = ('pattern', 'lock', 'topics', 'waiters', 'sessions')
+
+    def __init__(self, pattern: str, topics: list[str] = None):
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.topics: list[str] = topics or []
+        self.waiters: set[Session] = set() # sessions blocked in receive until a matching topic appears
+        self.sessions = 0 # subscribed sessions, the filter is dropped when the last one leaves
+
 class Session:
-    def __init__(self, session_id: str = None):
+    __slots__ = ('session_id', 'lock', 'subscribed_topics', 'cursors', 'groups', 'filters', 'matched', 'excluded',
+                 'last_active', '_wakeup')
+
+    def __init__(self, session_id: str = None, lock: threading.Lock = None):
         if not session_id:
             session_id = str(uuid4())
         self.session_id = session_id
+        self.lock = lock or threading.Lock()
         self.subscribed_topics: set[str] = set()
-        self.acknowledged_messages: set[str] = set()
+        self.cursors: dict[str, Cursor] = {} # topic -> Cursor, kept across unsubscribe
+        self.groups: dict[str, str] = None # topic -> consumer group, only for sessions that joined one
+        self.filters: dict[str, int] = None # wildcard filter -> how many of its topics were subscribed so far
+        self.matched: dict[str, str] = None # topic -> the filter that subscribed it
+        self.excluded: dict[str, set[str]] = None # filter -> matching topics unsubscribed one by one, left alone
         self.last_active = int(time.time())
+        self._wakeup: threading.Event = None # only sessions that ever long-poll need one
+
+    @property
+    def wakeup(self) -> threading.Event:
+        # callers must hold self.lock
+        if self._wakeup is None:
+            self._wakeup = threading.Event()
+        return self._wakeup
+
+    @wakeup.setter
+    def wakeup(self, wakeup):
+        # the asyncio engine installs an event that wakes its loop, anything with set/clear works
+        self._wakeup = wakeup
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
     
     def refresh(self):
         self.last_active = int(time.time())
     
-    def subscribe(self, topic: str) -> bool:
+    def subscribe(self, topic: str, group: str = None) -> bool:
         if topic in self.subscribed_topics:
             return False
         self.subscribed_topics.add(topic)
+        if group:
+            # the group's cursor is used instead of one of our own
+            if self.groups is None:
+                self.groups = {}
+            self.groups[topic] = group
+        elif topic not in self.cursors:
+            self.cursors[topic] = Cursor()
         return True
 
     def unsubscribe(self, topic: str) -> bool:
+        if not self._drop(topic):
+            return False
+        # our filters must not bring it back, not even after they start over
+        for pattern in self.filters or ():
+            if matches(pattern, topic):
+                if self.excluded is None:
+                    self.excluded = {}
+                self.excluded.setdefault(pattern, set()).add(topic)
+        return True
+
+    def _drop(self, topic: str) -> bool:
         if topic in self.subscribed_topics:
             self.subscribed_topics.remove(topic)
+            if self.groups:
+                self.groups.pop(topic, None)
+            if self.matched:
+                self.matched.pop(topic, None)
             return True
         return False
+
+    def subscribe_filter(self, pattern: str) -> bool:
+        if self.filters is None:
+            self.filters = {}
+        if pattern in self.filters:
+            return False
+        self.filters[pattern] = 0
+        return True
+
+    def filter_state(self) -> dict[str, list[str]]:
+        # filter -> the topics it leaves alone, what the log and snapshots keep of the filters
+        return {pattern: sorted((self.excluded or {}).get(pattern, ())) for pattern in self.filters or ()}
+
+    def restore_filters(self, filters: dict[str, list[str]]):
+        # every filter looks at all of its topics again after a restart, skipping the ones that were left
+        self.filters = {pattern: 0 for pattern in filters} or None
+        self.excluded = {pattern: set(topics) for pattern, topics in filters.items() if topics} or None
+
+    def match(self, topic: str, pattern: str) -> bool:
+        # a topic that appeared under one of our filters, unless it is subscribed already or was left
+        if (self.excluded and topic in self.excluded.get(pattern, ())) or not self.subscribe(topic):
+            return False
+        if self.matched is None:
+            self.matched = {}
+        self.matched[topic] = pattern
+        return True
+
+    def unsubscribe_filter(self, pattern: str) -> bool:
+        # the topics the filter brought in go with it
+        if not self.filters or pattern not in self.filters:
+            return False
+        del self.filters[pattern]
+        if self.excluded:
+            self.excluded.pop(pattern, None)
+        for topic in [topic for topic, matched_by in (self.matched or {}).items() if matched_by == pattern]:
+            self._drop(topic)
+        # some of them may match another filter of ours, which then picks them up again
+        for other in self.filters:
+            self.filters[other] = 0
+        return True
+
+    def group(self, topic: str) -> str:
+        return self.groups.get(topic) if self.groups else None
     
-    def acknowledge(self, topic_name: str, message_id: str) -> bool:
-        if topic_name in self.subscribed_topics:
-            self.acknowledged_messages.add(message_id)
+    def acknowledge(self, topic_name: str, seq: int) -> bool:
+        if topic_name in self.subscribed_topics and topic_name in self.cursors:
+            self.cursors[topic_name].acknowledge(seq)
+            return True
+        return False
+
+    def acknowledge_up_to(self, topic_name: str, seq: int) -> bool:
+        if topic_name in self.subscribed_topics and topic_name in self.cursors:
+            self.cursors[topic_name].acknowledge_up_to(seq)
             return True
         return False
@@ -0,0 +1,95 @@
+# Bounded receives. A page holds at most max_messages messages and about max_bytes of data, oldest first.
+# The continuation token carries the last sequence number handed out per topic, so the next page starts
+# after them even though nothing was acknowledged yet, and stays valid however the backlog changes.
+# The admin listing uses the same tokens and streams its pages as NDJSON.
+from typing import Callable, Iterable, Iterator
+import base64
+import json
+from .config import SERVER_SETTINGS
+from .encoder import dumps
+from .models import Message
+
+def take(messages: Iterable[Message], max_messages: int = None, max_bytes: int = None) -> list[Message]:
+    # the first message is always taken, so an oversized one cannot stall a consumer forever
+    page: list[Message] = []
+    size = 0
+    for message in messages:
+        if max_messages is not None and len(page) >= max_messages:
+            break
+        if max_bytes is not None:
+            size += message.size
+            if size > max_bytes and page:
+                break
+        page.append(message)
+    return page
+
+def encode_token(after: dict[str, int]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(after, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_token(token: str) -> dict[str, int]:
+    try:
+        after = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('invalid continuation token')
+    if not isinstance(after, dict) or not all(isinstance(seq, int) for seq in after.values()):
+        raise ValueError('invalid continuation token')
+    return after
+
+def advance(after: dict[str, int], messages: list[Message]) -> dict[str, int]:
+    after = dict(after or {})
+    for message in messages:
+        if message.seq > after.get(message.topic, -1):
+            after[message.topic] = message.seq
+    return after
+
+def admin_query(args, topic: str) -> dict:
+    # the arguments of an admin listing: cursor, max_messages, start and end in seconds, acknowledged
+    query = {'after': None, 'max_messages': None, 'start': None, 'end': None, 'acknowledged': None}
+    if 'cursor' in args:
+        query['after'] = decode_token(args['cursor']).get(topic)
+    if args.get('max_messages') is not None:
+        query['max_messages'] = int(args['max_messages'])
+        if query['max_messages'] <= 0:
+            raise ValueError('max_messages must be positive')
+    for name in ('start', 'end'):
+        if args.get(name) is not None:
+            try:
+                query[name] = float(args[name])
+            except ValueError:
+                raise ValueError(f'{name} must be a timestamp')
+    if args.get('acknowledged') is not None:
+        query['acknowledged'] = args['acknowledged'].lower() in ('1', 'true', 'yes')
+    return query
+
+def admin_lines(get_messages: Callable, topic: str, after: int = None, max_messages: int = None, start: float = None,
+                end: float = None, acknowledged: bool = None) -> Iterator[str]:
+    # one JSON message per line, taken from the queue a page at a time so no lock is held for long.
+    # Listings cut short by max_messages end with a {"next": token} line to continue from.
+    sent = 0
+    while True:
+        limit = SERVER_SETTINGS['ADMIN_PAGE_SIZE']
+        if max_messages is not None:
+            limit = min(limit, max_messages - sent)
+        messages, after = get_messages(topic, after, limit, start, end, acknowledged)
+        sent += len(messages)
+        if messages:
+            yield ''.join(dumps(message).decode() + '\n' for message in messages)
+        if after is None:
+            return
+        if max_messages is not None and sent >= max_messages:
+            yield dumps({'next': encode_token({topic: after})}).decode() + '\n'
+            return
+
+def receive_limits(args) -> tuple[int, int]:
+    # max_messages and max_bytes request arguments, capped by the server settings
+    limits = []
+    for name, cap in (('max_messages', SERVER_SETTINGS['MAX_RECEIVE_MESSAGES']), ('max_bytes', SERVER_SETTINGS['MAX_RECEIVE_BYTES'])):
+        value = args.get(name)
+        if value is None:
+            limits.append(cap)
+            continue
+        value = int(value)
+        if value <= 0:
+            raise ValueError(f'{name} must be positive')
+        limits.append(min(value, cap))
+    return limits[0], limits[1]
@@ -0,0 +1,388 @@
+# Partitioned mode: topics are consistent-hashed onto worker processes that each own a MessageQueue and
+# serve it over a unix socket. The HTTP processes hold no queue state, they route every call through
+# PartitionedMessageQueue, so any number of them (gunicorn -w N httpmq.server:app) see the same queue.
+# A session lives on its home partition (hashed by session id) and on every partition owning one of its
+# topics; receive fans in over all of them.
+# Start the workers with python -m httpmq.partition, then set PARTITIONS in the server config.
+from multiprocessing.connection import Client, Connection, Listener, wait
+from bisect import bisect
+from functools import lru_cache
+from uuid import uuid4
+import hashlib
+import heapq
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from .config import SERVER_SETTINGS, topic_retention
+from .message_queue import MessageQueue
+from .models import Message, Topic
+from .pagination import take
+from .storage import SegmentLog
+from .topics import is_filter
+
+def partition_address(directory: str, index: int) -> str:
+    return os.path.join(directory, f'partition-{index}.sock')
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'little')
+
+class HashRing:
+    # each node owns many points on the ring, so adding or removing a partition only moves the topics
+    # between its points and their predecessors instead of rehashing everything
+    REPLICAS = 128
+
+    def __init__(self, nodes: int, replicas: int = None):
+        replicas = replicas or self.REPLICAS
+        points = sorted((_hash(f'{node}:{replica}'), node) for node in range(nodes) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+        self.node = lru_cache(maxsize=65536)(self._node)
+
+    def _node(self, key: str) -> int:
+        index = bisect(self.hashes, _hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+class PartitionWorker:
+    # serves one MessageQueue, every call returns plain tuples that pickle cheaply
+    INTERRUPTED_TTL = 60 # seconds an interrupt is kept for a receive that has not arrived yet
+
+    def __init__(self, mq: MessageQueue):
+        self.mq = mq
+        self.lock = threading.Lock()
+        self.receiving: dict[str, set[threading.Event]] = {} # session_id -> cancel events of waiting receives
+        self.polls: dict[str, threading.Event] = {} # token -> cancel event of a waiting receive
+        self.interrupted: dict[str, float] = {} # token -> when it was interrupted before its receive got here
+        self.handlers = {
+            'has_session': self.has_session,
+            'register': self.register,
+            'publish_many': self.publish_many,
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+            'get_subscriptions': self.mq.get_subscriptions,
+            'acknowledge_many': self.mq.acknowledge_many,
+            'acknowledge_up_to': self.mq.acknowledge_up_to,
+            'receive': self.receive,
+            'interrupt': self.interrupt,
+            'get_messages': self.get_messages,
+            'get_topics': self.mq.get_topics,
+            'get_lag': self.mq.get_lag,
+        }
+
+    def serve(self, address: str, authkey: bytes):
+        with Listener(address, 'AF_UNIX', authkey=authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError):
+                    # a failed handshake only loses that client
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection: Connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (True, self.handlers[method](*args))
+                except Exception as exception:
+                    reply = (False, exception)
+                connection.send(reply)
+
+    def has_session(self, session_id: str) -> bool:
+        return session_id in self.mq.sessions
+
+    def register(self, session_id: str) -> str:
+        return self.mq.register(session_id)
+
+    def publish_many(self, messages: list[tuple[str, any, int]]) -> list[tuple[int, int, int]]:
+        return [(message.topic_ref.key, message.seq, message.created_ms) for message in self.mq.publish_many(messages)]
+
+    def subscribe(self, session_id: str, topic: str, group: str = None, visibility_timeout: int = None) -> bool:
+        # the first subscription to a topic of this partition brings the session here
+        if session_id not in self.mq.sessions:
+            self.mq.register(session_id)
+        return self.mq.subscribe(session_id, topic, group, visibility_timeout)
+
+    def unsubscribe(self, session_id: str, topic: str) -> bool:
+        return self.mq.unsubscribe(session_id, topic)
+
+    def receive(self, session_id: str, timeout: float, after: dict[str, int], max_messages: int,
+                max_bytes: int, token: str = None) -> list[tuple]:
+        # None tells the caller the session has nothing on this partition. The token names this receive
+        # for interrupt(), which may get here first.
+        if session_id not in self.mq.sessions:
+            return None
+        cancel = threading.Event()
+        with self.lock:
+            if token is not None:
+                if self.interrupted.pop(token, None) is not None:
+                    return []
+                self.polls[token] = cancel
+            self.receiving.setdefault(session_id, set()).add(cancel)
+        try:
+            messages = self.mq.receive(session_id, timeout, after, max_messages, max_bytes, cancel)
+        finally:
+            with self.lock:
+                waiting = self.receiving[session_id]
+                waiting.discard(cancel)
+                if not waiting:
+                    del self.receiving[session_id]
+                if token is not None:
+                    del self.polls[token]
+        return [(message.topic, message.topic_ref.key, message.seq, message.created_ms, message.ttl, message.data)
+                for message in messages]
+
+    def interrupt(self, session_id: str, token: str = None):
+        # without a token every waiting receive of the session starts over
+        with self.lock:
+            if token is None:
+                waiting = list(self.receiving.get(session_id, ()))
+            elif token in self.polls:
+                waiting = [self.polls[token]]
+            else:
+                # the receive has not arrived yet, or already returned and the entry ages out
+                now = time.monotonic()
+                self.interrupted = {other: at for other, at in self.interrupted.items() if now - at < self.INTERRUPTED_TTL}
+                self.interrupted[token] = now
+                waiting = []
+        for cancel in waiting:
+            cancel.set()
+        session = self.mq._session(session_id)
+        if session:
+            session.wake()
+
+    def get_messages(self, topic: str, *args) -> tuple[list[dict], int]:
+        return self.mq.get_messages(topic, *args)
+
+class PartitionClient:
+    # a pool of connections to one worker, a connection carries one call at a time
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.idle: list[Connection] = []
+
+    def call(self, method: str, *args) -> any:
+        return self.finish(self.start(method, *args))
+
+    def start(self, method: str, *args) -> Connection:
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            connection = Client(self.address, 'AF_UNIX', authkey=self.authkey)
+        connection.send((method, args))
+        return connection
+
+    def finish(self, connection: Connection) -> any:
+        try:
+            ok, result = connection.recv()
+        except (EOFError, OSError):
+            connection.close()
+            raise
+        with self.lock:
+            self.idle.append(connection)
+        if not ok:
+            raise result
+        return result
+
+class PartitionedSessions:
+    # stands in for MessageQueue.sessions in the membership checks of the server
+    def __init__(self, mq: 'PartitionedMessageQueue'):
+        self.mq = mq
+
+    def __contains__(self, session_id: str) -> bool:
+        return bool(session_id) and self.mq._home(session_id).call('has_session', session_id)
+
+class PartitionedMessageQueue:
+    # the MessageQueue interface the server uses, backed by the partition workers
+    TRACED_METHODS = ('register', 'publish_many', 'subscribe', 'unsubscribe', 'acknowledge_many', 'acknowledge_up_to',
+                      'get_subscriptions', 'get_messages', 'get_topics', 'get_lag')
+    TRACED_LOCKS = ()
+    TRACED_LOCK_OWNERS = ()
+    TRACED_LOCK_FACTORY = None
+
+    def __init__(self, directory: str, partitions: int, authkey: bytes = None):
+        authkey = authkey or SERVER_SETTINGS['AUTH_KEY'].encode()
+        self.partitions = [PartitionClient(partition_address(directory, index), authkey) for index in range(partitions)]
+        self.ring = HashRing(partitions)
+        self.sessions = PartitionedSessions(self)
+        self.topics: dict[str, Topic] = {} # name -> stand-in Topic, only its name and key are used
+
+    def start_reaper(self):
+        # every worker runs its own reaper
+        pass
+
+    def register(self, session_id: str) -> str:
+        return self._home(session_id).call('register', session_id)
+
+    def publish(self, topic: str, data: any, ttl: int = 3600) -> Message:
+        return self.publish_many([(topic, data, ttl)])[0]
+
+    def publish_many(self, messages: list[tuple[str, any, int]]) -> list[Message]:
+        by_partition: dict[int, list[int]] = {}
+        for index, (topic, _, _) in enumerate(messages):
+            by_partition.setdefault(self.ring.node(topic), []).append(index)
+        calls = [(partition, indexes, self.partitions[partition].start('publish_many', [messages[index] for index in indexes]))
+                 for partition, indexes in by_partition.items()]
+        published: list[Message] = [None] * len(messages)
+        for partition, indexes, connection in calls:
+            results = self.partitions[partition].finish(connection)
+            for index, (key, seq, created_ms) in zip(indexes, results):
+                topic, data, ttl = messages[index]
+                published[index] = Message(self._topic(topic, key), data, ttl, created_ms, seq)
+        return published
+
+    def subscribe(self, session_id: str, topic: str, group: str = None, visibility_timeout: int = None) -> bool:
+        # a consumer group lives with its topic, so its members meet on the topic's partition
+        if session_id not in self.sessions:
+            return False
+        if is_filter(topic):
+            if group:
+                raise ValueError('a consumer group needs a topic, not a filter')
+            # matching topics may live on any partition, each one expands the filter over its own
+            subscribed = any(self._all('subscribe', session_id, topic))
+            if subscribed:
+                self._home(session_id).call('interrupt', session_id)
+            return subscribed
+        partition = self.ring.node(topic)
+        subscribed = self.partitions[partition].call('subscribe', session_id, topic, group, visibility_timeout)
+        if subscribed and partition != self.ring.node(session_id):
+            # a receive already waiting does not know about this partition yet, make it start over
+            self._home(session_id).call('interrupt', session_id)
+        return subscribed
+
+    def unsubscribe(self, session_id: str, topic: str) -> bool:
+        if is_filter(topic):
+            return any(self._all('unsubscribe', session_id, topic))
+        return self.partitions[self.ring.node(topic)].call('unsubscribe', session_id, topic)
+
+    def get_subscriptions(self, session_id: str) -> list[str]:
+        results = self._all('get_subscriptions', session_id)
+        if results[self.ring.node(session_id)] is None:
+            return None
+        # every partition reports the session's filters
+        return list(dict.fromkeys(topic for topics in results if topics for topic in topics))
+
+    def acknowledge(self, session_id: str, topic_name: str, message_id: str) -> bool:
+        return self.acknowledge_many(session_id, [(topic_name, message_id)])[0]
+
+    def acknowledge_many(self, session_id: str, acknowledgements: list[tuple[str, str]]) -> list[bool]:
+        results = [False] * len(acknowledgements)
+        by_partition: dict[int, list[int]] = {}
+        for index, (topic, _) in enumerate(acknowledgements):
+            if isinstance(topic, str):
+                by_partition.setdefault(self.ring.node(topic), []).append(index)
+        for partition, indexes in by_partition.items():
+            acknowledged = self.partitions[partition].call('acknowledge_many', session_id,
+                                                           [acknowledgements[index] for index in indexes])
+            for index, result in zip(indexes, acknowledged):
+                results[index] = result
+        return results
+
+    def acknowledge_up_to(self, session_id: str, topic_name: str, seq: int) -> int:
+        return self.partitions[self.ring.node(topic_name)].call('acknowledge_up_to', session_id, topic_name, seq)
+
+    def receive(self, session_id: str, timeout: float = 0, after: dict[str, int] = None, max_messages: int = None,
+                max_bytes: int = None, encode: bool = False) -> list[Message]:
+        # every partition gives at most a page, leases on group messages cut here lapse after the visibility timeout.
+        # The messages are copies that live for one response, so encode has nothing to keep.
+        deadline = time.monotonic() + timeout
+        while True:
+            results = self._all('receive', session_id, 0, after, max_messages, max_bytes)
+            if results[self.ring.node(session_id)] is None:
+                return []
+            messages = take(self._merge(results), max_messages, max_bytes)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            # long-poll every partition the session is on, the first answer ends the wait for the others
+            spanned = [index for index, result in enumerate(results) if result is not None]
+            # the interrupt may reach a partition before the receive does, the token lets it wait there
+            token = uuid4().hex
+            calls = {self.partitions[index].start('receive', session_id, remaining, after, max_messages, max_bytes, token): index
+                     for index in spanned}
+            wait(list(calls))
+            for connection, index in calls.items():
+                if not connection.poll():
+                    self.partitions[index].call('interrupt', session_id, token)
+            messages = take(self._merge([self.partitions[index].finish(connection) for connection, index in calls.items()]),
+                            max_messages, max_bytes)
+            if messages:
+                return messages
+
+    def get_messages(self, topic: str, after: int = None, max_messages: int = None, start: float = None,
+                     end: float = None, acknowledged: bool = None) -> tuple[list[dict], int]:
+        return self.partitions[self.ring.node(topic)].call('get_messages', topic, after, max_messages, start, end,
+                                                           acknowledged)
+
+    def get_topics(self) -> list[str]:
+        return [topic for topics in self._all('get_topics') for topic in topics]
+
+    def get_lag(self, topic: str = None) -> list[dict]:
+        if topic is not None:
+            return self.partitions[self.ring.node(topic)].call('get_lag', topic)
+        return [lag for partition in self._all('get_lag') for lag in partition]
+
+    def _all(self, method: str, *args) -> list:
+        # the same call on every partition at once
+        connections = [partition.start(method, *args) for partition in self.partitions]
+        return [partition.finish(connection) for partition, connection in zip(self.partitions, connections)]
+
+    def _merge(self, results: list[list[tuple]]):
+        # every partition answers oldest first
+        return heapq.merge(*([Message(self._topic(topic, key), data, ttl, created_ms, seq)
+                              for topic, key, seq, created_ms, ttl, data in result]
+                             for result in results if result))
+
+    def _home(self, session_id: str) -> PartitionClient:
+        return self.partitions[self.ring.node(session_id)]
+
+    def _topic(self, name: str, key: int) -> Topic:
+        topic = self.topics.get(name)
+        if topic is None or topic.key != key:
+            # a worker restarted without a log hands out new keys
+            topic = self.topics[name] = Topic(name, key)
+        return topic
+
+def serve_partition(index: int, partitions: int, directory: str, data_dir: str = None, authkey: bytes = None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the supervisor decides when workers stop
+    storage = None
+    if data_dir:
+        storage = SegmentLog(os.path.join(data_dir, f'partition-{index}'), SERVER_SETTINGS['SEGMENT_BYTES'])
+    # every worker keeps its share of the memory budget
+    budget = SERVER_SETTINGS['MEMORY_BUDGET']
+    mq = MessageQueue(storage, topic_retention(), budget // partitions if budget is not None else None)
+    mq.start_reaper()
+    PartitionWorker(mq).serve(partition_address(directory, index), authkey or SERVER_SETTINGS['AUTH_KEY'].encode())
+
+def start_partitions(partitions: int, directory: str, data_dir: str = None) -> list[multiprocessing.Process]:
+    os.makedirs(directory, exist_ok=True)
+    for index in range(partitions):
+        # sockets left behind by a previous run
+        if os.path.exists(partition_address(directory, index)):
+            os.remove(partition_address(directory, index))
+    workers = [multiprocessing.Process(target=serve_partition, args=(index, partitions, directory, data_dir), daemon=True)
+               for index in range(partitions)]
+    for worker in workers:
+        worker.start()
+    # the servers connect as soon as they start, wait until every socket exists
+    for index in range(partitions):
+        while not os.path.exists(partition_address(directory, index)):
+            time.sleep(0.01)
+    return workers
+
+if __name__ == '__main__':
+    partitions = SERVER_SETTINGS['PARTITIONS'] or os.cpu_count()
+    workers = start_partitions(partitions, SERVER_SETTINGS['PARTITION_DIR'], SERVER_SETTINGS['DATA_DIR'])
+    print(f'{partitions} partitions listening in {SERVER_SETTINGS["PARTITION_DIR"]}')
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -1,11 +1,57 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template
 from uuid import uuid4
-from .config import SERVER_SETTINGS
-from .message_queue import MessageQueue
+import socket
+import threading
+import time
+from . import frames, handlers, pagination
+from .config import SERVER_SETTINGS, topic_retention
+from .message_queue import MessageQueue, QueueFull, TopicFull
+from .metrics import Registry
+from .tracing import Tracer
 from .models import Message, Session
+from .partition import PartitionedMessageQueue
+from .storage import SegmentLog
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 app = Flask(__name__)
-mq = MessageQueue()
+if SERVER_SETTINGS['PARTITIONS']:
+    # the queue lives in the partition workers, so any number of server processes can share it
+    mq = PartitionedMessageQueue(SERVER_SETTINGS['PARTITION_DIR'], SERVER_SETTINGS['PARTITIONS'])
+else:
+    storage = None
+    if SERVER_SETTINGS['DATA_DIR']:
+        storage = SegmentLog(SERVER_SETTINGS['DATA_DIR'], SERVER_SETTINGS['SEGMENT_BYTES'])
+    mq = MessageQueue(storage, topic_retention(), SERVER_SETTINGS['MEMORY_BUDGET'], SERVER_SETTINGS['LOCK_METRICS'])
+    mq.start_reaper()
+tracer = Tracer(SERVER_SETTINGS['SLOW_OP_SECONDS'], SERVER_SETTINGS['TRACE_PROFILE_RATE'])
+if SERVER_SETTINGS['TRACING']:
+    tracer.attach(mq, mq.TRACED_METHODS, mq.TRACED_LOCKS, mq.TRACED_LOCK_OWNERS, mq.TRACED_LOCK_FACTORY)
+
+http_metrics = Registry()
+request_seconds = http_metrics.histogram('httpmq_http_request_duration_seconds', 'Time to produce a response',
+                                         ('endpoint', 'method'))
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    # long-polls and streams mostly wait, the queue calls they make are traced on their own
+    if tracer.enabled and not request.args.get('timeout') and request.endpoint not in ('stream', 'websocket'):
+        g.trace = tracer.span(f'http {request.endpoint or "unmatched"}')
+        g.span = g.trace.__enter__()
+
+@app.after_request
+def record_latency(response: Response) -> Response:
+    # streams are timed until their response starts, long-polls include the wait
+    if 'start' in g:
+        request_seconds.observe(time.perf_counter() - g.start, (request.endpoint or 'unmatched', request.method))
+    if 'trace' in g:
+        g.span.bytes += response.content_length or 0
+        g.pop('trace').__exit__(None, None, None)
+    return response
 
 def validate_admin():
     if request.args.get("key") == SERVER_SETTINGS["AUTH_KEY"]:
@@ -16,97 +62,165 @@ def validate_admin():
         return True
     return False
 
+@app.errorhandler(QueueFull)
+def queue_full(error: QueueFull):
+    # 429 slows down the producers of one full topic, 503 means the whole server is out of memory budget
+    status = 429 if isinstance(error, TopicFull) else 503
+    return jsonify(error=error.reason), status, {'Retry-After': str(error.retry_after)}
+
+def reply(result: tuple[int, dict]):
+    status, payload = result
+    return jsonify(payload), status
+
+def session_id_arg() -> str:
+    return request.headers.get('Session-Id') or request.args.get('session_id')
+
 @app.route('/api/register', methods=['POST'])
 def register():
-    session_id = str(uuid4())
-    mq.register(session_id)
-    return jsonify(session_id=session_id), 200
+    return reply(handlers.register(mq))
 
 @app.route('/api/publish/<path:topic>', methods=['POST'])
 def publish(topic):
-    data = request.json.get('data')
-    ttl = SERVER_SETTINGS['DEFAULT_TTL']
-    if 'ttl' in request.json:
-        ttl_req = request.json.get('ttl')
-        if isinstance(ttl_req, int):
-            ttl = ttl_req
-        if isinstance(ttl_req, str) and ttl_req.lstrip('-').isdigit():
-            ttl = int(ttl_req)
-        if ttl < 0:
-            ttl = SERVER_SETTINGS['NEVER_EXPIRE_TTL']
-    message = mq.publish(topic, data, ttl)
-    return jsonify(status='success', message_id=message.message_id, timestamp=message.timestamp), 200
+    return reply(handlers.publish(mq, topic, request.json))
+
+@app.route('/api/publish', methods=['POST'])
+def publish_many():
+    return reply(handlers.publish_many(mq, request.json))
 
 @app.route('/api/subscribe', methods=['GET'])
 def get_subscribe():
-    session_id = request.headers.get('Session-Id')
-    if not session_id:
-        session_id = request.args.get('session_id')
-    session = mq.sessions.get(session_id)
-    if session:
-        return jsonify({'topics': list(session.subscribed_topics)}), 200
-    else:
-        return jsonify({'error': 'session_id not found'}), 400
+    return reply(handlers.get_subscriptions(mq, session_id_arg()))
 
 @app.route('/api/subscribe/<path:topic>', methods=['POST'])
 def subscribe(topic):
-    session_id = request.headers.get('Session-Id')
-    if not session_id:
-        data = request.get_json(force=True)
-        session_id = data.get('session_id')
-    if session_id in mq.sessions:
-        if mq.subscribe(session_id, topic):
-            return jsonify({'status': 'subscribed'}), 200
-        else:
-            return jsonify({'error': 'topic not found'}), 404
-    else:
-        return jsonify({'error': 'session_id not found'}), 400
+    data = request.get_json(force=True, silent=True) or {}
+    return reply(handlers.subscribe(mq, topic, request.headers.get('Session-Id') or data.get('session_id'), data))
 
 @app.route('/api/subscribe/<path:topic>', methods=['DELETE'])
 def unsubscribe(topic):
-    session_id = request.json.get('session_id')
-    if mq.unsubscribe(session_id, topic):
-        return jsonify(status='success'), 200
-    else:
-        return jsonify(error='topic or subscription not found'), 404
+    return reply(handlers.unsubscribe(mq, topic, request.json))
 
 @app.route('/api/receive', methods=['GET'])
 def receive():
-    mq.expire()
-    session_id = request.headers.get('Session-Id')
-    if not session_id:
-        session_id = request.args.get('session_id')
+    session_id = session_id_arg()
+    try:
+        timeout, after, max_messages, max_bytes = handlers.receive_query(request.args)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
     if session_id in mq.sessions:
-        messages = mq.receive(session_id)
-        return jsonify({'messages': [message.to_dict() for message in messages]}), 200
+        messages = mq.receive(session_id, timeout, after, max_messages, max_bytes, encode=True)
+        return Response(handlers.receive_body(after, messages), mimetype='application/json'), 200
     else:
         return jsonify({'error': 'session not found'}), 404
 
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    session_id = session_id_arg()
+    if session_id not in mq.sessions:
+        return jsonify({'error': 'session not found'}), 404
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_messages(session_id, handlers.auto_ack(request.args)), mimetype='text/event-stream',
+                    headers=headers)
+
+def stream_messages(session_id: str, auto_ack: bool):
+    # Server-Sent Events, oldest message first, each message is delivered once per stream
+    delivered: dict[str, int] = {} # topic -> last seq sent on this stream
+    yield ': connected\n\n'
+    while session_id in mq.sessions:
+        messages = mq.receive(session_id, SERVER_SETTINGS['STREAM_KEEPALIVE'], delivered,
+                              SERVER_SETTINGS['MAX_RECEIVE_MESSAGES'], SERVER_SETTINGS['MAX_RECEIVE_BYTES'], encode=True)
+        if not messages:
+            # also lets the server notice a closed connection
+            yield ': keep-alive\n\n'
+            continue
+        batch = handlers.last_seqs(messages)
+        delivered.update(batch)
+        yield handlers.stream_events(messages)
+        if auto_ack:
+            for topic, seq in batch.items():
+                mq.acknowledge_up_to(session_id, topic, seq)
+
+if Sock:
+    sock = Sock(app)
+
+    @sock.route('/api/ws')
+    def websocket(ws):
+        session_id = session_id_arg()
+        if session_id not in mq.sessions:
+            session_id = str(uuid4())
+            mq.register(session_id)
+        # replies and pushes are small frames, do not let Nagle hold them back
+        ws.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_lock = threading.Lock()
+        def send(data: bytes):
+            # the reader and the pusher thread share the connection
+            with send_lock:
+                ws.send(data)
+        send(frames.encode_frame(frames.OP_SESSION, 0, session_id.encode()))
+        closed = threading.Event()
+        threading.Thread(target=push_frames, args=(session_id, send, closed), daemon=True).start()
+        try:
+            while True:
+                data = ws.receive()
+                if isinstance(data, str):
+                    data = data.encode()
+                send(handlers.handle_frames(mq, session_id, data))
+        finally:
+            closed.set()
+
+def push_frames(session_id: str, send, closed: threading.Event):
+    delivered: dict[str, int] = {} # topic -> last seq pushed on this connection
+    while not closed.is_set() and session_id in mq.sessions:
+        # a short wait so the thread notices the connection closing
+        messages = mq.receive(session_id, 1, delivered, SERVER_SETTINGS['MAX_RECEIVE_MESSAGES'],
+                              SERVER_SETTINGS['MAX_RECEIVE_BYTES'])
+        if not messages:
+            continue
+        delivered.update(handlers.last_seqs(messages))
+        try:
+            send(handlers.message_frames(messages))
+        except Exception:
+            return
+
 @app.route('/api/acknowledge', methods=['POST'])
 def acknowledge():
-    session_id = request.json.get('session_id')
-    topic_name = request.json.get('topic')
-    message_id = request.json.get('message_id')
-    if not session_id or not message_id or not topic_name:
-        return jsonify(error='bad request'), 400
-    if mq.acknowledge(session_id, topic_name, message_id):
-        return jsonify(status='success'), 200
-    else:
-        return jsonify(error='message invalid or not found'), 404
+    return reply(handlers.acknowledge(mq, request.json))
 
 @app.route('/api/admin/topics', methods=['GET'])
 def admin_topics():
     if not validate_admin():
         return jsonify(error='Unauthorized'), 401
-    topics = [topic for topic in mq.get_topics()]
-    return jsonify(topics=topics), 200
+    return reply(handlers.admin_topics(mq))
+
+@app.route('/api/admin/lag', methods=['GET'])
+def admin_lag():
+    if not validate_admin():
+        return jsonify(error='Unauthorized'), 401
+    return reply(handlers.admin_lag(mq, request.args))
 
 @app.route('/api/admin/messages/<path:topic>', methods=['GET'])
 def admin_messages(topic):
     if not validate_admin():
         return jsonify(error='Unauthorized'), 401
-    messages = mq.get_messages(topic)
-    return jsonify(messages=[message for message in messages]), 200
+    try:
+        query = pagination.admin_query(request.args, topic)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    return Response(pagination.admin_lines(mq.get_messages, topic, **query), mimetype='application/x-ndjson'), 200
+
+@app.route('/api/admin/trace', methods=['GET', 'POST'])
+def admin_trace():
+    if not validate_admin():
+        return jsonify(error='Unauthorized'), 401
+    return reply(handlers.admin_trace(mq, tracer, request.json if request.method == 'POST' else None))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not validate_admin():
+        return jsonify(error='Unauthorized'), 401
+    # a partitioned queue keeps its metrics in the worker processes
+    body = (mq.metrics.render() if isinstance(mq, MessageQueue) else '') + http_metrics.render()
+    return Response(body, mimetype='text/plain; version=0.0.4'), 200
 
 @app.route('/')
 def index():
@@ -121,4 +235,5 @@ def tool():
     return app.send_static_file('tool.html')
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # the reloader imports this module in a second process, which must not open the same log
+    app.run(debug=True, use_reloader=not SERVER_SETTINGS['DATA_DIR'] or SERVER_SETTINGS['PARTITIONS'])
@@ -0,0 +1,197 @@
+from zlib import crc32
+import mmap
+import os
+import struct
+from .storage import fsync_directory
+
+# Snapshot layout, every integer little-endian:
+#   header: magic, version, log position the snapshot was started at, topic count, session count
+#   topic: name, key, next_seq, message count, then per message seq, created_ms, ttl, data kind, data,
+#          then per consumer group name, visibility timeout, position, ack bitmap
+#   session: session id, subscribed topics, then per cursor topic, position, ack bitmap,
+#            then per joined group topic, group name, then per wildcard filter the filter and the topics
+#            it leaves alone, then per matched topic, filter
+#   trailer: crc32 of everything between the header and the trailer
+# Strings and blobs are length-prefixed, so a loader can walk a memory map without copying the file.
+MAGIC = b'HMQS'
+VERSION = 3
+HEADER = struct.Struct('<4sHQII')
+TOPIC = struct.Struct('<QQI')
+MESSAGE = struct.Struct('<QqqBI')
+CURSOR = struct.Struct('<QI')
+GROUP = struct.Struct('<IQI')
+COUNT = struct.Struct('<I')
+LENGTH = struct.Struct('<H')
+TRAILER = struct.Struct('<I')
+
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_SUFFIX = '.snap'
+
+def snapshot_path(directory: str, lsn: int) -> str:
+    return os.path.join(directory, f'{SNAPSHOT_PREFIX}{lsn:020d}{SNAPSHOT_SUFFIX}')
+
+def list_snapshots(directory: str) -> list[tuple[int, str]]:
+    snapshots = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            lsn = int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)])
+            snapshots.append((lsn, os.path.join(directory, name)))
+    snapshots.sort()
+    return snapshots
+
+def _pack_str(value: str) -> bytes:
+    encoded = value.encode()
+    return LENGTH.pack(len(encoded)) + encoded
+
+class SnapshotWriter:
+    def __init__(self, path: str, lsn: int):
+        self.path = path
+        self.lsn = lsn
+        self.file = open(path + '.tmp', 'wb')
+        self.checksum = 0
+        self.topic_count = 0
+        self.session_count = 0
+        self.file.write(HEADER.pack(MAGIC, VERSION, lsn, 0, 0))
+
+    def write_topic(self, name: str, key: int, next_seq: int, messages: list[tuple[int, int, int, tuple[int, bytes]]],
+                    groups: dict[str, tuple[int, int, int]] = None):
+        chunks = [_pack_str(name), TOPIC.pack(key, next_seq, len(messages))]
+        for seq, created_ms, ttl, (kind, data) in messages:
+            chunks.append(MESSAGE.pack(seq, created_ms, ttl, kind, len(data)))
+            chunks.append(data)
+        groups = groups or {}
+        chunks.append(COUNT.pack(len(groups)))
+        for group, (visibility_timeout, position, acknowledged) in groups.items():
+            bitmap = acknowledged.to_bytes((acknowledged.bit_length() + 7) // 8, 'little')
+            chunks.append(_pack_str(group))
+            chunks.append(GROUP.pack(visibility_timeout, position, len(bitmap)))
+            chunks.append(bitmap)
+        self._write(b''.join(chunks))
+        self.topic_count += 1
+
+    def write_session(self, session_id: str, subscribed_topics: list[str], cursors: dict[str, tuple[int, int]],
+                      groups: dict[str, str] = None, filters: dict[str, list[str]] = None, matched: dict[str, str] = None):
+        chunks = [_pack_str(session_id), COUNT.pack(len(subscribed_topics))]
+        for topic in subscribed_topics:
+            chunks.append(_pack_str(topic))
+        chunks.append(COUNT.pack(len(cursors)))
+        for topic, (position, acknowledged) in cursors.items():
+            bitmap = acknowledged.to_bytes((acknowledged.bit_length() + 7) // 8, 'little')
+            chunks.append(_pack_str(topic))
+            chunks.append(CURSOR.pack(position, len(bitmap)))
+            chunks.append(bitmap)
+        groups = groups or {}
+        chunks.append(COUNT.pack(len(groups)))
+        for topic, group in groups.items():
+            chunks.append(_pack_str(topic))
+            chunks.append(_pack_str(group))
+        filters = filters or {}
+        chunks.append(COUNT.pack(len(filters)))
+        for pattern, excluded in filters.items():
+            chunks.append(_pack_str(pattern))
+            chunks.append(COUNT.pack(len(excluded)))
+            for topic in excluded:
+                chunks.append(_pack_str(topic))
+        matched = matched or {}
+        chunks.append(COUNT.pack(len(matched)))
+        for topic, pattern in matched.items():
+            chunks.append(_pack_str(topic))
+            chunks.append(_pack_str(pattern))
+        self._write(b''.join(chunks))
+        self.session_count += 1
+
+    def close(self):
+        self.file.write(TRAILER.pack(self.checksum))
+        # counts are only known at the end
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.lsn, self.topic_count, self.session_count))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+        # the rename must be durable before the caller removes what the snapshot replaces
+        fsync_directory(os.path.dirname(self.path) or '.')
+
+    def _write(self, chunk: bytes):
+        self.checksum = crc32(chunk, self.checksum)
+        self.file.write(chunk)
+
+class SnapshotReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.lsn, self.topic_count, self.session_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or self.version != VERSION:
+            raise ValueError(f'{path} is not a snapshot')
+        (checksum,) = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+        if crc32(self.map[HEADER.size:len(self.map) - TRAILER.size]) != checksum:
+            raise ValueError(f'{path} is corrupt')
+        self.offset = HEADER.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def topics(self):
+        # yields (name, key, next_seq, messages, groups) with messages as (seq, created_ms, ttl, kind, data)
+        # and groups as name -> (visibility_timeout, position, bitmap)
+        for _ in range(self.topic_count):
+            name = self._str()
+            key, next_seq, count = TOPIC.unpack_from(self.map, self.offset)
+            self.offset += TOPIC.size
+            messages = []
+            for _ in range(count):
+                seq, created_ms, ttl, kind, length = MESSAGE.unpack_from(self.map, self.offset)
+                self.offset += MESSAGE.size
+                messages.append((seq, created_ms, ttl, kind, self.map[self.offset:self.offset + length]))
+                self.offset += length
+            groups = {}
+            for _ in range(self._count()):
+                group = self._str()
+                visibility_timeout, position, length = GROUP.unpack_from(self.map, self.offset)
+                self.offset += GROUP.size
+                groups[group] = (visibility_timeout, position, int.from_bytes(self.map[self.offset:self.offset + length], 'little'))
+                self.offset += length
+            yield name, key, next_seq, messages, groups
+
+    def sessions(self):
+        # read after topics(), the sections are laid out back to back
+        # yields (session_id, subscribed_topics, cursors, groups, filters, matched) with cursors as
+        # topic -> (position, bitmap), groups as topic -> group name, filters as filter -> excluded topics
+        # and matched as topic -> filter
+        for _ in range(self.session_count):
+            session_id = self._str()
+            subscribed_topics = [self._str() for _ in range(self._count())]
+            cursors = {}
+            for _ in range(self._count()):
+                topic = self._str()
+                position, length = CURSOR.unpack_from(self.map, self.offset)
+                self.offset += CURSOR.size
+                cursors[topic] = (position, int.from_bytes(self.map[self.offset:self.offset + length], 'little'))
+                self.offset += length
+            groups = {}
+            for _ in range(self._count()):
+                topic = self._str()
+                groups[topic] = self._str()
+            filters = {}
+            for _ in range(self._count()):
+                pattern = self._str()
+                filters[pattern] = [self._str() for _ in range(self._count())]
+            matched = {}
+            for _ in range(self._count()):
+                topic = self._str()
+                matched[topic] = self._str()
+            yield session_id, subscribed_topics, cursors, groups, filters, matched
+
+    def _count(self) -> int:
+        (count,) = COUNT.unpack_from(self.map, self.offset)
+        self.offset += COUNT.size
+        return count
+
+    def _str(self) -> str:
+        (length,) = LENGTH.unpack_from(self.map, self.offset)
+        self.offset += LENGTH.size
+        value = self.map[self.offset:self.offset + length].decode()
+        self.offset += length
+        return value
@@ -0,0 +1,236 @@
+from zlib import crc32
+import json
+import os
+import struct
+import threading
+import time
+
+# Record layout: payload length, crc32 of the payload, record type, payload.
+HEADER = struct.Struct('<IIB')
+# PUBLISH payload: topic key, seq, created_ms, ttl, data kind, then the encoded data.
+PUBLISH = struct.Struct('<QQqqB')
+
+RECORD_PUBLISH = 1
+RECORD_TOPIC = 2
+RECORD_REGISTER = 3
+RECORD_SUBSCRIBE = 4
+RECORD_UNSUBSCRIBE = 5
+RECORD_ACK = 6
+RECORD_ACK_UP_TO = 7
+RECORD_SESSION = 8
+RECORD_SESSION_EXPIRED = 9
+RECORD_GROUP_ACK = 10
+RECORD_TRIM = 11
+RECORD_FILTER = 12
+RECORD_MATCH = 13
+
+DATA_STR = 0
+DATA_JSON = 1
+
+def encode_record(record_type: int, payload: bytes) -> bytes:
+    return HEADER.pack(len(payload), crc32(payload), record_type) + payload
+
+def encode_json(record_type: int, value: any) -> bytes:
+    return encode_record(record_type, json.dumps(value, separators=(',', ':')).encode())
+
+def encode_data(data: any) -> tuple[int, bytes]:
+    if isinstance(data, str):
+        return DATA_STR, data.encode()
+    return DATA_JSON, json.dumps(data, separators=(',', ':')).encode()
+
+def encode_publish(topic_key: int, seq: int, created_ms: int, ttl: int, data: tuple[int, bytes]) -> bytes:
+    kind, encoded = data
+    return encode_record(RECORD_PUBLISH, PUBLISH.pack(topic_key, seq, created_ms, ttl, kind) + encoded)
+
+def decode_data(kind: int, encoded: bytes) -> any:
+    data = encoded.decode()
+    if kind == DATA_JSON:
+        return json.loads(data)
+    return data
+
+def fsync_directory(directory: str):
+    # makes a created, renamed or removed file in the directory survive a crash
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def decode_publish(payload: bytes) -> tuple[int, int, int, int, any]:
+    topic_key, seq, created_ms, ttl, kind = PUBLISH.unpack_from(payload)
+    return topic_key, seq, created_ms, ttl, decode_data(kind, payload[PUBLISH.size:])
+
+class Segment:
+    def __init__(self, path: str, start_lsn: int):
+        self.path = path
+        self.start_lsn = start_lsn
+        self.size = 0
+        self.max_expire_ts = 0
+        self.sessions: set[str] = set() # sessions with records in this segment
+        self.topics: set[int] = set() # keys of topics with records in this segment
+        self.file = None
+        self.linked = True # False until the directory entry of a new segment is fsynced
+
+    def note(self, expire_ts: int = 0, session_id: str = None, topic_key: int = None):
+        if expire_ts > self.max_expire_ts:
+            self.max_expire_ts = expire_ts
+        if session_id is not None:
+            self.sessions.add(session_id)
+        if topic_key is not None:
+            self.topics.add(topic_key)
+
+class SegmentLog:
+    SEGMENT_SUFFIX = '.log'
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, group_commit_delay: float = 0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.group_commit_delay = group_commit_delay # extra time to gather records before each fsync
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.pending = threading.Condition(self.lock)
+        self.segments: list[Segment] = []
+        self.buffer: list[tuple[Segment, bytes]] = []
+        self.lsn = 0 # bytes appended
+        self.durable_lsn = 0 # bytes written and fsynced
+        self.flusher: threading.Thread = None
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(self.SEGMENT_SUFFIX):
+                start_lsn = int(name[:-len(self.SEGMENT_SUFFIX)])
+                segment = Segment(os.path.join(directory, name), start_lsn)
+                segment.size = os.path.getsize(segment.path)
+                self.segments.append(segment)
+        if self.segments:
+            self.lsn = self.durable_lsn = self.segments[-1].start_lsn + self.segments[-1].size
+
+    def replay(self, from_lsn: int = 0):
+        # yields (segment, record_type, payload), the caller rebuilds each segment's metadata through note(),
+        # a torn record at the end of the last segment is truncated away
+        for index, segment in enumerate(self.segments):
+            if segment.start_lsn + segment.size <= from_lsn:
+                continue
+            with open(segment.path, 'rb') as file:
+                data = file.read()
+            offset = max(from_lsn - segment.start_lsn, 0)
+            while offset + HEADER.size <= len(data):
+                length, checksum, record_type = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + length
+                payload = data[offset + HEADER.size:end]
+                if end > len(data) or crc32(payload) != checksum:
+                    break
+                yield segment, record_type, payload
+                offset = end
+            if offset < len(data):
+                if index != len(self.segments) - 1:
+                    raise ValueError(f'corrupt record in {segment.path} at offset {offset}')
+                with open(segment.path, 'r+b') as file:
+                    file.truncate(offset)
+                segment.size = offset
+        if self.segments:
+            self.lsn = self.durable_lsn = self.segments[-1].start_lsn + self.segments[-1].size
+
+    def start(self):
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.notify()
+        if self.flusher:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        for segment in self.segments:
+            if segment.file:
+                segment.file.close()
+                segment.file = None
+
+    def append(self, record: bytes, expire_ts: int = 0, session_id: str = None, topic_key: int = None) -> int:
+        with self.lock:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or (segment.size and segment.size + len(record) > self.segment_bytes):
+                segment = Segment(os.path.join(self.directory, f'{self.lsn:020d}{self.SEGMENT_SUFFIX}'), self.lsn)
+                segment.linked = False
+                self.segments.append(segment)
+            segment.size += len(record)
+            segment.note(expire_ts, session_id, topic_key)
+            self.buffer.append((segment, record))
+            self.lsn += len(record)
+            self.pending.notify()
+            return self.lsn
+
+    def wait(self, lsn: int):
+        with self.lock:
+            while self.durable_lsn < lsn and not self.closed:
+                self.flushed.wait()
+
+    def flush(self):
+        # group commit: everything appended since the last flush shares one write and one fsync per segment
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            lsn = self.lsn
+            active = self.segments[-1] if self.segments else None
+        touched: list[Segment] = []
+        for segment, record in buffer:
+            if segment.file is None:
+                segment.file = open(segment.path, 'ab')
+                touched.append(segment)
+            elif segment not in touched:
+                touched.append(segment)
+            segment.file.write(record)
+        created = False
+        for segment in touched:
+            segment.file.flush()
+            os.fsync(segment.file.fileno())
+            if not segment.linked:
+                segment.linked = created = True
+            if segment is not active:
+                segment.file.close()
+                segment.file = None
+        if created:
+            fsync_directory(self.directory)
+        with self.lock:
+            self.durable_lsn = lsn
+            self.flushed.notify_all()
+
+    def appended_lsn(self) -> int:
+        with self.lock:
+            return self.lsn
+
+    def truncate_before(self, lsn: int):
+        # drop sealed segments that end at or before lsn, a snapshot covers them
+        for segment in self.sealed_segments():
+            if segment.start_lsn + segment.size <= lsn:
+                self.delete(segment)
+
+    def sealed_segments(self) -> list[Segment]:
+        with self.lock:
+            return self.segments[:-1]
+
+    def delete(self, segment: Segment):
+        # records of a sealed segment may still be waiting for the flusher
+        self.wait(segment.start_lsn + segment.size)
+        with self.lock:
+            self.segments.remove(segment)
+        if segment.file:
+            segment.file.close()
+            segment.file = None
+        os.remove(segment.path)
+        fsync_directory(self.directory)
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                if not self.buffer:
+                    self.pending.wait()
+                    continue
+            # records appended while the previous fsync ran are already batched,
+            # an optional delay gathers a larger group at the cost of latency
+            if self.group_commit_delay:
+                time.sleep(self.group_commit_delay)
+            self.flush()
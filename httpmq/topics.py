@@ -0,0 +1,109 @@
+# Topic names are '/'-separated levels. Subscriptions may also be MQTT-style filters, where a + level
+# matches exactly one level and a trailing # level matches any number of levels, including none.
+# Wildcards only count as such when they fill a whole level, so 'c++' is still an ordinary name.
+SINGLE = '+'
+MULTI = '#'
+
+def is_filter(name: str) -> bool:
+    levels = name.split('/')
+    if MULTI in levels[:-1]:
+        raise ValueError(f'# must be the last level of {name}')
+    return SINGLE in levels or levels[-1] == MULTI
+
+def matches(pattern: str, name: str) -> bool:
+    # whether a filter matches a topic name, for a single check where building a trie does not pay
+    levels = name.split('/')
+    for index, level in enumerate(pattern.split('/')):
+        if level == MULTI:
+            return True
+        if index == len(levels) or (level != SINGLE and level != levels[index]):
+            return False
+    return len(levels) == index + 1
+
+class TopicTrie:
+    # maps names or filters to values one level per node, so every lookup walks the levels
+    # of the name instead of scanning what is stored
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children: dict[str, TopicTrie] = {}
+        self.value = None
+
+    def get(self, name: str) -> any:
+        node = self
+        for level in name.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node.value
+
+    def insert(self, name: str, value: any):
+        node = self
+        for level in name.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicTrie()
+            node = child
+        node.value = value
+
+    def remove(self, name: str):
+        levels = name.split('/')
+        path = [self]
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].value = None
+        # prune the branch up to the first node still in use
+        for depth in range(len(levels), 0, -1):
+            if path[depth].value is not None or path[depth].children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+
+    def filters_matching(self, name: str) -> list:
+        # the values of the stored filters that match a topic name
+        found = []
+        self._filters_matching(name.split('/'), 0, found)
+        return found
+
+    def _filters_matching(self, levels: list[str], index: int, found: list):
+        multi = self.children.get(MULTI)
+        if multi and multi.value is not None:
+            found.append(multi.value)
+        if index == len(levels):
+            if self.value is not None:
+                found.append(self.value)
+            return
+        for level in (levels[index], SINGLE):
+            child = self.children.get(level)
+            if child:
+                child._filters_matching(levels, index + 1, found)
+
+    def names_matching(self, pattern: str) -> list:
+        # the values of the stored names that a filter matches
+        found = []
+        self._names_matching(pattern.split('/'), 0, found)
+        return found
+
+    def _names_matching(self, levels: list[str], index: int, found: list):
+        if index == len(levels):
+            if self.value is not None:
+                found.append(self.value)
+            return
+        level = levels[index]
+        if level == MULTI:
+            self._collect(found)
+        elif level == SINGLE:
+            for child in self.children.values():
+                child._names_matching(levels, index + 1, found)
+        else:
+            child = self.children.get(level)
+            if child:
+                child._names_matching(levels, index + 1, found)
+
+    def _collect(self, found: list):
+        if self.value is not None:
+            found.append(self.value)
+        for child in self.children.values():
+            child._collect(found)
@@ -0,0 +1,221 @@
+# Opt-in tracing. attach() wraps the queue's methods and its locks on the instance, the queue-wide ones as well
+# as those of every topic and session, so nothing is paid while tracing is off and it can be switched on and off
+# at runtime. Every call becomes a span with its wall time, the time spent waiting for the wrapped locks, and
+# the items and bytes it scanned, which the queue reports through count_scanned where it walks its data.
+# Spans slower than slow_seconds go to the httpmq.slow logger and a ring buffer served to admins, and a
+# sampled fraction of outermost spans runs under cProfile so the slow ones come with their hot functions.
+# The current span lives in a context variable, so spans nest across threads and asyncio tasks alike.
+from collections import deque
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Iterable
+import cProfile
+import functools
+import io
+import json
+import logging
+import pstats
+import random
+import threading
+import time
+
+logger = logging.getLogger('httpmq.slow')
+# shared by every tracer, so the queue can report what it scans without knowing which one is attached
+current_span: ContextVar['Span'] = ContextVar('span', default=None)
+
+class Span:
+    __slots__ = ('name', 'parent', 'started', 'wall', 'lock_wait', 'items', 'bytes', 'profile')
+
+    def __init__(self, name: str, parent: 'Span' = None):
+        self.name = name
+        self.parent = parent
+        self.started = time.time()
+        self.wall = 0.0
+        self.lock_wait = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.profile: str = None
+
+    def to_dict(self) -> dict:
+        span = {
+            'name': self.name,
+            'parent': self.parent.name if self.parent else None,
+            'started': round(self.started, 3),
+            'wall_ms': round(self.wall * 1e3, 3),
+            'lock_wait_ms': round(self.lock_wait * 1e3, 3),
+            'items': self.items,
+            'bytes': self.bytes,
+        }
+        if self.profile:
+            span['profile'] = self.profile
+        return span
+
+class TracedLock:
+    # adds the time spent acquiring the wrapped lock to the current span
+    __slots__ = ('lock', 'current')
+
+    def __init__(self, lock, current: ContextVar):
+        self.lock = lock
+        self.current = current
+
+    def __enter__(self):
+        span = self.current.get()
+        if span is None:
+            self.lock.__enter__()
+            return self
+        start = perf_counter()
+        self.lock.__enter__()
+        span.lock_wait += perf_counter() - start
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.lock.__exit__(*exc_info)
+
+class Tracer:
+    SLOW_LOG_SIZE = 200
+    PROFILE_LINES = 15
+
+    def __init__(self, slow_seconds: float = 0.1, profile_rate: float = 0):
+        self.enabled = False
+        self.slow_seconds = slow_seconds
+        self.profile_rate = profile_rate # fraction of outermost spans run under cProfile
+        self.current = current_span
+        self.slow: deque[dict] = deque(maxlen=self.SLOW_LOG_SIZE)
+        self.lock = threading.Lock()
+        self.attached: list[tuple[object, str, object]] = [] # (target, attribute, its own value or None)
+        self.lock_owners: list[tuple[object, tuple[str, ...]]] = [] # (target, dicts of objects with a lock)
+
+    def attach(self, target, methods: tuple[str, ...], locks: tuple[str, ...] = (), lock_owners: tuple[str, ...] = (),
+               lock_factory: str = None):
+        # callers name the methods worth a span, e.g. the part of receive that works rather than waits, the locks,
+        # the dicts whose values have a lock of their own and the method that makes those locks for new values
+        with self.lock:
+            if any(attached is target for attached, _, _ in self.attached):
+                return
+            for name in methods:
+                method = getattr(target, name, None)
+                if method is not None:
+                    self.attached.append((target, name, vars(target).get(name)))
+                    setattr(target, name, self.wrap(name.lstrip('_'), method))
+            for name in locks:
+                lock = getattr(target, name, None)
+                if lock is not None:
+                    self.attached.append((target, name, lock))
+                    setattr(target, name, TracedLock(lock, self.current))
+            if lock_factory:
+                # first, so an object created while the existing ones are wrapped gets a traced lock too
+                factory = getattr(target, lock_factory)
+                self.attached.append((target, lock_factory, vars(target).get(lock_factory)))
+                setattr(target, lock_factory, self.wrap_lock_factory(factory))
+            for name in lock_owners:
+                for owner in list(getattr(target, name).values()):
+                    if not isinstance(owner.lock, TracedLock):
+                        owner.lock = TracedLock(owner.lock, self.current)
+            self.lock_owners.append((target, lock_owners))
+            self.enabled = True
+
+    def detach(self):
+        # a caller holding a traced lock still releases the lock it wraps
+        with self.lock:
+            for target, name, own in reversed(self.attached):
+                if own is None:
+                    # back to the method of the class
+                    delattr(target, name)
+                else:
+                    setattr(target, name, own)
+            # the objects wrapped on attach and those created since
+            for target, names in self.lock_owners:
+                for name in names:
+                    for owner in list(getattr(target, name).values()):
+                        if isinstance(owner.lock, TracedLock):
+                            owner.lock = owner.lock.lock
+            self.attached = []
+            self.lock_owners = []
+            self.enabled = False
+
+    def configure(self, slow_seconds: float = None, profile_rate: float = None):
+        for value in (slow_seconds, profile_rate):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError('expected a non-negative number')
+        if profile_rate is not None and profile_rate > 1:
+            raise ValueError('profile_rate is a fraction')
+        if slow_seconds is not None:
+            self.slow_seconds = slow_seconds
+        if profile_rate is not None:
+            self.profile_rate = profile_rate
+
+    def wrap(self, name: str, method):
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return method(*args, **kwargs)
+        return traced
+
+    def wrap_lock_factory(self, factory):
+        @functools.wraps(factory)
+        def traced(*args, **kwargs):
+            return TracedLock(factory(*args, **kwargs), self.current)
+        return traced
+
+    def span(self, name: str, profile: bool = True) -> 'SpanContext':
+        # profile=False for spans that await, cProfile would charge them for every other task
+        return SpanContext(self, name, profile)
+
+    def finish(self, span: Span):
+        if span.wall < self.slow_seconds:
+            return
+        entry = span.to_dict()
+        self.slow.append(entry)
+        logger.warning('slow %s', json.dumps(entry))
+
+    def state(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'slow_seconds': self.slow_seconds,
+            'profile_rate': self.profile_rate,
+            'slow': list(self.slow),
+        }
+
+class SpanContext:
+    __slots__ = ('tracer', 'name', 'allow_profile', 'span', 'token', 'profiler', 'start')
+
+    def __init__(self, tracer: Tracer, name: str, allow_profile: bool):
+        self.tracer = tracer
+        self.name = name
+        self.allow_profile = allow_profile
+
+    def __enter__(self) -> Span:
+        parent = self.tracer.current.get()
+        self.span = Span(self.name, parent)
+        self.token = self.tracer.current.set(self.span)
+        self.profiler = None
+        if parent is None and self.allow_profile and self.tracer.profile_rate and random.random() < self.tracer.profile_rate:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # another profiler is active in this thread
+                self.profiler = None
+        self.start = perf_counter()
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.wall = perf_counter() - self.start
+        if self.profiler:
+            self.profiler.disable()
+            if self.span.wall >= self.tracer.slow_seconds:
+                self.span.profile = top_functions(self.profiler, self.tracer.PROFILE_LINES)
+        self.tracer.current.reset(self.token)
+        self.tracer.finish(self.span)
+
+def count_scanned(items: int, messages: Iterable = ()):
+    # entries the current call looked at and the messages whose data it read, a no-op unless it is traced
+    span = current_span.get()
+    if span is not None:
+        span.items += items
+        span.bytes += sum(message.size for message in messages)
+
+def top_functions(profiler: cProfile.Profile, lines: int) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(lines)
+    return output.getvalue()
@@ -0,0 +1,133 @@
+# Restarts from the write-ahead log: after segment compaction, from a snapshot and the log written
+# after it, with a torn final record, and of wildcard subscriptions.
+import heapq
+import os
+import time
+from httpmq.message_queue import MessageQueue
+from httpmq.snapshot import list_snapshots
+from httpmq.storage import HEADER, RECORD_PUBLISH, SegmentLog
+
+def reopen(mq: MessageQueue, directory: str) -> MessageQueue:
+    mq.close()
+    return MessageQueue(SegmentLog(directory))
+
+def seal(mq: MessageQueue):
+    # the next record starts a new segment
+    mq.storage.segment_bytes = mq.storage.segments[-1].size
+
+def expire_session(mq: MessageQueue, session_id: str):
+    # as if the session had been idle for longer than its ttl, and only that one is due
+    mq.sessions[session_id].last_active -= mq.SESSION_TTL + 1
+    with mq.expiry_lock:
+        heapq.heappush(mq.session_expiry, (0, session_id))
+    mq._expire_sessions(int(time.time()), 100)
+
+def test_compaction_keeps_live_sessions(tmp_path):
+    directory = str(tmp_path)
+    mq = MessageQueue(SegmentLog(directory))
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    published = mq.publish_many([('a', 'short', 1), ('a', 'long', 3600)])
+    mq.acknowledge('s', 'a', published[0].message_id)
+    seal(mq)
+    mq.register('other')
+    mq._compact_storage(int(time.time()) + 10)
+    assert len(mq.storage.segments) == 2
+    mq = reopen(mq, directory)
+    assert mq.get_subscriptions('s') == ['a']
+    assert [message.data for message in mq.receive('s')] == ['long']
+    mq.close()
+
+def test_compaction_keeps_session_expiry(tmp_path):
+    directory = str(tmp_path)
+    mq = MessageQueue(SegmentLog(directory))
+    # the first segment registers the session and outlives the second
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    mq.publish('a', 'long', 3600)
+    seal(mq)
+    mq.publish('b', 'short', 1)
+    expire_session(mq, 's')
+    seal(mq)
+    mq.register('other')
+    mq._compact_storage(int(time.time()) + 10)
+    assert len(mq.storage.segments) == 2
+    mq = reopen(mq, directory)
+    assert 's' not in mq.sessions
+    # the carried forward tombstone survives compactions until the registration is gone
+    seal(mq)
+    mq.register('another')
+    mq._compact_storage(int(time.time()) + 10)
+    mq = reopen(mq, directory)
+    assert 's' not in mq.sessions
+    assert 'other' in mq.sessions
+    mq.close()
+
+def test_torn_final_record(tmp_path):
+    directory = str(tmp_path)
+    mq = MessageQueue(SegmentLog(directory))
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    mq.publish_many([('a', 'first', 3600), ('a', 'second', 3600)])
+    mq.close()
+    path = SegmentLog(directory).segments[-1].path
+    size = os.path.getsize(path)
+    # a crash in the middle of writing a publish
+    with open(path, 'ab') as file:
+        file.write(HEADER.pack(100, 0, RECORD_PUBLISH) + b'partial')
+    mq = MessageQueue(SegmentLog(directory))
+    assert os.path.getsize(path) == size
+    assert [message.data for message in mq.receive('s')] == ['first', 'second']
+    mq.publish('a', 'third', 3600)
+    mq = reopen(mq, directory)
+    assert [message.data for message in mq.receive('s')] == ['first', 'second', 'third']
+    mq.close()
+
+def test_snapshot_and_log_tail(tmp_path):
+    directory = str(tmp_path)
+    mq = MessageQueue(SegmentLog(directory))
+    mq.register('s')
+    mq.register('gone')
+    mq.subscribe('s', 'a')
+    mq.subscribe('s', 'b', 'workers')
+    published = mq.publish_many([('a', 'one', 3600), ('a', {'n': 2}, 3600), ('a', 'three', 3600), ('b', 'job', 3600)])
+    # out of order, so the snapshot has to keep the ack bitmap
+    mq.acknowledge('s', 'a', published[1].message_id)
+    seal(mq)
+    mq.register('other')
+    lsn = mq.snapshot()
+    # the sealed segment is covered by the snapshot and dropped
+    assert [segment.start_lsn > 0 for segment in mq.storage.segments] == [True]
+    mq.acknowledge_up_to('s', 'a', published[0].seq)
+    mq.publish('a', 'four', 3600)
+    mq.subscribe('s', 'c')
+    mq.publish('c', 'five', 3600)
+    expire_session(mq, 'gone')
+    mq.register('new')
+    mq = reopen(mq, directory)
+    assert [snapshot_lsn for snapshot_lsn, _ in list_snapshots(directory)] == [lsn]
+    assert sorted(mq.sessions) == ['new', 'other', 's']
+    assert sorted(mq.get_subscriptions('s')) == ['a', 'b', 'c']
+    # topics come back in no particular order, messages of one topic in order
+    received = sorted(mq.receive('s'), key=lambda message: message.topic)
+    assert [message.data for message in received] == ['three', 'four', 'job', 'five']
+    mq.close()
+
+def test_unsubscribed_topic_stays_out_of_its_filter(tmp_path):
+    directory = str(tmp_path)
+    mq = MessageQueue(SegmentLog(directory))
+    mq.register('s')
+    mq.publish('t', 'p1', 3600)
+    mq.subscribe('s', '+')
+    mq.unsubscribe('s', 't')
+    mq.publish('t', 'p4', 3600)
+    assert mq.receive('s') == []
+    # from the log, then from a snapshot
+    mq = reopen(mq, directory)
+    assert mq.receive('s') == []
+    assert mq.get_subscriptions('s') == ['+']
+    mq.snapshot()
+    mq = reopen(mq, directory)
+    assert mq.receive('s') == []
+    assert mq.get_subscriptions('s') == ['+']
+    mq.close()
@@ -0,0 +1,65 @@
+# Messages dropped by drop_unsubscribed use up sequence numbers without taking space in the topic log.
+from httpmq.message_queue import MessageQueue
+from httpmq.models import Retention
+from httpmq.storage import SegmentLog
+
+def test_dropped_messages_take_no_slots():
+    mq = MessageQueue(None, {'': Retention(drop_unsubscribed=True)})
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    mq.publish('a', 'kept', 3600)
+    mq.unsubscribe('s', 'a')
+    for i in range(1000):
+        mq.publish('a', f'dropped {i}', 3600)
+    topic = mq.topics['a']
+    assert (len(topic.log), topic.count, topic.next_seq) == (1, 1, 1001)
+    mq.subscribe('s', 'a')
+    after = mq.publish('a', 'after', 3600)
+    assert after.seq == 1001
+    assert topic.get(500) is None
+    assert [message.data for message in mq.receive('s')] == ['kept', 'after']
+    assert [lag['unread'] for lag in mq.get_lag('a')[0]['consumers']] == [2]
+    messages, last = mq.get_messages('a')
+    assert ([message['data'] for message in messages], last) == (['kept', 'after'], None)
+
+def test_dropped_sequence_numbers_survive_a_restart(tmp_path):
+    retention = {'': Retention(drop_unsubscribed=True)}
+    mq = MessageQueue(SegmentLog(str(tmp_path)), retention)
+    mq.publish('a', 'dropped', 3600)
+    dropped = mq.publish('a', 'dropped too', 3600)
+    mq.close()
+    mq = MessageQueue(SegmentLog(str(tmp_path)), retention)
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    assert mq.publish('a', 'kept', 3600).seq == dropped.seq + 1
+    mq.close()
+
+def test_reclaimed_messages_leave_the_expiry_heap():
+    mq = MessageQueue(None, {'': Retention(reclaim_acked=True)})
+    for session_id in ('s', 't'):
+        mq.register(session_id)
+        mq.subscribe(session_id, 'a')
+    for i in range(100):
+        mq.publish('a', f'message {i}', 3600)
+    for session_id in ('s', 't'):
+        for message in mq.receive(session_id, max_messages=100):
+            mq.acknowledge(session_id, 'a', message.message_id)
+    topic = mq.topics['a']
+    assert topic.count == 0
+    assert len(mq.message_expiry) <= 1
+    assert mq.retained_bytes == 0
+
+def test_trimmed_messages_leave_the_expiry_heap_and_the_budget():
+    mq = MessageQueue(None, {'': Retention(max_messages=10)})
+    mq.register('s')
+    mq.subscribe('s', 'a')
+    for i in range(1000):
+        mq.publish('a', f'message {i}', 3600)
+    assert len(mq.message_expiry) <= 2 * 10 + 1
+    mq.receive('s', encode=True)
+    topic = mq.topics['a']
+    retained = [message.size + len(message.encoded) + mq.MESSAGE_OVERHEAD for message in topic.since(topic.first_seq)]
+    assert mq.retained_bytes == sum(retained)
+    for i in range(10):
+        mq.publish('a', f'later {i}', 3600)
+    assert mq.retained_bytes == sum(message.size + mq.MESSAGE_OVERHEAD for message in topic.since(topic.first_seq))